@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for building calls from wide multi-sample VCF rows, comparing column-by-column parsing with NumPy decoding
+(if NumPy is installed.)
+
+Usage: python3 benchmarks/genotype_decoding.py [n_samples] [n_rows]
+"""
+
+import random
+import sys
+import timeit
+
+from bento_variant_service.tables.vcf import table as vcf_table
+from bento_variant_service.variants.models import Allele, Variant
+
+
+GENOTYPES = ("0/0", "0/0", "0/0", "0/0", "0|1", "1|1", "./.")
+
+
+def make_row(rng: random.Random, n_samples: int) -> tuple:
+    return ("22", "16050075", ".", "A", "G", "50", "PASS", ".", "GT:AD:DP:GQ",
+            *(f"{rng.choice(GENOTYPES)}:10,2:{rng.randint(0, 60)}:99" for _ in range(n_samples)))
+
+
+def main():
+    n_samples = int(sys.argv[1]) if len(sys.argv) > 1 else 2500
+    n_rows = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    rng = random.Random(42)
+    rows = [make_row(rng, n_samples) for _ in range(n_rows)]
+    sample_ids = tuple(f"S{i:05d}" for i in range(n_samples))
+    variant = Variant("GRCh37", "22", "A", (Allele.from_vcf("G"),), 16050075)
+
+    def run(only_interesting: bool):
+        for row in rows:
+            tuple(vcf_table.VCFVariantTable._variant_calls(variant, sample_ids, row, only_interesting))
+
+    has_numpy = vcf_table.HAS_NUMPY
+    print(f"{n_rows} rows x {n_samples} samples")
+    for only_interesting in (False, True):
+        vcf_table.HAS_NUMPY = False
+        python_time = min(timeit.repeat(lambda: run(only_interesting), number=1, repeat=3))
+        print(f"  only_interesting={only_interesting}:")
+        print(f"    pure Python: {python_time * 1000:.1f} ms")
+
+        if has_numpy:
+            vcf_table.HAS_NUMPY = True
+            numpy_time = min(timeit.repeat(lambda: run(only_interesting), number=1, repeat=3))
+            print(f"          NumPy: {numpy_time * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
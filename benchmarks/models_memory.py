@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for the memory footprint of variant / call / allele models, e.g. for a region search result on a large
+cohort. Builds variants with calls for every sample the same way VCF tables do, and reports the memory allocated, next
+to a baseline of dict-backed models like the ones used before slots and shared alleles (which store the alleles of
+each call's genotype on the call.) Also times getting the genotype alleles of every call, which the models build once
+per distinct genotype of each variant rather than storing on every call.
+
+Usage: python3 benchmarks/models_memory.py [n_variants] [n_samples]
+"""
+
+import random
+import sys
+import timeit
+import tracemalloc
+
+from bento_variant_service.variants.models import Allele, AlleleClass, Call, Variant
+
+
+GENOTYPES = ((0, 0), (0, 0), (0, 0), (0, 0), (0, 1), (1, 1), (".", "."))
+
+
+class BaselineAllele:
+    def __init__(self, allele_class: AlleleClass, value: str):
+        self.allele_class = allele_class
+        self.value = value
+
+
+class BaselineVariant:
+    def __init__(self, assembly_id, chromosome, ref_bases, alt_alleles, start_pos, qual=None, calls=(), file_uri=None):
+        self.assembly_id = assembly_id
+        self.chromosome = chromosome
+        self.ref_bases = ref_bases
+        self.alt_alleles = alt_alleles
+        self.start_pos = start_pos
+        self.qual = qual
+        self.calls = calls
+        self.file_uri = file_uri
+
+    @property
+    def ref_allele(self):
+        return BaselineAllele(AlleleClass.SEQUENCE, self.ref_bases)
+
+
+class BaselineCall:
+    def __init__(self, variant, sample_id, genotype, phased=False, phase_set=None, read_depth=None):
+        self.variant = variant
+        self.sample_id = sample_id
+        self.genotype = genotype
+        self.phased = phased
+        self.phase_set = phase_set if phased else None
+        self.read_depth = read_depth
+        self.genotype_alleles = tuple(map(self._genotype_to_allele, genotype))
+        self.genotype_type = Call.genotype_type_of(genotype)
+
+    def _genotype_to_allele(self, g):
+        if g == ".":
+            return BaselineAllele(AlleleClass.MISSING, ".")
+        elif g == 0:
+            return self.variant.ref_allele
+        return self.variant.alt_alleles[g - 1]
+
+
+MODELS = (
+    ("models", Variant, Call, Allele.from_vcf),
+    ("dict-backed baseline", BaselineVariant, BaselineCall,
+     lambda a: BaselineAllele(Allele.class_from_vcf(a), a)),
+)
+
+
+def build_variants(variant_class, call_class, make_allele, n_variants: int, n_samples: int):
+    rng = random.Random(42)
+    sample_ids = tuple(f"S{i:05d}" for i in range(n_samples))
+
+    variants = []
+    for i in range(n_variants):
+        ref, alt = rng.sample("ACGT", 2)
+        variant = variant_class(
+            assembly_id="GRCh37",
+            chromosome="22",
+            ref_bases=ref,
+            alt_alleles=(make_allele(alt),),
+            start_pos=16050000 + i,
+            qual=50.0,
+        )
+        variant.calls = tuple(
+            call_class(variant=variant, sample_id=sample_id, genotype=rng.choice(GENOTYPES), phased=False)
+            for sample_id in sample_ids
+        )
+        variants.append(variant)
+
+    return variants
+
+
+def genotype_alleles(variants):
+    for v in variants:
+        for c in v.calls:
+            _ = c.genotype_alleles
+
+
+def main():
+    n_variants = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    n_samples = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    print(f"{n_variants} variants, {n_variants * n_samples} calls")
+
+    for name, variant_class, call_class, make_allele in MODELS:
+        tracemalloc.start()
+        variants = build_variants(variant_class, call_class, make_allele, n_variants, n_samples)
+        current, peak = tracemalloc.get_traced_memory()
+
+        # Time getting every call's alleles, e.g. to build the representation of a search result; the first pass is
+        # the one which builds anything that gets cached.
+        first = timeit.timeit(lambda: genotype_alleles(variants), number=1)
+        again = timeit.timeit(lambda: genotype_alleles(variants), number=1)
+        after_access, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        n_calls = sum(len(v.calls) for v in variants)
+        print(f"  {name}:")
+        print(f"          allocated: {current / 2 ** 20:.1f} MiB ({current / n_calls:.1f} bytes / call)")
+        print(f"               peak: {peak / 2 ** 20:.1f} MiB")
+        print(f"    genotype_alleles: {first * 1000:.1f} ms first pass, {again * 1000:.1f} ms after; "
+              f"{(after_access - current) / 2 ** 20:.1f} MiB more allocated")
+
+
+if __name__ == "__main__":
+    main()
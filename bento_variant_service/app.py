@@ -3,6 +3,7 @@ import subprocess
 import sys
 
 from bento_lib.responses import flask_errors
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, jsonify, current_app
 from typing import Any, Dict, Optional
 from urllib.parse import quote
@@ -12,7 +13,7 @@ from bento_variant_service import __version__
 from bento_variant_service.beacon.routes import bp_beacon
 from bento_variant_service.constants import SERVICE_NAME, SERVICE_TYPE, SERVICE_ID
 from bento_variant_service.ingest import bp_ingest
-from bento_variant_service.pool import teardown_pool
+from bento_variant_service.metrics import bp_metrics
 from bento_variant_service.search import bp_chord_search
 from bento_variant_service.tables.routes import bp_tables
 from bento_variant_service.table_manager import (
@@ -50,6 +51,13 @@ def create_app(test_config: Optional[Dict[str, Any]] = None):
 
         # Override host for all DRS requests. If set to blank, this will fetch from the 'true' DRS host instead.
         "DRS_URL": os.environ.get("DRS_URL", UNIX_DRS_BASE_PATH),
+
+        # Build carrier indices for ingested VCFs, for answering carrier queries without parsing genotypes
+        "BUILD_CARRIER_INDEX": os.environ.get("BUILD_CARRIER_INDEX", "true").strip().lower() == "true",
+        # Build per-sample indices for ingested VCFs, for finding a sample's variants without reading every row
+        "BUILD_SAMPLE_INDEX": os.environ.get("BUILD_SAMPLE_INDEX", "true").strip().lower() == "true",
+        # Indices are built in the background after ingests, one file at a time
+        "INDEX_BUILD_EXECUTOR": ThreadPoolExecutor(max_workers=1, thread_name_prefix="vcf_indices"),
     }
 
     if test_config:  # pragma: no cover
@@ -76,6 +84,7 @@ def create_app(test_config: Optional[Dict[str, Any]] = None):
     application.register_blueprint(bp_beacon)
     application.register_blueprint(bp_chord_search)
     application.register_blueprint(bp_ingest)
+    application.register_blueprint(bp_metrics)
     application.register_blueprint(bp_tables)
     application.register_blueprint(bp_workflows)
 
@@ -92,7 +101,6 @@ def create_app(test_config: Optional[Dict[str, Any]] = None):
 
     @application.teardown_appcontext
     def app_teardown(err):
-        teardown_pool(err)
         clear_table_manager(err)
 
     @application.route("/service-info", methods=["GET"])
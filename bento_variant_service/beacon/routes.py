@@ -4,27 +4,16 @@
 import bento_variant_service
 import os
 
-from bento_lib.search.queries import (
-    convert_query_to_ast,
-    and_asts_to_ast,
-
-    FUNCTION_RESOLVE,
-    FUNCTION_NOT,
-    FUNCTION_LE,
-    FUNCTION_GE,
-    FUNCTION_EQ
-)
-
 from flask import Blueprint, json, jsonify, request, Response
 from itertools import chain
 from jsonschema import validate, ValidationError
 from typing import Callable, List, Optional, Tuple
 from urllib.parse import urlparse
 
-from bento_variant_service.search import generic_variant_search
+from bento_variant_service.coalescing import SingleFlight
+from bento_variant_service.search import beacon_variant_search, table_generations
 from bento_variant_service.tables.base import TableManager
 from bento_variant_service.table_manager import get_table_manager
-from bento_variant_service.variants.genotypes import GT_HOMOZYGOUS_REFERENCE
 
 
 CHORD_URL = os.environ.get("CHORD_URL", "http://localhost:5000/")
@@ -39,6 +28,9 @@ BEACON_API_VERSION = "v1.0"
 
 BEACON_SEARCH_TIMEOUT = 30
 
+# Identical Beacon queries which come in while one is already running share its results
+_beacon_query_flights = SingleFlight("beacon_queries", timeout=BEACON_SEARCH_TIMEOUT)
+
 bp_beacon = Blueprint("beacon", __name__)
 
 with bp_beacon.open_resource("schemas/beacon_allele_request.schema.json") as bars:
@@ -185,40 +177,22 @@ def beacon_query():
 
     dataset_ids = query.get("datasetIds", None)
     if dataset_ids is not None:
-        dataset_ids = tuple(set(d.split(":")[0] for d in dataset_ids))
+        dataset_ids = tuple(sorted(set(d.split(":")[0] for d in dataset_ids)))
 
     table_manager: TableManager = get_table_manager()
 
-    # Create an additional filtering query based on the rest of the Beacon request, plus other filtering we want to do
-    rest_of_query = and_asts_to_ast((
-        *(
-            convert_query_to_ast([fn, [FUNCTION_RESOLVE, *field], value])
-            for fn, field, value in (
-                (FUNCTION_GE, ("end",), end_min),
-                (FUNCTION_LE, ("end",), end_max),
-                (FUNCTION_EQ, ("ref",), ref),
-
-                # One of the two below will be none
-                (FUNCTION_EQ, ("calls", "[item]", "genotype_alleles", "[item]"), alt_allele),
-                (FUNCTION_EQ, ("calls", "[item]", "genotype_alleles", "[item]"), alt_id),
-            ) if value is not None
-        ),
-
-        # Only want interesting results
-        convert_query_to_ast([FUNCTION_NOT, [
-            FUNCTION_EQ,
-            [FUNCTION_RESOLVE, "calls", "[item]", "genotype_type"],
-            GT_HOMOZYGOUS_REFERENCE
-        ]])
-    ))
+    alt = alt_allele if alt_allele is not None else alt_id
+    query_key = (assembly_id, query["referenceName"], start_min, start_max, end_min, end_max, ref, alt, dataset_ids,
+                 table_generations(table_manager))
 
     # noinspection PyTypeChecker
-    results = generic_variant_search(table_manager, chromosome=query["referenceName"], start_min=start_min,
-                                     start_max=start_max, rest_of_query=rest_of_query, assembly_id=assembly_id,
-                                     dataset_ids=dataset_ids, timeout=BEACON_SEARCH_TIMEOUT)
+    results = _beacon_query_flights.do(query_key, lambda: tuple(beacon_variant_search(
+        table_manager, assembly_id=assembly_id, chromosome=query["referenceName"], start_min=start_min,
+        start_max=start_max, end_min=end_min, end_max=end_max, ref=ref, alt=alt, dataset_ids=dataset_ids,
+        timeout=BEACON_SEARCH_TIMEOUT)))
 
     include_dataset_responses = query.get("includeDatasetResponses", BEACON_IDR_NONE)
-    dataset_matches = set(bd.beacon_id for bd in chain.from_iterable(d.beacon_datasets for d, _ in results)
+    dataset_matches = set(bd.beacon_id for bd in chain.from_iterable(d.beacon_datasets for d in results)
                           if bd.assembly_id == assembly_id)
 
     if include_dataset_responses == BEACON_IDR_ALL:
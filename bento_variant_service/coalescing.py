@@ -0,0 +1,85 @@
+import threading
+
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from bento_variant_service.metrics import get_counter, increment_counter, set_gauge
+
+
+__all__ = [
+    "SingleFlight",
+]
+
+
+class _Flight:
+    __slots__ = ("done", "result", "succeeded")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.succeeded = False
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into a single execution: the first caller (the leader) runs the call,
+    and callers with the same key which come in while it's running wait for it and share its result. Calls which are
+    made after it's done run again. If the leader fails or gives up, or takes longer than the timeout, whoever was
+    waiting on it runs the call for themselves instead.
+
+    Coalescing only happens within a process. The numbers of executed and coalesced calls, and the ratio of coalesced
+    calls to all calls, are kept in the metrics under the flight's name.
+    """
+
+    def __init__(self, name: str, timeout: Optional[float] = None):
+        self.name = name
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, _Flight] = {}
+
+    def _join(self, key: Hashable) -> Tuple[_Flight, bool]:
+        # Gets the flight in progress for the key, or starts a new one; also returns whether the caller is the leader.
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+            increment_counter(f"{self.name}_executed" if leader else f"{self.name}_coalesced")
+            n_executed = get_counter(f"{self.name}_executed")
+            n_coalesced = get_counter(f"{self.name}_coalesced")
+            set_gauge(f"{self.name}_coalescing_ratio", n_coalesced / (n_executed + n_coalesced))
+
+        return flight, leader
+
+    def _land(self, key: Hashable, flight: _Flight, result: Any = None, succeeded: bool = False):
+        with self._lock:
+            # Calls from here on start a new flight
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+        flight.result = result
+        flight.succeeded = succeeded
+        flight.done.set()
+
+    def _wait(self, flight: _Flight) -> bool:
+        return flight.done.wait(self.timeout) and flight.succeeded
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """
+        Calls fn, unless a call with the same key is already in progress, in which case its result is returned instead.
+        """
+
+        flight, leader = self._join(key)
+
+        if not leader:
+            return flight.result if self._wait(flight) else fn()
+
+        succeeded = False
+        result = None
+        try:
+            result = fn()
+            succeeded = True
+            return result
+        finally:
+            self._land(key, flight, result, succeeded)
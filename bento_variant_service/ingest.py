@@ -2,6 +2,7 @@ import json
 import os
 import shutil
 import sys
+import traceback
 
 from base64 import urlsafe_b64encode
 from bento_lib.responses import flask_errors
@@ -17,9 +18,10 @@ from bento_lib.workflows import (
     get_workflow,
     workflow_exists,
 )
+from concurrent.futures import Future
 from flask import Blueprint, current_app, request
 from jsonschema import validate, ValidationError
-from typing import List, Tuple
+from typing import List, Optional, Sequence, Tuple, Type
 from urllib.parse import urlparse
 
 from bento_variant_service.constants import SERVICE_NAME
@@ -28,6 +30,10 @@ from bento_variant_service.table_manager import (
     MANAGER_TYPE_MEMORY,
     get_table_manager,
 )
+from bento_variant_service.tables.base import TableManager
+from bento_variant_service.tables.vcf.carriers import CarrierIndexBuilder
+from bento_variant_service.tables.vcf.sample_index import SampleIndexBuilder
+from bento_variant_service.tables.vcf.sidecars import SidecarBuilder, build_sidecars
 from bento_variant_service.workflows import WORKFLOWS
 
 
@@ -84,7 +90,7 @@ def write_drs_object_files(table_id: str, request_data: dict):  # pragma: no cov
             json.dump({"data": vcf_url, "index": idx_url}, df)
 
 
-def move_ingest_files(table_id: str, request_data: dict):
+def move_ingest_files(table_id: str, request_data: dict) -> List[str]:
     workflow_id, workflow_outputs, workflow_params = get_ingest_metadata_from_request(request_data)
     workflow_metadata = get_workflow(workflow_id, WORKFLOWS)
 
@@ -111,6 +117,55 @@ def move_ingest_files(table_id: str, request_data: dict):
         # Move the file from its temporary location to its location in the service's data folder.
         shutil.move(tmp_file_path, file_path)
 
+    return [file_path for _, file_path in files_to_move]
+
+
+def build_vcf_indices(file_paths: List[str], builder_classes: Sequence[Type[SidecarBuilder]]):
+    if not builder_classes:
+        return
+
+    for file_path in filter(lambda f: f.endswith(".vcf.gz"), file_paths):
+        try:
+            # All of a file's indices are built in the same pass over its rows
+            print(f"[{SERVICE_NAME}] Building indices for {file_path}: "
+                  f"{', '.join(b.SIDECAR.__name__ for b in builder_classes)}", flush=True)
+            build_sidecars(file_path, builder_classes)
+        except (OSError, ValueError) as e:
+            # Indices are optional; without them, searches read and parse rows instead
+            print(f"[{SERVICE_NAME}] [ERROR] Could not build indices for {file_path}: {e}", file=sys.stderr, flush=True)
+
+
+def _build_vcf_indices_and_update(table_manager: TableManager, file_paths: List[str],
+                                  builder_classes: Sequence[Type[SidecarBuilder]]):
+    try:
+        build_vcf_indices(file_paths, builder_classes)
+        # Reload the tables' files, which opens any new indices
+        table_manager.update_tables()
+    except Exception as e:  # pragma: no cover
+        # Nothing is waiting on this job, so make sure any errors end up in the logs
+        print(f"[{SERVICE_NAME}] [ERROR] Encountered exception while building indices: {e}", file=sys.stderr,
+              flush=True)
+        traceback.print_exc()
+
+
+def queue_vcf_indices(file_paths: List[str]) -> Optional[Future]:
+    """
+    Queues index builds for any ingested VCFs on the app's index build executor, so that ingest requests don't wait on
+    reading every row of the ingested files; tables pick the indices up once they're done (and search without them
+    until then.) Returns the future for the builds, if any were queued.
+    """
+
+    builder_classes = (
+        *((CarrierIndexBuilder,) if current_app.config["BUILD_CARRIER_INDEX"] else ()),
+        *((SampleIndexBuilder,) if current_app.config["BUILD_SAMPLE_INDEX"] else ()),
+    )
+
+    if not builder_classes or not any(f.endswith(".vcf.gz") for f in file_paths):
+        return None
+
+    return current_app.config["INDEX_BUILD_EXECUTOR"].submit(
+        _build_vcf_indices_and_update, get_table_manager(), file_paths, builder_classes)
+
 
 # Ingest files into tables
 # Ingestion doesn't allow uploading files directly, it simply moves them from a different location on the filesystem.
@@ -150,6 +205,7 @@ def ingest():
 
         # Check manager type to determine how the ingestion will be handled
         manager_type = current_app.config["TABLE_MANAGER"]
+        ingested_files: List[str] = []
         if manager_type == MANAGER_TYPE_DRS:  # pragma: no cover
             write_drs_object_files(table_id, request.json)
         elif manager_type == MANAGER_TYPE_MEMORY:
@@ -157,13 +213,16 @@ def ingest():
             return flask_errors.flask_bad_request_error(MEMORY_CANNOT_INGEST_ERROR)
         else:  # MANAGER_TYPE_VCF
             try:
-                move_ingest_files(table_id, request.json)
+                ingested_files = move_ingest_files(table_id, request.json)
             except KeyError:  # From make_output_params; TODO: In future may change to custom exception
                 return flask_errors.flask_bad_request_error("Bad workflow parameter")
 
         # After files have been handled, refresh the tables in the manager
         get_table_manager().update_tables()
 
+        # Newly-ingested files are searchable right away; their indices are built afterwards, out of the request
+        queue_vcf_indices(ingested_files)
+
         return current_app.response_class(status=204)
 
     except (ValidationError, ValueError):  # UUID, or JSON schema failure TODO: More detailed error messages
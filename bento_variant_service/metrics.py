@@ -0,0 +1,60 @@
+import threading
+
+from flask import Blueprint, jsonify
+from typing import Dict, Union
+
+
+__all__ = [
+    "increment_counter",
+    "get_counter",
+    "set_gauge",
+    "get_metrics",
+    "clear_metrics",
+    "bp_metrics",
+]
+
+
+Number = Union[int, float]
+
+
+# Metrics are kept per-process; each (e.g. gunicorn) worker process reports its own values.
+_metrics_lock = threading.Lock()
+_counters: Dict[str, Number] = {}
+_gauges: Dict[str, Number] = {}
+
+
+def increment_counter(name: str, value: Number = 1):
+    with _metrics_lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def get_counter(name: str) -> Number:
+    with _metrics_lock:
+        return _counters.get(name, 0)
+
+
+def set_gauge(name: str, value: Number):
+    with _metrics_lock:
+        _gauges[name] = value
+
+
+def get_metrics() -> dict:
+    with _metrics_lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+        }
+
+
+def clear_metrics():
+    with _metrics_lock:
+        _counters.clear()
+        _gauges.clear()
+
+
+bp_metrics = Blueprint("metrics", __name__)
+
+
+@bp_metrics.route("/private/metrics", methods=["GET"])
+def metrics():
+    return jsonify(get_metrics())
@@ -1,6 +1,9 @@
+import multiprocessing
 import os
+import threading
 
-from flask import g
+from collections import namedtuple
+from typing import Any, Dict, Iterable, Optional, Tuple
 
 
 try:  # pragma: no cover
@@ -14,22 +17,195 @@ except ValueError:  # pragma: no cover
         WORKERS = int(os.environ.get("WORKERS", "1"))
 
 
+try:  # pragma: no cover
+    # Searches with an estimated amount of work (roughly, the number of VCF fields to parse) at or below this threshold
+    # are run in the request process, since sending them to the pool would cost more than the search itself.
+    INLINE_SEARCH_MAX_WORK = int(os.environ.get("INLINE_SEARCH_MAX_WORK", ""))
+except ValueError:  # pragma: no cover
+    INLINE_SEARCH_MAX_WORK = 1000000
+
+
 if WORKERS == 1:  # pragma: no cover
     from multiprocessing.dummy import Pool
 else:  # pragma: no cover
     from multiprocessing import Pool
 
 
-def get_pool():
-    if "pool" not in g:
-        g.pool = Pool(processes=WORKERS)
+# Most searches which can be running in the pool at once while still being able to be cancelled individually; searches
+# started while this many are already running still work, but can only be stopped by their deadline.
+MAX_CANCELLABLE_SEARCHES = 256
+
+# Identifies a search to the pool's workers, so they can check whether it has been cancelled: a slot in the pool's
+# shared array of cancelled searches, and the search's ID (since slots are re-used once a search is done with them.)
+SearchToken = namedtuple("SearchToken", ("slot", "search_id"))
+
+# Reference to a table in the worker table registry; sent to workers instead of pickling the whole table for each task.
+TableRef = namedtuple("TableRef", ("table_id", "generation", "search"), defaults=(None,))
+
+# Worker-side state, filled in by the pool initializer:
+#  - tables: registry of tables, keyed by table ID, with the generation of each table at the time it was registered.
+#    When workers are forked, the tables are inherited rather than pickled.
+#  - cancelled: IDs of cancelled searches, by slot, in shared memory so that the request process can set them while
+#    workers are in the middle of a task.
+# Kept per thread, since with a single worker the pool's workers are threads in the request process, and a pool which
+# has been replaced may still be finishing searches with older generations of the tables.
+_worker_state = threading.local()
+
+
+def _init_worker(tables: Dict[str, Tuple[int, Any]], cancelled: Any):
+    _worker_state.tables = tables
+    _worker_state.cancelled = cancelled
+
+
+def get_worker_table(table_ref: TableRef) -> Any:
+    tables: Dict[str, Tuple[int, Any]] = getattr(_worker_state, "tables", {})
+    generation, table = tables.get(table_ref.table_id, (None, None))
+    if generation != table_ref.generation:  # pragma: no cover
+        # acquire_pool should have replaced the pool with an up-to-date registry if anything changed
+        raise LookupError(f"Worker has generation {generation} of table {table_ref.table_id}; "
+                          f"needed {table_ref.generation}")
+    return table
+
+
+def worker_cancelled(search: Optional[SearchToken]) -> bool:
+    """
+    Checks whether the search a worker's task belongs to has been cancelled, in which case whatever the worker is doing
+    can be stopped. Cheap enough to be checked often.
+    """
+    cancelled = getattr(_worker_state, "cancelled", None)
+    return cancelled is not None and search is not None and cancelled[search.slot] == search.search_id
+
+
+def snapshot_tables(tables: Iterable[Any]) -> Dict[str, Tuple[int, Any]]:
+    """
+    Reads the generation of each of the tables once, for a registry of tables by ID to pass to acquire_pool. Tables can
+    be updated (e.g. by a background index build) while they're being searched, so the registry and the table
+    references sent to workers should both come from the same snapshot.
+    """
+    return {t.table_id: (t.generation, t) for t in tables}
+
+
+class _SharedPool:
+    def __init__(self, tables: Dict[str, Tuple[int, Any]]):
+        self.generations = {table_id: generation for table_id, (generation, _) in tables.items()}
+        self.cancelled = multiprocessing.RawArray("Q", MAX_CANCELLABLE_SEARCHES)
+        self.free_slots = list(range(MAX_CANCELLABLE_SEARCHES))
+        self.pool = Pool(processes=WORKERS, initializer=_init_worker, initargs=(dict(tables), self.cancelled))
+        self.n_leases = 0
+        self.retired = False
+        self.broken = False
+
+    def has_tables(self, tables: Dict[str, Tuple[int, Any]], table_ids: Iterable[str]) -> bool:
+        return all(self.generations.get(table_id) == tables[table_id][0] for table_id in table_ids)
+
+    def retire(self):
+        # Searches still using the pool get to finish; the workers are stopped once they're done.
+        self.retired = True
+        if self.n_leases == 0:
+            if self.broken:
+                self.pool.terminate()
+            else:
+                self.pool.close()
+
+
+_pool_lock = threading.Lock()
+_shared_pool: Optional[_SharedPool] = None
+_last_search_id = 0
+
+
+class PoolLease:
+    """
+    A search's use of the shared worker pool, from acquire_pool. Must be released once the search is done with the
+    pool, whether it finished or not.
+    """
+
+    def __init__(self, shared_pool: _SharedPool, search: Optional[SearchToken]):
+        self._shared_pool = shared_pool
+        self._search = search
+        self._released = False
+
+    @property
+    def pool(self):
+        return self._shared_pool.pool
+
+    @property
+    def search(self) -> Optional[SearchToken]:
+        return self._search
+
+    def table_ref(self, table_id: str) -> TableRef:
+        return TableRef(table_id, self._shared_pool.generations[table_id], self.search)
+
+    def cancel(self):
+        """
+        Cancels whatever the pool's workers are doing for this search, without affecting any other search. Workers which
+        check worker_cancelled stop their current task for the search early.
+        """
+        if self._search is not None:
+            self._shared_pool.cancelled[self._search.slot] = self._search.search_id
+
+    def release(self, broken: bool = False):
+        """
+        Releases the search's use of the pool. If broken is set (e.g. a worker got stuck somewhere it couldn't check
+        its deadline), the pool is replaced for later searches and its workers are stopped once nothing is using it.
+        """
+
+        global _shared_pool
+
+        with _pool_lock:
+            if self._released:
+                return
+            self._released = True
+
+            shared_pool = self._shared_pool
+            shared_pool.n_leases -= 1
+            if self._search is not None:
+                shared_pool.free_slots.append(self._search.slot)
+
+            if broken:
+                shared_pool.broken = True
+                if _shared_pool is shared_pool:
+                    _shared_pool = None
+                shared_pool.retire()
+            elif shared_pool.retired:
+                shared_pool.retire()
+
+
+def acquire_pool(tables: Dict[str, Tuple[int, Any]], table_ids: Iterable[str]) -> PoolLease:
+    """
+    Gets a lease on the worker pool shared by all searches in the process, to search the tables with the specified IDs.
+    The pool's workers are given a registry of tables (see snapshot_tables) when the pool is created, which they can
+    get at through get_worker_table; the pool is kept around as long as the tables being searched haven't changed.
+    Otherwise, it's replaced by one registering all the tables passed, and the old one is stopped once the searches
+    still using it are done.
+    """
+
+    global _last_search_id, _shared_pool
+
+    with _pool_lock:
+        if _shared_pool is None or not _shared_pool.has_tables(tables, table_ids):
+            if _shared_pool is not None:
+                _shared_pool.retire()
+            _shared_pool = _SharedPool(tables)
+
+        _shared_pool.n_leases += 1
+
+        search = None
+        if _shared_pool.free_slots:
+            _last_search_id += 1
+            search = SearchToken(_shared_pool.free_slots.pop(), _last_search_id)
+
+        return PoolLease(_shared_pool, search)
+
 
-    return g.pool
+def shutdown_pool():
+    """
+    Stops the shared worker pool's workers once any searches still using it are done, so that the next search starts a
+    fresh one.
+    """
 
+    global _shared_pool
 
-def teardown_pool(err):
-    if err is not None:  # pragma: no cover
-        print(err)
-    pool = g.pop("pool", None)
-    if pool is not None:
-        pool.close()
+    with _pool_lock:
+        if _shared_pool is not None:
+            _shared_pool.retire()
+            _shared_pool = None
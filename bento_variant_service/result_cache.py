@@ -0,0 +1,127 @@
+import os
+import threading
+
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional, Set, Tuple
+
+from bento_variant_service.metrics import increment_counter, set_gauge
+
+
+__all__ = [
+    "SEARCH_CACHE_MAX_BYTES",
+    "ResultCache",
+]
+
+
+try:  # pragma: no cover
+    # Upper bound on the total size of the search results cached by each table manager; 0 turns caching off.
+    SEARCH_CACHE_MAX_BYTES = int(os.environ.get("SEARCH_CACHE_MAX_BYTES", ""))
+except ValueError:  # pragma: no cover
+    SEARCH_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+class ResultCache:
+    """
+    Least-recently-used cache bounded by the total size of the values in it (as given when each value is added) rather
+    than by the number of entries. Each entry also records the tables it was computed from, so that entries can be
+    evicted when one of those tables changes. Hits, misses, evictions (to make room) and invalidations (from tables
+    changing) are counted in the metrics under the cache's name.
+    """
+
+    def __init__(self, name: str, max_bytes: int):
+        self.name = name
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, Tuple[Any, int, Tuple[str, ...]]] = OrderedDict()
+        self._table_keys: Dict[str, Set[Hashable]] = {}
+        self._n_bytes = 0
+
+    @property
+    def n_bytes(self) -> int:
+        return self._n_bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, key: Hashable):
+        # Must be called with the lock held
+        _, size, table_ids = self._entries.pop(key)
+        self._n_bytes -= size
+
+        for table_id in table_ids:
+            keys = self._table_keys.get(table_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._table_keys[table_id]
+
+    def _update_gauges(self):
+        set_gauge(f"{self.name}_bytes", self._n_bytes)
+        set_gauge(f"{self.name}_entries", len(self._entries))
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Gets the value cached for a key, marking it as recently used, or None if nothing is cached for the key.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        increment_counter(f"{self.name}_hits" if entry is not None else f"{self.name}_misses")
+        return entry[0] if entry is not None else None
+
+    def put(self, key: Hashable, value: Any, size: int, table_ids: Iterable[str]):
+        """
+        Caches a value, evicting the least recently used entries until the cache is back under its size limit. Values
+        which are bigger than the whole cache are not cached.
+        """
+
+        if self.max_bytes <= 0 or size > self.max_bytes:
+            return
+
+        table_ids = tuple(table_ids)
+        n_evicted = 0
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (value, size, table_ids)
+            self._n_bytes += size
+            for table_id in table_ids:
+                self._table_keys.setdefault(table_id, set()).add(key)
+
+            while self._n_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                n_evicted += 1
+
+            self._update_gauges()
+
+        if n_evicted:
+            increment_counter(f"{self.name}_evictions", n_evicted)
+
+    def invalidate_table(self, table_id: str):
+        """
+        Evicts every entry computed from the specified table, e.g. because the table was changed or deleted.
+        """
+
+        with self._lock:
+            keys = tuple(self._table_keys.get(table_id, ()))
+            if not keys:
+                return
+
+            for key in keys:
+                self._remove(key)
+            self._update_gauges()
+
+        increment_counter(f"{self.name}_invalidations", len(keys))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._table_keys.clear()
+            self._n_bytes = 0
+            self._update_gauges()
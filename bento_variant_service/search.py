@@ -1,8 +1,12 @@
 import json
+import multiprocessing
+import operator
 import re
 import sys
+import time
 import traceback
 
+from collections import Counter, namedtuple
 from bento_lib.responses import flask_errors
 from bento_lib.search.data_structure import check_ast_against_data_structure
 from bento_lib.search.queries import (
@@ -14,6 +18,9 @@ from bento_lib.search.queries import (
     Expression,
     Literal,
 
+    FUNCTION_AND,
+    FUNCTION_OR,
+    FUNCTION_NOT,
     FUNCTION_EQ,
     FUNCTION_LT,
     FUNCTION_LE,
@@ -22,14 +29,38 @@ from bento_lib.search.queries import (
     FUNCTION_RESOLVE
 )
 from datetime import datetime
-from flask import Blueprint, jsonify, request
-from typing import Any, Callable, List, Iterable, Optional, Tuple
+from functools import partial, reduce
+from flask import Blueprint, current_app, jsonify, request, stream_with_context
+from typing import (
+    Any, Callable, Dict, FrozenSet, Hashable, List, Iterable, Iterator, Optional, Sequence, Tuple, Union
+)
 from werkzeug import Response
 
+from bento_variant_service.coalescing import SingleFlight
 from bento_variant_service.constants import SERVICE_NAME
-from bento_variant_service.pool import get_pool, teardown_pool
+from bento_variant_service.metrics import increment_counter, set_gauge
+from bento_variant_service.pool import (
+    INLINE_SEARCH_MAX_WORK,
+    TableRef,
+    acquire_pool,
+    get_worker_table,
+    snapshot_tables,
+    worker_cancelled,
+)
+from bento_variant_service.result_cache import ResultCache
 from bento_variant_service.tables.base import VariantTable, TableManager
+from bento_variant_service.variants import genotypes as gt
+from bento_variant_service.variants.models import FULL_PROJECTION, Projection, Variant, parse_projection
 from bento_variant_service.table_manager import get_table_manager
+from bento_variant_service.variants.regions import (
+    Region,
+    RegionSet,
+    WHOLE_GENOME,
+    intersect_regions,
+    intersect_region_sets,
+    normalize_regions,
+    union_region_sets,
+)
 from bento_variant_service.variants.schemas import VARIANT_SCHEMA
 
 
@@ -38,51 +69,147 @@ BASE_REGEX = re.compile(r"([acgtnACGTN]+|\.|<[^\s;]+>)")
 
 CHORD_SEARCH_TIMEOUT = 180
 
+# Share of a search's timeout that workers get to search tables in; the rest is left for them to send back whatever they
+# found before the deadline.
+WORKER_DEADLINE_FRACTION = 0.9
+
+CALLS_FIELD = Literal("calls")
+CALL_SAMPLE_ID_FIELD = (CALLS_FIELD, Literal("[item]"), Literal("sample_id"))
+CALL_GENOTYPE_TYPE_FIELD = (CALLS_FIELD, Literal("[item]"), Literal("genotype_type"))
+
+
+# Matches are sent back from search workers as an already-encoded JSON array, alongside the number of matches in it
+EncodedMatches = namedtuple("EncodedMatches", ("n_matches", "data"))
+EMPTY_ENCODED_MATCHES = EncodedMatches(0, b"[]")
+
+# Fields aggregate searches can tally matches by: variant fields count matching variants, call fields count the calls
+# of matching variants (as they would be returned by a private search.)
+AGGREGATE_VARIANT_FIELDS = ("assembly_id", "chromosome")
+AGGREGATE_CALL_FIELDS = ("genotype_type",)
+AGGREGATE_FIELDS = (*AGGREGATE_VARIANT_FIELDS, *AGGREGATE_CALL_FIELDS)
+
+# Samples to return calls for: either a set of sample IDs, or the name of a sample set in each table's metadata
+CallSamples = Union[FrozenSet[str], str]
+
+# What search workers send back for each table: whether anything matched, the worker's results for the table (encoded
+# matches, counts, or nothing for Beacon searches), whether the table's deadline passed before it was fully searched,
+# and whether the search was cancelled before then. In either of the last two cases, the results only cover what was
+# found up to that point.
+TableResult = namedtuple("TableResult", ("table_id", "found", "data", "timed_out", "cancelled"), defaults=(False,))
+
+# Aggregate search results for a table: the number of matching variants, and for each group-by field, a dictionary of
+# counts by value
+VariantCounts = namedtuple("VariantCounts", ("n_matches", "groups"))
+
+# Identical searches which come in while one is already running share its execution and results, e.g. when the same
+# dashboard is open in a bunch of tabs.
+_search_flights = SingleFlight("searches", timeout=CHORD_SEARCH_TIMEOUT)
+
+
+class InvalidQueryError(ValueError):
+    """
+    Raised by chord_search for queries which can't be searched with, e.g. because a position in them isn't an integer.
+    """
+    pass
+
+
+class _DeadlineExceeded(Exception):
+    pass
+
+
+class _SearchCancelled(Exception):
+    pass
+
 
 def _err(response_callable, message: str):
     print(f"[{SERVICE_NAME}] [ERROR] {message}", file=sys.stderr)
     return response_callable(message)
 
 
-def search_worker_prime(
+def _resolve_table(table: Union[VariantTable, TableRef]) -> VariantTable:
+    # Inline searches get passed tables directly; searches in the pool get references to the worker's copy of a table.
+    return get_worker_table(table) if isinstance(table, TableRef) else table
+
+
+def _cancellation_check(table: Union[VariantTable, TableRef]) -> Optional[Callable[[], bool]]:
+    # Only searches in the pool can be cancelled from elsewhere; inline searches just stop being iterated.
+    return partial(worker_cancelled, table.search) if isinstance(table, TableRef) else None
+
+
+def resolve_call_samples(table: VariantTable, call_samples: Optional[CallSamples]) -> Optional[FrozenSet[str]]:
+    # Tables without a sample set by the specified name don't have any of its samples
+    if isinstance(call_samples, str):
+        return table.sample_set(call_samples) or frozenset()
+    return call_samples
+
+
+def _search_matches(
     table: VariantTable,
-    chromosome: Optional[str],
-    start_min: Optional[int],
-    start_max: Optional[int],
+    regions: RegionSet,
     rest_of_query: Optional[AST],
-    internal_data: bool,
+    include_calls: bool,
     assembly_id: Optional[str],
-) -> Tuple[Optional[VariantTable], List[dict]]:
-    found = False
-    matches = []
-
-    possible_matches = table.variants(assembly_id, chromosome, start_min, start_max)
-
-    checked_schema = False
+    sample_ids: Optional[FrozenSet[str]],
+    only_interesting: bool,
+    call_sample_ids: Optional[FrozenSet[str]] = None,
+    deadline: Optional[float] = None,
+    cancelled: Optional[Callable[[], bool]] = None,
+) -> Iterator[Tuple[Variant, Optional[dict]]]:
+    # Yields each matching variant, along with its augmented representation if one had to be built to check the query.
+    # Without calls, variants don't match the schema, so schema validation has to be skipped as well.
+    # Raises _DeadlineExceeded if the deadline (a time.time() value) passes before the table has been fully searched,
+    # and _SearchCancelled if the search is cancelled before then.
+
+    if query_resolves_field(rest_of_query, CALLS_FIELD):
+        # The query needs to be checked against every call, so calls can only be left out afterwards
+        call_sample_ids = None
+
+    # Why the search was stopped early, if it was
+    stopped_by: Optional[type] = None
+
+    def should_stop() -> bool:
+        nonlocal stopped_by
+        if deadline is not None and time.time() >= deadline:
+            stopped_by = _DeadlineExceeded
+        elif cancelled is not None and cancelled():
+            stopped_by = _SearchCancelled
+        return stopped_by is not None
+
+    # The table checks should_stop for each row it reads, since it may go through lots of rows between matches
+    possible_matches = table.variants_in_regions(
+        assembly_id, regions, interesting_rows=only_interesting, sample_ids=sample_ids,
+        call_sample_ids=call_sample_ids, should_stop=should_stop)
+
+    checked_schema = not include_calls
 
     while True:
+        if should_stop():
+            raise stopped_by()
+
         try:
             variant = next(possible_matches)
 
+            if rest_of_query is None:
+                yield variant, None
+                continue
+
             # Schema controls whether these augmented fields will be queryable or not.
             # Cache this value to avoid having to compute it for check_ast... and append at end.
-            v = variant.as_augmented_chord_representation()
+            v = variant.as_augmented_chord_representation(include_calls=include_calls)
 
-            match = rest_of_query is None or check_ast_against_data_structure(
+            match = check_ast_against_data_structure(
                 rest_of_query, v, VARIANT_SCHEMA, secure_errors=False, skip_schema_validation=checked_schema)
-            found = found or match
-
-            if not internal_data and found:
-                break
 
             # Avoid re-checking the schema over and over, since it's exceedingly slow
             # Check it once to make sure someone hasn't screwed up somewhere
             checked_schema = True
 
-            if match:  # implicitly internal_data is True here as well
-                matches.append(v)
+            if match:
+                yield variant, v
 
         except StopIteration:
+            if stopped_by is not None:
+                raise stopped_by()
             break
 
         except ValueError as e:  # pragma: no cover
@@ -93,51 +220,453 @@ def search_worker_prime(
             traceback.print_exc()
             break
 
-    return (table if found else None), matches
+
+def search_worker_prime(
+    table: Union[VariantTable, TableRef],
+    regions: RegionSet,
+    rest_of_query: Optional[AST],
+    internal_data: bool,
+    assembly_id: Optional[str],
+    sample_ids: Optional[FrozenSet[str]] = None,
+    only_interesting: bool = False,
+    projection: Optional[Projection] = None,
+    call_samples: Optional[CallSamples] = None,
+    deadline: Optional[float] = None,
+) -> TableResult:
+    cancelled = _cancellation_check(table)
+    table = _resolve_table(table)
+
+    found = False
+    timed_out = False
+    search_cancelled = False
+    matches: List[bytes] = []
+
+    call_sample_ids = resolve_call_samples(table, call_samples)
+    if call_sample_ids is not None:
+        projection = (projection or FULL_PROJECTION)._replace(sample_ids=call_sample_ids)
+
+    # If calls aren't going to be returned or checked, don't build them at all.
+    return_calls = internal_data and (projection is None or "calls" in projection.variant_fields)
+    include_calls = return_calls or query_resolves_field(rest_of_query, CALLS_FIELD)
+
+    try:
+        for variant, v in _search_matches(
+                table, regions, rest_of_query, include_calls, assembly_id, sample_ids, only_interesting,
+                call_sample_ids if return_calls else None, deadline, cancelled):
+            found = True
+
+            if not internal_data:
+                break
+
+            # Encode matches here rather than in the request process, which would otherwise have to unpickle every
+            # match and then serialize it again for the response.
+            # Matches are checked against the full representation, but only the projected fields are sent back.
+            if v is None or projection is not None:
+                v = variant.as_augmented_chord_representation(include_calls=return_calls, projection=projection)
+            matches.append(json.dumps(v, separators=(",", ":")).encode("utf-8"))
+
+    except _DeadlineExceeded:
+        # Send back the matches found so far instead of nothing
+        timed_out = True
+
+    except _SearchCancelled:
+        # Nobody is waiting on the results anymore, but they still mustn't pass for complete ones
+        search_cancelled = True
+
+    # Only send back the table ID, rather than pickling the whole table again
+    return TableResult(
+        table.table_id, found, EncodedMatches(len(matches), b"[" + b",".join(matches) + b"]"), timed_out,
+        search_cancelled)
 
 
 def search_worker(args):
     return search_worker_prime(*args)
 
 
-def generic_variant_search(
-    table_manager: TableManager,
+def aggregate_search_worker_prime(
+    table: Union[VariantTable, TableRef],
+    regions: RegionSet,
+    rest_of_query: Optional[AST],
+    assembly_id: Optional[str],
+    sample_ids: Optional[FrozenSet[str]],
+    only_interesting: bool,
+    group_by: Tuple[str, ...],
+    deadline: Optional[float] = None,
+) -> TableResult:
+    cancelled = _cancellation_check(table)
+    table = _resolve_table(table)
+
+    n_matches = 0
+    timed_out = False
+    search_cancelled = False
+    groups: Dict[str, Counter] = {field: Counter() for field in group_by}
+    variant_fields = tuple(f for f in group_by if f in AGGREGATE_VARIANT_FIELDS)
+    count_genotype_types = "genotype_type" in groups
+
+    # Only build calls if they need to be checked or counted; nothing gets encoded either way
+    include_calls = count_genotype_types or query_resolves_field(rest_of_query, CALLS_FIELD)
+
+    try:
+        for variant, _ in _search_matches(
+                table, regions, rest_of_query, include_calls, assembly_id, sample_ids, only_interesting,
+                deadline=deadline, cancelled=cancelled):
+            n_matches += 1
+
+            for field in variant_fields:
+                groups[field][getattr(variant, field)] += 1
+
+            if count_genotype_types:
+                groups["genotype_type"].update(c.genotype_type for c in variant.calls)
+
+    except _DeadlineExceeded:
+        timed_out = True
+
+    except _SearchCancelled:
+        search_cancelled = True
+
+    return TableResult(
+        table.table_id, n_matches > 0, VariantCounts(n_matches, {f: dict(c) for f, c in groups.items()}), timed_out,
+        search_cancelled)
+
+
+def aggregate_search_worker(args):
+    return aggregate_search_worker_prime(*args)
+
+
+def beacon_search_worker_prime(
+    table: Union[VariantTable, TableRef],
+    assembly_id: Optional[str],
     chromosome: Optional[str],
     start_min: Optional[int],
     start_max: Optional[int],
+    end_min: Optional[int],
+    end_max: Optional[int],
+    ref: str,
+    alt: str,
+    deadline: Optional[float] = None,
+) -> TableResult:
+    cancelled = _cancellation_check(table)
+    table = _resolve_table(table)
+
+    # Beacon matches are a single lookup, so they can only be skipped if they haven't been started yet (e.g. when
+    # queued up behind slower tables.)
+    if deadline is not None and time.time() >= deadline:
+        return TableResult(table.table_id, False, None, True)
+    if cancelled is not None and cancelled():
+        return TableResult(table.table_id, False, None, False, True)
+
+    return TableResult(
+        table.table_id,
+        table.beacon_match(assembly_id, chromosome, start_min, start_max, end_min, end_max, ref, alt),
+        None,
+        False)
+
+
+def beacon_search_worker(args):
+    return beacon_search_worker_prime(*args)
+
+
+def _search_tables(
+    table_manager: TableManager,
+    regions: RegionSet,
+    assembly_id: Optional[str] = None,
+    dataset_ids: Optional[List[str]] = None,
+) -> Tuple[VariantTable, ...]:
+    # Set of dataset IDs to include. If none, all dataset IDs are included!
+    ds = set(dataset_ids) if dataset_ids is not None else None
+
+    tables = tuple(
+        table for table in table_manager.route_tables(assembly_id, regions)
+        if (ds is None or table.table_id in ds) and (assembly_id is None or assembly_id in table.assembly_ids)
+    )
+
+    # Drop tables which cannot have anything in the regions searched before anything gets sent to a worker
+    overlapping_tables = tuple(table for table in tables if table.may_overlap(assembly_id, regions))
+    increment_counter("search_tables_pruned", len(tables) - len(overlapping_tables))
+
+    return overlapping_tables
+
+
+def _search_work(tables: Sequence[VariantTable], assembly_id: Optional[str], regions: RegionSet) -> int:
+    # Each table dispatched costs at least a bit of work, even if it's empty or nothing overlaps the region.
+    return sum(
+        max(sum(t.estimate_search_work(assembly_id, *region) for region in regions), 1)
+        for t in tables
+    )
+
+
+def plan_inline_search(tables: Sequence[VariantTable], assembly_id: Optional[str], regions: RegionSet) -> bool:
+    """
+    Decides whether a search over the specified tables is small enough to be run in the request process. Sending a
+    search to the pool means pickling each table to a worker and pickling all the results back, which for point queries
+    against one or two tables is most of the time spent.
+    """
+
+    work = _search_work(tables, assembly_id, regions)
+    inline = work <= INLINE_SEARCH_MAX_WORK
+
+    set_gauge("search_inline_max_work", INLINE_SEARCH_MAX_WORK)
+    set_gauge("search_last_estimated_work", work)
+    increment_counter("searches_inline" if inline else "searches_pooled")
+
+    return inline
+
+
+def _dispatch_search(
+    worker: Callable,
+    table_manager: TableManager,
+    tables: Sequence[VariantTable],
+    task_args: tuple,
+    timeout: int,
+    inline: bool = False,
+    timed_out_tables: Optional[List[str]] = None,
+) -> Iterable[TableResult]:
+    """
+    Runs a search worker on each table, yielding the results as they come in. Workers get a deadline to search each
+    table by, after which they send back what they have found so far; the IDs of tables which timed out, or which were
+    only partly searched before the search was cancelled, are added to timed_out_tables, if it's specified.
+    """
+
+    for result in _run_search_tasks(worker, table_manager, tables, task_args, timeout, inline):
+        if result.timed_out:
+            increment_counter("search_tables_timed_out")
+        if result.cancelled:
+            increment_counter("search_tables_cancelled")
+        if (result.timed_out or result.cancelled) and timed_out_tables is not None:
+            timed_out_tables.append(result.table_id)
+        yield result
+
+
+def _run_search_tasks(
+    worker: Callable,
+    table_manager: TableManager,
+    tables: Sequence[VariantTable],
+    task_args: tuple,
+    timeout: int,
+    inline: bool,
+) -> Iterable[TableResult]:
+    start_time = datetime.now()
+    deadline = time.time() + timeout * WORKER_DEADLINE_FRACTION
+
+    if inline:
+        yield from map(worker, ((table, *task_args, deadline) for table in tables))
+        return
+
+    # Workers are given the manager's tables when the pool is created, so only table references need to be sent over
+    # for each task instead of the pickled tables (which include e.g. the full list of sample IDs for each file.) The
+    # pool is shared by every search until one of the tables searched changes; the pool's registry and the references
+    # come from the same snapshot of the tables' generations, so that tables which are updated partway through the
+    # search still match up.
+    registry = snapshot_tables((*table_manager.tables.values(), *tables))
+    lease = acquire_pool(registry, (table.table_id for table in tables))
+    refs = [lease.table_ref(table.table_id) for table in tables]
+
+    outstanding = {table.table_id: None for table in tables}  # Ordered, so timeouts get reported in table order
+    finished = False
+    broken = False
+
+    try:
+        search_job = lease.pool.imap_unordered(worker, ((ref, *task_args, deadline) for ref in refs))
+
+        while True:
+            try:
+                result = search_job.next(timeout=max(timeout - (datetime.now() - start_time).total_seconds(), 1))
+            except StopIteration:
+                finished = True
+                break
+            except multiprocessing.TimeoutError:
+                # Some worker is stuck somewhere it can't check its deadline (e.g. waiting on a file), so give up on
+                # the pool instead of waiting on it any longer; the next search will get a fresh one.
+                print(f"[{SERVICE_NAME}] [ERROR] Search timed out waiting on {len(outstanding)} table(s)",
+                      file=sys.stderr, flush=True)
+                finished = True
+                broken = True
+                lease.cancel()
+                yield from (TableResult(table_id, False, None, True) for table_id in outstanding)
+                break
+
+            outstanding.pop(result.table_id, None)
+            yield result
+
+    finally:
+        if not finished:
+            # Whatever wanted the results has gone away before they were all in, e.g. because the generator of a
+            # streaming response was closed when the client disconnected. Stop the workers from scanning tables for
+            # nothing, rather than leaving them to hold up the next searches.
+            print(f"[{SERVICE_NAME}] [DEBUG] Cancelling search with {len(outstanding)} table(s) left", flush=True)
+            increment_counter("searches_cancelled")
+            lease.cancel()
+        lease.release(broken)
+
+
+def generic_variant_search(
+    table_manager: TableManager,
+    regions: RegionSet,
     rest_of_query: Optional[AST] = None,
     internal_data=False,
     assembly_id: Optional[str] = None,
     dataset_ids: Optional[List[str]] = None,
     timeout: int = CHORD_SEARCH_TIMEOUT,
-) -> Iterable[Tuple[VariantTable, List[dict]]]:
+    sample_ids: Optional[FrozenSet[str]] = None,
+    only_interesting: bool = False,
+    projection: Optional[Projection] = None,
+    call_samples: Optional[CallSamples] = None,
+    timed_out_tables: Optional[List[str]] = None,
+) -> Iterable[Tuple[VariantTable, EncodedMatches]]:
     # TODO: Sane defaults
     # TODO: Figure out inclusion/exclusion with start_min/end_max
 
-    # Set of dataset IDs to include. If none, all dataset IDs are included!
-    ds = set(dataset_ids) if dataset_ids is not None else None
-
-    pool = get_pool()
+    tables = _search_tables(table_manager, regions, assembly_id, dataset_ids)
+    tables_by_id = {table.table_id: table for table in tables}
 
-    # with get_pool() as pool:
-    start_time = datetime.now()
-    search_job = pool.imap_unordered(
+    search_results = _dispatch_search(
         search_worker,
-        ((dataset, chromosome, start_min, start_max, rest_of_query, internal_data, assembly_id)
-         for dataset in table_manager.tables.values()
-         if (ds is None or dataset.table_id in ds) and (assembly_id is None or assembly_id in dataset.assembly_ids))
-    )
+        table_manager,
+        tables,
+        (regions, rest_of_query, internal_data, assembly_id, sample_ids, only_interesting, projection, call_samples),
+        timeout,
+        inline=plan_inline_search(tables, assembly_id, regions),
+        timed_out_tables=timed_out_tables)
 
-    # TODO: Bespoke timeout error handling
-    while True:
-        try:
-            d, m = search_job.next(timeout=max(timeout - (datetime.now() - start_time).total_seconds(), 1))
-            if len(m) > 0 or (not internal_data and d is not None):
-                yield d, m
-        except StopIteration:
-            teardown_pool(None)
-            pool.join()
-            break
+    for r in search_results:
+        # Tables the pool gave up on don't have any matches to send back
+        if r.data is not None and (r.data.n_matches > 0 or (not internal_data and r.found)):
+            yield tables_by_id[r.table_id], r.data
+
+
+def _index_variant_counts(counts: Dict[Tuple[str, str], int], group_by: Tuple[str, ...]) -> VariantCounts:
+    # Turns counts by (assembly ID, chromosome) from a table's indices into the same form as aggregate worker results
+    groups: Dict[str, Counter] = {field: Counter() for field in group_by}
+
+    for (assembly_id, chromosome), n in counts.items():
+        if n == 0:
+            continue
+        for field, value in (("assembly_id", assembly_id), ("chromosome", chromosome)):
+            if field in groups:
+                groups[field][value] += n
+
+    return VariantCounts(sum(counts.values()), {f: dict(c) for f, c in groups.items()})
+
+
+def generic_aggregate_search(
+    table_manager: TableManager,
+    regions: RegionSet,
+    group_by: Tuple[str, ...],
+    rest_of_query: Optional[AST] = None,
+    assembly_id: Optional[str] = None,
+    dataset_ids: Optional[List[str]] = None,
+    timeout: int = CHORD_SEARCH_TIMEOUT,
+    sample_ids: Optional[FrozenSet[str]] = None,
+    only_interesting: bool = False,
+    timed_out_tables: Optional[List[str]] = None,
+) -> Iterable[Tuple[VariantTable, VariantCounts]]:
+    """
+    Counts the variants matching a search in each table with at least one match, tallied by the group-by fields. Counts
+    are computed where the search runs, so no matches are built or sent back. If the query is just a set of regions
+    and no calls need to be counted, tables which can are asked for counts from their indices instead.
+    """
+
+    tables = _search_tables(table_manager, regions, assembly_id, dataset_ids)
+    tables_by_id = {table.table_id: table for table in tables}
+
+    tables_to_search = tables
+    if (rest_of_query is None and sample_ids is None and not only_interesting and
+            not any(f in AGGREGATE_CALL_FIELDS for f in group_by)):
+        tables_to_search = []
+
+        for table in tables:
+            counts = table.count_variants_in_regions(assembly_id, regions)
+            if counts is None:
+                tables_to_search.append(table)
+                continue
+
+            increment_counter("search_tables_counted_from_index")
+            variant_counts = _index_variant_counts(counts, group_by)
+            if variant_counts.n_matches > 0:
+                yield table, variant_counts
+
+    if not tables_to_search:
+        return
+
+    search_results = _dispatch_search(
+        aggregate_search_worker,
+        table_manager,
+        tables_to_search,
+        (regions, rest_of_query, assembly_id, sample_ids, only_interesting, group_by),
+        timeout,
+        inline=plan_inline_search(tables_to_search, assembly_id, regions),
+        timed_out_tables=timed_out_tables)
+
+    for r in search_results:
+        if r.found:
+            yield tables_by_id[r.table_id], r.data
+
+
+def beacon_variant_search(
+    table_manager: TableManager,
+    assembly_id: str,
+    chromosome: str,
+    start_min: Optional[int],
+    start_max: Optional[int],
+    end_min: Optional[int],
+    end_max: Optional[int],
+    ref: str,
+    alt: str,
+    dataset_ids: Optional[List[str]] = None,
+    timeout: int = CHORD_SEARCH_TIMEOUT,
+    timed_out_tables: Optional[List[str]] = None,
+) -> Iterable[VariantTable]:
+    """
+    Dedicated search path for Beacon allele requests, which only need to know whether a sample in a table carries a
+    particular allele. This avoids building and checking a generic query AST against every call in every variant.
+    """
+
+    # End positions are start positions plus the length of the reference allele, so (inclusive) end bounds can be
+    # turned into start bounds. If these contradict the start bounds, nothing can match.
+    region = intersect_regions(Region(chromosome, start_min, start_max), Region(
+        chromosome,
+        end_min - len(ref) if end_min is not None else None,
+        end_max - len(ref) + 1 if end_max is not None else None,
+    ))
+
+    if region is None:
+        increment_counter("searches_empty")
+        return iter(())
+
+    _, start_min, start_max = region
+
+    tables = _search_tables(table_manager, (region,), assembly_id, dataset_ids)
+    tables_by_id = {table.table_id: table for table in tables}
+
+    search_results = _dispatch_search(
+        beacon_search_worker,
+        table_manager,
+        tables,
+        (assembly_id, chromosome, start_min, start_max, end_min, end_max, ref, alt),
+        timeout,
+        inline=plan_inline_search(tables, assembly_id, (region,)),
+        timed_out_tables=timed_out_tables)
+
+    return (tables_by_id[r.table_id] for r in search_results if r.found)
+
+
+def table_generations(table_manager: TableManager) -> Tuple[Tuple[str, int], ...]:
+    """
+    Identifies the current state of a table manager's tables, for keying searches; changes whenever a table does.
+    """
+    return tuple(sorted((table_id, t.generation) for table_id, t in table_manager.tables.items()))
+
+
+def ast_key(query: Optional[AST]) -> Hashable:
+    """
+    Hashable form of a query AST, for keying searches. Literals keep their type, since e.g. 1 and "1" don't match the
+    same things.
+    """
+
+    if query is None or isinstance(query, Literal):
+        return query if query is None else (type(query.value).__name__, query.value)
+
+    return (query.fn, *(ast_key(a) for a in query.args))
 
 
 def query_key_op_value(query_item: AST, field: str, op: str) -> Optional[Literal]:
@@ -155,117 +684,490 @@ def query_key_op_value(query_item: AST, field: str, op: str) -> Optional[Literal
     return None
 
 
-def query_key_op_value_or_pass(query_item: AST, field: str, value: Optional[Literal], state_changed: bool, op: str,
-                               transform: Callable = lambda x: x) -> Tuple[Optional[Any], bool]:
-    if value is None:  # No value has been parsed from the query yet
-        value = query_key_op_value(query_item, field, op)  # May yield a value
-        if value is not None:  # New value derived from query_key_op_value call
-            value = transform(value)  # Transform the value to standardize it in the context of the query
-            return value, True  # Something got transformed, so return True for state_changed
+def _condition_region(query_item: AST) -> Optional[Region]:
+    # Region covering all variants which satisfy a single condition, if the condition constrains position at all.
+    # Raises a ValueError or TypeError if a position in the condition isn't an integer.
+
+    # Reminder: start_min is inclusive (start_min = X is the same as start >= X) and start_max is exclusive
+    #   (start_max = X is the same as start < X); variants are at least 1 nucleotide long, meaning that if end is
+    #   limited in some way we can sometimes derive a start_max.
+    extractors = (
+        # format: [#eq [#resolve chromosome] "1"]
+        ("chromosome", FUNCTION_EQ, lambda x: Region(x, None, None)),
+        ("start", FUNCTION_EQ, lambda x: Region(None, int(x), int(x) + 1)),  # start = X: X <= start < X + 1
+        ("start", FUNCTION_GE, lambda x: Region(None, int(x), None)),  # start >= X: start_min = X
+        ("start", FUNCTION_GT, lambda x: Region(None, int(x) + 1, None)),  # start > X: start_min = X + 1
+        ("start", FUNCTION_LE, lambda x: Region(None, None, int(x) + 1)),  # start <= X: start_max = X + 1
+        ("start", FUNCTION_LT, lambda x: Region(None, None, int(x))),  # start < X: start_max = X
+        ("end", FUNCTION_LE, lambda x: Region(None, None, int(x))),  # end <= X: start_max = X
+        ("end", FUNCTION_LT, lambda x: Region(None, None, int(x) - 1)),  # end < X: start_max = X - 1
+    )
+
+    for field, op, transform in extractors:
+        value = query_key_op_value(query_item, field, op)
+        if value is not None:
+            return transform(value)
+
+    return None
+
+
+FOLDABLE_COMPARISONS = {
+    FUNCTION_EQ: operator.eq,
+    FUNCTION_LT: operator.lt,
+    FUNCTION_LE: operator.le,
+    FUNCTION_GT: operator.gt,
+    FUNCTION_GE: operator.ge,
+}
 
-    return value, state_changed
 
+def fold_constants(query: AST) -> AST:
+    """
+    Simplifies parts of a query which do not depend on the data, e.g. comparisons between two literals, or #and / #or
+    expressions with a literal true or false argument. A query which folds down to a literal false can never match.
+    """
 
-def pipeline_value_extraction(query_item: AST, initial_value: Optional[Literal], initial_state_changed: bool,
-                              extractors: Tuple[Tuple[str, str, Callable], ...]) -> Tuple[Optional[Any], bool]:
-    field, op, transform = extractors[0]
-    v, s = query_key_op_value_or_pass(query_item, field, initial_value, initial_state_changed, op, transform)
-    for field, op, transform in extractors[1:]:
-        v, s = query_key_op_value_or_pass(query_item, field, v, s, op, transform)
-    return v, s
+    if not isinstance(query, Expression) or query.fn == FUNCTION_RESOLVE:
+        return query
 
+    args = tuple(map(fold_constants, query.args))
+    literals = tuple(a.value for a in args if isinstance(a, Literal))
 
-def parse_query_for_tabix(query: AST) -> Tuple[Optional[str], Optional[int], Optional[int], AST]:
-    query_items = ast_to_and_asts(query)
+    if query.fn in (FUNCTION_AND, FUNCTION_OR):
+        # Literal value which decides the whole expression: true for #or, false for #and
+        short_circuit = query.fn == FUNCTION_OR
+        if any(v is short_circuit for v in literals):
+            return Literal(short_circuit)
 
-    chromosome = None
-    start_min = None
-    start_max = None
+        remaining = tuple(a for a in args if not (isinstance(a, Literal) and isinstance(a.value, bool)))
+        if not remaining:
+            return Literal(not short_circuit)
+        if len(remaining) == 1:
+            return remaining[0]
+        return Expression(query.fn, remaining)
 
-    other_query_items = []
+    if query.fn == FUNCTION_NOT and literals and isinstance(literals[0], bool):
+        return Literal(not literals[0])
+
+    if query.fn in FOLDABLE_COMPARISONS and len(literals) == 2 and type(literals[0]) is type(literals[1]):
+        # Comparisons between different types are left for the search itself to report as errors
+        return Literal(FOLDABLE_COMPARISONS[query.fn](*literals))
+
+    return Expression(query.fn, args)
+
+
+def query_regions(query: AST) -> RegionSet:
+    """
+    Finds a normalized set of regions which covers every variant that could match the query, following #and and #or
+    sub-expressions. Anything which does not constrain position (including #not) is treated as covering the whole
+    genome, so the result may be larger than the set of matches but never smaller.
+    """
+
+    if isinstance(query, Expression):
+        if query.fn == FUNCTION_AND:
+            return reduce(intersect_region_sets, map(query_regions, query.args), (WHOLE_GENOME,))
+
+        if query.fn == FUNCTION_OR:
+            return reduce(union_region_sets, map(query_regions, query.args), ())
+
+        region = _condition_region(query)
+        if region is not None:
+            return normalize_regions((region,))
+
+    return (WHOLE_GENOME,)
 
-    for q in query_items:
-        # format: [#eq [#resolve chromosome] "1"]
 
-        state_changed = False
+def query_resolves_field(query: Optional[AST], field: Literal) -> bool:
+    # Whether any part of the query looks at the specified top-level field of the data structure
+    return isinstance(query, Expression) and (
+        (query.fn == FUNCTION_RESOLVE and len(query.args) > 0 and query.args[0] == field) or
+        any(query_resolves_field(a, field) for a in query.args)
+    )
+
+
+def _call_field_values(query_item: AST, field: Tuple[Literal, ...]) -> Optional[FrozenSet[str]]:
+    # Values for a [#eq [#resolve calls [item] <field>] "..."] condition, or an #or of them
+    if isinstance(query_item, Expression) and query_item.fn == FUNCTION_OR:
+        branches = tuple(_call_field_values(a, field) for a in query_item.args)
+        return None if any(b is None for b in branches) else frozenset().union(*branches)
+
+    if (isinstance(query_item, Expression) and
+            query_item.fn == FUNCTION_EQ and
+            isinstance(query_item.args[0], Expression) and
+            query_item.args[0].fn == FUNCTION_RESOLVE and
+            query_item.args[0].args == field and
+            isinstance(query_item.args[1], Literal) and
+            isinstance(query_item.args[1].value, str)):
+        return frozenset((query_item.args[1].value,))
+
+    return None
+
+
+def query_sample_ids(query: AST) -> Optional[FrozenSet[str]]:
+    """
+    Finds the set of samples which any matching variant must have a call for, if the query restricts this at the top
+    level. Since every [item] in a query refers to the same call, calls for other samples can't affect whether a
+    variant matches, and don't need to be parsed.
+    """
+
+    sample_ids = None
+
+    for q in ast_to_and_asts(query):
+        item_sample_ids = _call_field_values(q, CALL_SAMPLE_ID_FIELD)
+        if item_sample_ids is not None:
+            sample_ids = item_sample_ids if sample_ids is None else sample_ids & item_sample_ids
+
+    return sample_ids
+
+
+def query_only_interesting(query: AST) -> bool:
+    """
+    Checks whether the query requires, at the top level, a call with an interesting genotype type (e.g. HETEROZYGOUS.)
+    If so, rows without any interesting calls can't match and can be skipped, e.g. using a carrier index. Variants which
+    do match are still returned with all of their calls.
+    """
 
-        chromosome, state_changed = query_key_op_value_or_pass(q, "chromosome", chromosome, state_changed, FUNCTION_EQ)
+    return any(
+        genotype_types is not None and not (genotype_types & gt.GT_UNINTERESTING_CALLS)
+        for genotype_types in (_call_field_values(q, CALL_GENOTYPE_TYPE_FIELD) for q in ast_to_and_asts(query)))
 
-        # Reminder: start_min is inclusive (start_min = X is the same as start >= X)
-        start_min, state_changed = pipeline_value_extraction(q, start_min, state_changed, (
-            ("start", FUNCTION_EQ, int),  # Convert start = X to start_min = X (start_max handled below)
-            ("start", FUNCTION_GE, int),  # Extract start >= X into start_min = X
-            ("start", FUNCTION_GT, lambda x: int(x) + 1),  # Convert start > X to start_min = X + 1
-        ))
 
-        # Reminder: start_max is exclusive (start_max = X is the same as start < X); variants are at least 1 nucleotide
-        #   long, meaning that if end is limited in some way we can sometimes derive a start_max.
-        start_max, state_changed = pipeline_value_extraction(q, start_max, state_changed, (
-            ("start", FUNCTION_EQ, lambda x: int(x) + 1),  # Convert start = X to start_max = X + 1
-            ("start", FUNCTION_LE, lambda x: int(x) + 1),  # Extract start <= X to start_max = X + 1
-            ("start", FUNCTION_LT, int),  # Convert start < X to start_max = X
-            ("end", FUNCTION_LE, int),  # Convert end <= X to start_max = X
-            ("end", FUNCTION_LT, lambda x: int(x) - 1),  # Convert end < X to start_max = X - 2
-        ))
+def parse_query_for_tabix(query: AST) -> Tuple[RegionSet, Optional[AST]]:
+    """
+    Splits a query into the regions which need to be searched and the rest of the query, to be checked against each
+    variant found. If the query can never match anything, no regions are returned. Raises a ValueError or TypeError if
+    a position in the query isn't an integer.
+    """
 
-        if not state_changed:
-            other_query_items.append(q)
+    query = fold_constants(query)
+    if isinstance(query, Literal):
+        # Either everything or nothing matches
+        return ((WHOLE_GENOME,) if query.value else ()), None
 
-    return chromosome, start_min, start_max, and_asts_to_ast(tuple(other_query_items))
+    # Top-level conditions on position are fully covered by the regions, so they don't need to be checked against each
+    # variant; anything else (e.g. conditions in an #or) narrows the regions down but stays in the query.
+    other_query_items = tuple(q for q in ast_to_and_asts(query) if _condition_region(q) is None)
 
+    return query_regions(query), and_asts_to_ast(other_query_items)
 
-def chord_search(table_manager: TableManager, dt: str, query: List, internal_data: bool = False):
-    null_result = {} if internal_data else []
+
+def chord_search(
+    table_manager: TableManager,
+    dt: str,
+    query: List,
+    internal_data: bool = False,
+    aggregate_by: Optional[Tuple[str, ...]] = None,
+    projection: Optional[Projection] = None,
+    call_samples: Optional[CallSamples] = None,
+    timed_out_tables: Optional[List[str]] = None,
+    stream: bool = False,
+):
+    """
+    Searches variant tables using a Bento query. For internal searches, returns a dictionary of table IDs to the
+    (already JSON-encoded) matches for each table, with only the fields in the projection and calls for the samples in
+    call_samples if specified; otherwise, returns a list of tables with at least one match. If aggregate_by is
+    specified, returns a dictionary of table IDs to the counts of matches for each table instead, tallied by the values
+    of those fields. Tables which could not be searched in full before the timeout only have partial results, and
+    their IDs are added to timed_out_tables if it's specified. Raises an InvalidQueryError if the query is invalid.
+    If stream is set, internal searches which are big enough to be run in the worker pool return an iterator of
+    (table ID, matches) pairs instead, which runs the search as it goes; closing it before the end cancels the rest of
+    the search.
+    """
+
+    aggregate = aggregate_by is not None
+    null_result = {} if internal_data or aggregate else []
 
     if dt != "variant":
         # TODO: Don't silently ignore errors
         return _err(lambda _m: null_result, f"Encountered non-variant data type: {dt}")
 
-    # TODO: Parser error handling
-    query_ast = convert_query_to_ast_and_preprocess(query)
+    try:
+        query_ast = convert_query_to_ast_and_preprocess(query)
+
+        print(f"[{SERVICE_NAME}] [DEBUG] Performing search using query {query_ast}, internal_data={internal_data}, "
+              f"aggregate_by={aggregate_by}", flush=True)
 
-    print(f"[{SERVICE_NAME}] [DEBUG] Performing search using query {query_ast}, internal_data={internal_data}",
-          flush=True)
+        regions, rest_of_query = parse_query_for_tabix(query_ast)
+        sample_ids = query_sample_ids(query_ast)
+        only_interesting = query_only_interesting(query_ast)
 
-    chromosome, start_min, start_max, rest_of_query = parse_query_for_tabix(query_ast)
+    except (SyntaxError, ValueError, TypeError) as e:
+        raise InvalidQueryError(f"Invalid query: {e}") from e
 
-    print(f"[{SERVICE_NAME}] [DEBUG] For search, using chromosome={chromosome}, start_min={start_min}, "
-          f"start_max={start_max}, rest_of_query={rest_of_query}", flush=True)
+    print(f"[{SERVICE_NAME}] [DEBUG] For search, using regions={regions}, sample_ids={sample_ids}, "
+          f"only_interesting={only_interesting}, rest_of_query={rest_of_query}", flush=True)
 
-    dataset_results = {} if internal_data else []
+    dataset_results = null_result
 
     # TODO: What coordinate system do we want?
 
     try:
-        # Check validity of VCF chromosome
-        assert chromosome is None or re.match(CHROMOSOME_REGEX, chromosome) is not None
+        # Check validity of VCF chromosomes
+        assert all(r.chromosome is None or (isinstance(r.chromosome, str) and
+                                            re.match(CHROMOSOME_REGEX, r.chromosome) is not None) for r in regions)
+
+        if not regions:
+            # Query can never match anything, so don't bother the pool or open any files
+            increment_counter("searches_empty")
+            return dataset_results
+
+        # Searches are keyed on what they're actually run with, so e.g. queries which only differ in how their
+        # conditions are written are still the same search, and on the generations of the tables they could touch, so
+        # that nothing stale gets shared or cached even if changes to other tables don't affect them.
+        tables = table_manager.route_tables(None, regions)
+        search_key = (regions, ast_key(rest_of_query), sample_ids, only_interesting, internal_data, aggregate_by,
+                      projection, call_samples, tuple(sorted((t.table_id, t.generation) for t in tables)))
+
+        search_results = table_manager.search_cache.get(search_key)
+
+        # Only searches which are sent to the pool are worth streaming; anything else is done about as soon as it could
+        # start being sent back.
+        stream = stream and internal_data and not aggregate and search_results is None and \
+            _search_work(tables, None, regions) > INLINE_SEARCH_MAX_WORK
+
+        def run_search():
+            return _cache_search_results(
+                table_manager.search_cache, search_key, tuple(t.table_id for t in tables), _search_results(
+                    table_manager, regions, rest_of_query, internal_data, aggregate_by, sample_ids, only_interesting,
+                    projection, call_samples))
+
+        if search_results is None and stream:
+            # Streamed searches only go as fast as their client reads the response, so nothing else waits on them
+            search_results = run_search()
+        elif search_results is None:
+            # Identical searches share the results once they're all in, rather than each one getting searched again
+            search_results = _search_flights.do(search_key, lambda: tuple(run_search()))
+
+        search_results = _with_timed_out_tables(search_results, timed_out_tables)
+
+        if aggregate:
+            return dict(search_results)
+
+        if internal_data:
+            return search_results if stream else dict(search_results)
+
+        return [{"id": table_id, "data_type": "variant"} for table_id, _ in search_results]
+
+    except (ValueError, AssertionError) as e:
+        # TODO
+        _print_search_error(e)
+
+    return dataset_results
 
+
+def _search_results(
+    table_manager: TableManager,
+    regions: RegionSet,
+    rest_of_query: Optional[AST],
+    internal_data: bool,
+    aggregate_by: Optional[Tuple[str, ...]],
+    sample_ids: Optional[FrozenSet[str]],
+    only_interesting: bool,
+    projection: Optional[Projection],
+    call_samples: Optional[CallSamples],
+) -> Iterator[Tuple[Optional[str], Any]]:
+    # Runs a search for chord_search, yielding (table ID, matches or counts) for each table with results, and then
+    # (None, IDs of tables which timed out), so that everything about the search can be shared when it's coalesced.
+
+    timed_out_tables: List[str] = []
+
+    if aggregate_by is not None:
+        search_results = generic_aggregate_search(
+            table_manager=table_manager,
+            regions=regions,
+            group_by=aggregate_by,
+            rest_of_query=rest_of_query,
+            timeout=CHORD_SEARCH_TIMEOUT,
+            sample_ids=sample_ids,
+            only_interesting=only_interesting,
+            timed_out_tables=timed_out_tables,
+        )
+    else:
         search_results = generic_variant_search(
             table_manager=table_manager,
-            chromosome=chromosome,
-            start_min=start_min,
-            start_max=start_max,
+            regions=regions,
             rest_of_query=rest_of_query,
             internal_data=internal_data,
             timeout=CHORD_SEARCH_TIMEOUT,
+            sample_ids=sample_ids,
+            only_interesting=only_interesting,
+            projection=projection,
+            call_samples=call_samples,
+            timed_out_tables=timed_out_tables,
         )
 
-        if internal_data:
-            return {d.table_id: {"data_type": "variant", "matches": e} for d, e in search_results if e is not None}
+    for table, data in search_results:
+        yield table.table_id, data
 
-        return [{"id": d.table_id, "data_type": "variant"} for d, _ in search_results]
+    yield None, tuple(timed_out_tables)
 
-    except (ValueError, AssertionError) as e:
-        # TODO
-        print(f"[{SERVICE_NAME}] [ERROR] Encountered error during search: {str(e)}", file=sys.stderr, flush=True)
-        traceback.print_exc()
 
-    return dataset_results
+def _result_size(table_id: Optional[str], data: Any) -> int:
+    # Roughly how much space a table's results take up, going by their encoded size
+    if isinstance(data, EncodedMatches):
+        return len(table_id) + len(data.data)
+    if isinstance(data, VariantCounts):
+        return len(table_id) + len(json.dumps(data.groups))
+    return len(table_id or "")
+
+
+def _cache_search_results(
+    cache: ResultCache,
+    key: Hashable,
+    table_ids: Tuple[str, ...],
+    results: Iterable[Tuple[Optional[str], Any]],
+) -> Iterator[Tuple[Optional[str], Any]]:
+    # Passes the results of _search_results through, caching them once they're all in. Only complete runs are cached:
+    # nothing is if the results stop being iterated over before the end (e.g. when a streamed search is cancelled) or
+    # the search fails, and partial results from searches where tables timed out or were cancelled aren't either, since
+    # the search might get further next time.
+    items = []
+    for item in results:
+        items.append(item)
+        yield item
+
+    table_id, timed_out_tables = items[-1]
+    if table_id is None and not timed_out_tables:
+        cache.put(key, tuple(items), sum(_result_size(*item) for item in items), table_ids)
+
+
+def _with_timed_out_tables(
+    results: Iterable[Tuple[Optional[str], Any]],
+    timed_out_tables: Optional[List[str]],
+) -> Iterator[Tuple[str, Any]]:
+    # Unpacks the results of _search_results, adding the tables which timed out to timed_out_tables
+    for table_id, data in results:
+        if table_id is not None:
+            yield table_id, data
+        elif timed_out_tables is not None:
+            timed_out_tables.extend(data)
+
+
+def _print_search_error(e: Exception):
+    print(f"[{SERVICE_NAME}] [ERROR] Encountered error during search: {str(e)}", file=sys.stderr, flush=True)
+    traceback.print_exc()
 
 
 bp_chord_search = Blueprint("chord_search", __name__)
 
 
+def _json_response(data: bytes) -> Response:
+    return current_app.response_class(data, mimetype="application/json")
+
+
+def _request_aggregate_by() -> Optional[Tuple[str, ...]]:
+    """
+    Gets the fields to group by for an aggregate search from the request body (for POST) or arguments (for GET), or None
+    if the request isn't for an aggregate search. Raises a ValueError if the aggregate options are invalid.
+    """
+
+    if request.method == "POST":
+        aggregate = request.json.get("aggregate", False)
+        group_by = request.json.get("group_by", [])
+        if not isinstance(aggregate, bool):
+            raise ValueError("aggregate must be a boolean")
+    else:
+        aggregate = request.args.get("aggregate", "false").strip().lower()
+        group_by = [f.strip() for f in request.args.get("group_by", "").split(",") if f.strip()]
+        if aggregate not in ("true", "false"):
+            raise ValueError("aggregate must be true or false")
+        aggregate = aggregate == "true"
+
+    if not aggregate:
+        if group_by:
+            raise ValueError("group_by can only be used in aggregate searches")
+        return None
+
+    if not isinstance(group_by, list) or any(f not in AGGREGATE_FIELDS for f in group_by):
+        raise ValueError(f"group_by must be a list of fields from: {', '.join(AGGREGATE_FIELDS)}")
+
+    return tuple(dict.fromkeys(group_by))  # Remove duplicates, keeping order
+
+
+def _request_projection() -> Optional[Projection]:
+    """
+    Gets the projection of variant fields to return from the request body (for POST) or arguments (for GET), or None if
+    no fields were specified. Raises a ValueError if the fields are invalid.
+    """
+
+    if request.method == "POST":
+        fields = request.json.get("fields")
+        if fields is not None and (not isinstance(fields, list) or not all(isinstance(f, str) for f in fields)):
+            raise ValueError("fields must be a list of strings")
+    else:
+        fields = request.args.get("fields")
+        fields = None if fields is None else [f.strip() for f in fields.split(",") if f.strip()]
+
+    return None if fields is None else parse_projection(fields)
+
+
+def request_call_samples() -> Optional[CallSamples]:
+    """
+    Gets the samples to return calls for from the request body (for POST) or arguments (for GET): either a list of
+    sample IDs (samples; comma-separated for GET), or the name of a sample set (sample_set.) Returns None if neither was
+    specified, and raises a ValueError if they're invalid.
+    """
+
+    if request.method == "POST":
+        samples = request.json.get("samples")
+        sample_set = request.json.get("sample_set")
+        if samples is not None and (not isinstance(samples, list) or not all(isinstance(s, str) for s in samples)):
+            raise ValueError("samples must be a list of sample IDs")
+        if sample_set is not None and not isinstance(sample_set, str):
+            raise ValueError("sample_set must be the name of a sample set")
+    else:
+        samples = request.args.get("samples")
+        samples = None if samples is None else [s.strip() for s in samples.split(",") if s.strip()]
+        sample_set = request.args.get("sample_set")
+
+    if samples is not None and sample_set is not None:
+        raise ValueError("Only one of samples and sample_set can be specified")
+
+    return sample_set if sample_set is not None else (None if samples is None else frozenset(samples))
+
+
+def _search_options(internal_data: bool) -> Tuple[Optional[Tuple[str, ...]], Optional[Projection],
+                                                  Optional[CallSamples]]:
+    # Options which only apply to private searches, since public searches only say which tables have matches
+    aggregate_by = _request_aggregate_by()
+    projection = _request_projection()
+    call_samples = request_call_samples()
+
+    if (aggregate_by is not None or projection is not None or call_samples is not None) and not internal_data:
+        raise ValueError("Aggregates, fields and samples are only available in private searches")
+
+    if aggregate_by is not None and (projection is not None or call_samples is not None):
+        raise ValueError("Aggregate searches do not return fields or samples")
+
+    return aggregate_by, projection, call_samples
+
+
+def _encode_private_results(
+    results: Iterable[Tuple[str, EncodedMatches]],
+    timed_out_tables: List[str],
+) -> Iterator[bytes]:
+    # Splice the encoded matches for each table into the response as they come in, instead of decoding and re-encoding
+    # them. Timed-out tables are only known once every result is in.
+    error = None
+
+    yield b'{"results":{'
+    try:
+        for i, (table_id, m) in enumerate(results):
+            yield (b"," if i else b"") + json.dumps(table_id).encode("utf-8") + \
+                b':{"data_type":"variant","matches":' + m.data + b"}"
+    except Exception as e:
+        # Streamed results are only searched for once the response has been started, so errors can't turn it into an
+        # error response anymore; finish the JSON off with the error instead, so the results aren't taken as complete.
+        _print_search_error(e)
+        error = "Encountered error during search"
+
+    yield b'},"timed_out_tables":' + json.dumps(timed_out_tables).encode("utf-8") + \
+        (b',"error":' + json.dumps(error).encode("utf-8") if error is not None else b"") + b"}"
+
+
+def _counts_response(counts: VariantCounts) -> dict:
+    return {"count": counts.n_matches, "groups": counts.groups}
+
+
 def _search_endpoint(internal_data=False):
     # TODO: Request validation schema
 
@@ -300,7 +1202,37 @@ def _search_endpoint(internal_data=False):
         except json.decoder.JSONDecodeError:
             return _err(flask_errors.flask_bad_request_error, f"Invalid query JSON: {query}")
 
-    return jsonify({"results": chord_search(get_table_manager(), data_type, query, internal_data=internal_data)})
+    try:
+        aggregate_by, projection, call_samples = _search_options(internal_data)
+    except ValueError as e:
+        return _err(flask_errors.flask_bad_request_error, str(e))
+
+    timed_out_tables: List[str] = []
+    try:
+        results = chord_search(get_table_manager(), data_type, query, internal_data=internal_data,
+                               aggregate_by=aggregate_by, projection=projection, call_samples=call_samples,
+                               timed_out_tables=timed_out_tables, stream=True)
+    except InvalidQueryError as e:
+        return _err(flask_errors.flask_bad_request_error, str(e))
+
+    if aggregate_by is not None:
+        return jsonify({
+            "results": {
+                table_id: {"data_type": "variant", **_counts_response(c)} for table_id, c in results.items()},
+            "timed_out_tables": timed_out_tables,
+        })
+
+    if internal_data and isinstance(results, dict):
+        return _json_response(b"".join(_encode_private_results(results.items(), timed_out_tables)))
+
+    if internal_data:
+        # Stream the response, so that the search runs while it's being sent back and gets cancelled if the client goes
+        # away before it's done (which closes the generator.) The context is kept around for the table
+        # manager.
+        return current_app.response_class(
+            stream_with_context(_encode_private_results(results, timed_out_tables)), mimetype="application/json")
+
+    return jsonify({"results": results, "timed_out_tables": timed_out_tables})
 
 
 @bp_chord_search.route("/search", methods=["GET", "POST"])
@@ -348,13 +1280,32 @@ def table_search(table_id, internal=False) -> Optional[Response]:
         except json.decoder.JSONDecodeError:
             return _err(flask_errors.flask_bad_request_error, f"Invalid query JSON: {query}")
 
+    try:
+        aggregate_by, projection, call_samples = _search_options(internal)
+    except ValueError as e:
+        return _err(flask_errors.flask_bad_request_error, str(e))
+
+    if isinstance(call_samples, str) and table.sample_set(call_samples) is None:
+        return _err(flask_errors.flask_bad_request_error, f"No sample set {call_samples} in table {table_id}")
+
     # If it exists in the variant table manager, it's of data type 'variant'
-    search = chord_search(get_table_manager(), "variant", query, internal_data=internal)
+    timed_out_tables: List[str] = []
+    try:
+        search = chord_search(get_table_manager(), "variant", query, internal_data=internal,
+                              aggregate_by=aggregate_by, projection=projection, call_samples=call_samples,
+                              timed_out_tables=timed_out_tables)
+    except InvalidQueryError as e:
+        return _err(flask_errors.flask_bad_request_error, str(e))
+    timed_out = table_id in timed_out_tables
+
+    if aggregate_by is not None:
+        counts = search.get(table_id, VariantCounts(0, {f: {} for f in aggregate_by}))
+        return jsonify({"results": _counts_response(counts), "timed_out": timed_out})
 
     if internal:
-        results = {"results": search.get(table_id, {}).get("matches", [])}
-        print(f"[{SERVICE_NAME}] [DEBUG] Got {len(results['results'])} results for internal search", flush=True)
-        return jsonify(results)
+        matches = search.get(table_id, EMPTY_ENCODED_MATCHES)
+        print(f"[{SERVICE_NAME}] [DEBUG] Got {matches.n_matches} results for internal search", flush=True)
+        return _json_response(b'{"results":' + matches.data + b',"timed_out":' + json.dumps(timed_out).encode() + b"}")
 
     return jsonify(next((s for s in search if s["id"] == table.table_id), None) is not None)
 
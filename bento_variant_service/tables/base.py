@@ -1,30 +1,61 @@
+import threading
+
 from abc import ABC, abstractmethod
-from typing import Dict, Generator, Optional, Sequence, Set, Tuple
+from itertools import count
+from typing import AbstractSet, Callable, Dict, FrozenSet, Generator, Optional, Sequence, Set, Tuple
 
 from bento_variant_service.beacon.datasets import BeaconDataset
+from bento_variant_service.result_cache import SEARCH_CACHE_MAX_BYTES, ResultCache
 from bento_variant_service.variants.models import Variant
+from bento_variant_service.variants.regions import RegionSet, normalize_chromosome
 from bento_variant_service.variants.schemas import VARIANT_SCHEMA
 
 
 __all__ = [
+    "ContigRoute",
     "VariantTable",
     "TableManager",
 ]
 
 
+# (assembly ID, normalized contig)
+ContigRoute = Tuple[str, str]
+
+# Source of table generations, shared by all tables so that a table re-created with the ID of an old one doesn't start
+# out with a generation the old one had.
+_generations = count(1)
+
+
 class VariantTable(ABC):  # pragma: no cover
     def __init__(self, table_id: str, name: Optional[str], metadata: dict, assembly_ids: Sequence[str] = ()):
         self.table_id = table_id
         self.name: Optional[str] = None
         self.metadata: dict = {}
         self._assembly_ids: Set = set()
+        self._generation: int = next(_generations)
         self.update(name, metadata, assembly_ids)
         self._deleted = False
 
     def update(self, name: Optional[str], metadata: dict, assembly_ids: Sequence[str] = ()):
+        assembly_ids = set(assembly_ids)
+
+        if name != self.name or metadata != self.metadata or assembly_ids != self._assembly_ids:
+            self._bump_generation()
+
         self.name = name
         self.metadata = metadata
-        self._assembly_ids = set(assembly_ids)
+        self._assembly_ids = assembly_ids
+
+    def _bump_generation(self):
+        self._generation = next(_generations)
+
+    @property
+    def generation(self) -> int:
+        """
+        Number which changes whenever the contents of the table may have changed, and which no other table in the
+        process has had. Used to tell whether copies of the table (e.g. in pool workers) are out of date.
+        """
+        return self._generation
 
     def delete(self):
         self._deleted = True
@@ -44,6 +75,13 @@ class VariantTable(ABC):  # pragma: no cover
             "schema": VARIANT_SCHEMA,
         }
 
+    def sample_set(self, name: str) -> Optional[FrozenSet[str]]:
+        """
+        Gets a named set of sample IDs from the table's metadata (e.g. a cohort subset), or None if there isn't one.
+        """
+        sample_set = self.metadata.get("sample_sets", {}).get(name)
+        return None if sample_set is None else frozenset(sample_set)
+
     @property
     def beacon_datasets(self):
         return tuple(
@@ -67,6 +105,34 @@ class VariantTable(ABC):  # pragma: no cover
     def n_of_samples(self) -> int:
         pass
 
+    def estimate_search_work(
+        self,
+        assembly_id: Optional[str] = None,
+        chromosome: Optional[str] = None,
+        start_min: Optional[int] = None,
+        start_max: Optional[int] = None,
+    ) -> int:
+        """
+        Estimates the amount of work (roughly, the number of fields to parse) needed to search the table for variants
+        in a particular region. Used to decide how a search should be executed; does not need to be exact.
+        """
+        return self.n_of_variants
+
+    @property
+    def contig_routes(self) -> Optional[Set[ContigRoute]]:
+        """
+        Set of (assembly ID, normalized contig) pairs the table has variants on, used to route searches to tables.
+        None means the table cannot tell, and needs to be searched regardless of contig.
+        """
+        return None
+
+    def may_overlap(self, assembly_id: Optional[str], regions: RegionSet) -> bool:
+        """
+        Cheaply checks whether the table could have any variants in the specified regions, e.g. using a summary of
+        what each file covers, so that searches can skip tables without sending them to a worker.
+        """
+        return True
+
     @abstractmethod
     def _variants(
         self,
@@ -77,16 +143,182 @@ class VariantTable(ABC):  # pragma: no cover
         offset: Optional[int] = None,
         count: Optional[int] = None,
         only_interesting: bool = False,
+        sample_ids: Optional[AbstractSet[str]] = None,
+        call_sample_ids: Optional[AbstractSet[str]] = None,
+        interesting_rows: bool = False,
+        should_stop: Optional[Callable[[], bool]] = None,
     ) -> Generator[Variant, None, None]:
+        """
+        If only_interesting is set, only variants with interesting calls (e.g. not reference or missing) are yielded,
+        and only with those calls. If interesting_rows is set, variants without interesting calls are skipped the same
+        way, but the ones yielded still come with all of their calls.
+        If sample_ids is specified, only calls for those samples are needed; tables may leave out calls for other
+        samples (and variants without any calls for them) to avoid parsing them. If call_sample_ids is specified, only
+        calls for those samples will be looked at, but variants are selected the same way; tables may leave out calls
+        for other samples after deciding which variants to yield.
+        If should_stop is specified, it's called before each row is looked at (including rows which end up being
+        skipped), and the table stops yielding variants as soon as it returns True.
+        """
         yield None
 
     def variants(self, *args, **kwargs) -> Generator[Variant, None, None]:
         assert not self._deleted
         return self._variants(*args, **kwargs)
 
+    def variants_in_regions(
+        self,
+        assembly_id: Optional[str],
+        regions: RegionSet,
+        only_interesting: bool = False,
+        sample_ids: Optional[AbstractSet[str]] = None,
+        call_sample_ids: Optional[AbstractSet[str]] = None,
+        interesting_rows: bool = False,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ) -> Generator[Variant, None, None]:
+        """
+        Yields variants starting in any of the specified regions. Since variants are only yielded for the region their
+        start position falls in, a normalized (non-overlapping) set of regions will not yield any variant twice.
+        """
+        for region in regions:
+            yield from self.variants(assembly_id, *region, only_interesting=only_interesting, sample_ids=sample_ids,
+                                     call_sample_ids=call_sample_ids, interesting_rows=interesting_rows,
+                                     should_stop=should_stop)
+
+    def count_variants_in_regions(
+        self,
+        assembly_id: Optional[str],
+        regions: RegionSet,
+    ) -> Optional[Dict[Tuple[str, str], int]]:
+        """
+        Counts the variants starting in any of the specified regions by (assembly ID, chromosome), using indices rather
+        than reading any variants. Returns None if the table cannot count them this way, in which case they need to be
+        counted by going through variants_in_regions instead.
+        """
+        return None
+
+    def _beacon_match(
+        self,
+        assembly_id: Optional[str],
+        chromosome: Optional[str],
+        start_min: Optional[int],
+        start_max: Optional[int],
+        end_min: Optional[int],
+        end_max: Optional[int],
+        ref: str,
+        alt: str,
+    ) -> bool:
+        # Generic implementation, for tables which can only provide fully-built variants. Tables with access to the
+        # underlying records should override this with something which doesn't build calls.
+
+        for variant in self._variants(assembly_id, chromosome, start_min, start_max):
+            if variant.ref_bases != ref:
+                continue
+
+            if ((end_min is not None and variant.end_pos < end_min) or
+                    (end_max is not None and variant.end_pos > end_max)):
+                continue
+
+            # Genotype indices for alternate alleles start at 1 (0 is the reference allele)
+            alt_index = next((i for i, a in enumerate(variant.alt_alleles, 1) if a.value == alt), None)
+            if alt_index is None:
+                continue
+
+            if any(alt_index in c.genotype for c in variant.calls):
+                return True
+
+        return False
+
+    def beacon_match(self, *args, **kwargs) -> bool:
+        """
+        Checks whether at least one sample in the table carries a particular alternate allele in the specified region.
+        Coordinates are the same as in variants(); end bounds are inclusive.
+        """
+        assert not self._deleted
+        return self._beacon_match(*args, **kwargs)
+
 
 class TableManager(ABC):  # pragma: no cover
     # TODO: Rename
+
+    def __init__(self):
+        # Inverted index of which tables have variants on which contigs, kept up to date as tables change. Tables can
+        # be created or deleted by one request while others are searching, so the index is only used with the lock held.
+        self._routes_lock = threading.RLock()
+        self._routes: Dict[ContigRoute, Set[str]] = {}
+        self._contig_routes: Dict[str, Set[str]] = {}
+        self._unrouted_table_ids: Set[str] = set()
+        self._table_routes: Dict[str, Tuple[int, Optional[Set[ContigRoute]]]] = {}
+
+        # Results of searches over the manager's tables; entries are evicted whenever a table they involve is re-routed
+        # (i.e. changed or removed, e.g. by an ingest or a delete.)
+        self.search_cache = ResultCache("search_cache", SEARCH_CACHE_MAX_BYTES)
+
+    def _remove_table_routes(self, table_id: str):
+        self.search_cache.invalidate_table(table_id)
+
+        with self._routes_lock:
+            _, routes = self._table_routes.pop(table_id, (None, None))
+            self._unrouted_table_ids.discard(table_id)
+
+            for route in (routes or ()):
+                self._routes[route].discard(table_id)
+                if not self._routes[route]:
+                    del self._routes[route]
+
+                self._contig_routes[route[1]].discard(table_id)
+                if not self._contig_routes[route[1]]:
+                    del self._contig_routes[route[1]]
+
+    def _update_table_routes(self, table: VariantTable):
+        with self._routes_lock:
+            if table.table_id in self._table_routes and self._table_routes[table.table_id][0] == table.generation:
+                # Nothing has changed since the routes were last computed
+                return
+
+            self._remove_table_routes(table.table_id)
+
+            routes = table.contig_routes
+            self._table_routes[table.table_id] = (table.generation, routes)
+
+            if routes is None:
+                self._unrouted_table_ids.add(table.table_id)
+                return
+
+            for route in routes:
+                self._routes.setdefault(route, set()).add(table.table_id)
+                self._contig_routes.setdefault(route[1], set()).add(table.table_id)
+
+    def _update_routes(self):
+        with self._routes_lock:
+            for table_id in tuple(self._table_routes):
+                if table_id not in self.tables:
+                    self._remove_table_routes(table_id)
+
+            for table in tuple(self.tables.values()):
+                self._update_table_routes(table)
+
+    def route_tables(self, assembly_id: Optional[str], regions: RegionSet) -> Tuple[VariantTable, ...]:
+        """
+        Finds tables which could have variants in the specified regions, looking up each region's contig in the
+        routing map rather than checking every table. Tables are returned in order of table ID, so that searches list
+        their results in the same order every time.
+        """
+
+        tables = self.tables
+
+        if any(r.chromosome is None for r in regions):
+            return tuple(t for _, t in sorted(tables.items()))
+
+        with self._routes_lock:
+            table_ids = set(self._unrouted_table_ids)
+            for region in regions:
+                contig = normalize_chromosome(region.chromosome)
+                table_ids.update(
+                    self._contig_routes.get(contig, ()) if assembly_id is None else
+                    self._routes.get((assembly_id, contig), ()))
+
+        return tuple(tables[t] for t in sorted(table_ids) if t in tables)
+
     @abstractmethod
     def get_table(self, table_id: str) -> Optional[VariantTable]:
         pass
@@ -1,5 +1,5 @@
 from itertools import chain
-from typing import Dict, Generator, List, Optional, Tuple
+from typing import AbstractSet, Callable, Dict, Generator, List, Optional, Tuple
 
 from bento_variant_service.beacon.datasets import BeaconDataset
 from bento_variant_service.variants.models import Variant
@@ -17,6 +17,15 @@ class MemoryVariantTable(VariantTable):
     def __init__(self, table_id, name, metadata, assembly_ids=()):
         super().__init__(table_id, name, metadata, assembly_ids)
         self.variant_store: List[Variant] = []
+        self._generation_n_variants = 0
+
+    @property
+    def generation(self) -> int:
+        # The variant store is append-only, but may be appended to directly
+        if len(self.variant_store) != self._generation_n_variants:
+            self._generation_n_variants = len(self.variant_store)
+            self._bump_generation()
+        return super().generation
 
     @property
     def n_of_variants(self) -> int:
@@ -39,7 +48,12 @@ class MemoryVariantTable(VariantTable):
         offset: Optional[int] = None,
         count: Optional[int] = None,
         only_interesting: bool = False,
+        sample_ids: Optional[AbstractSet[str]] = None,
+        call_sample_ids: Optional[AbstractSet[str]] = None,
+        interesting_rows: bool = False,
+        should_stop: Optional[Callable[[], bool]] = None,
     ) -> Generator[Variant, None, None]:
+        # Variants are stored with all their calls already, so sample_ids / call_sample_ids are ignored here
         offset: int = 0 if offset is None else offset
         if offset < 0 or offset >= len(self.variant_store):
             return
@@ -49,6 +63,9 @@ class MemoryVariantTable(VariantTable):
             return
 
         for v in self.variant_store[offset:offset+count]:
+            if should_stop is not None and should_stop():
+                return
+
             if chromosome is not None and v.chromosome != chromosome:
                 continue
 
@@ -61,7 +78,7 @@ class MemoryVariantTable(VariantTable):
             if assembly_id is not None and v.assembly_id != assembly_id:
                 continue
 
-            if only_interesting and next((c for c in v.calls if c.is_interesting), None) is None:
+            if (only_interesting or interesting_rows) and next((c for c in v.calls if c.is_interesting), None) is None:
                 # Uninteresting; skip this variant
                 continue
 
@@ -74,6 +91,7 @@ class MemoryVariantTable(VariantTable):
 
 class MemoryTableManager(TableManager):
     def __init__(self):
+        super().__init__()
         self._tables = {}
         self.id_to_generate = "fixed_id"
 
@@ -100,10 +118,12 @@ class MemoryTableManager(TableManager):
             raise IDGenerationFailure()
 
         new_table = MemoryVariantTable(table_id=table_id, name=name, metadata=metadata, assembly_ids=("GRCh37",))
-        self._tables[table_id] = new_table
+        self._tables = {**self._tables, table_id: new_table}  # Replaced rather than changed, like the VCF managers'
+        self._update_table_routes(new_table)
 
         return new_table
 
     def delete_table_and_update(self, table_id: str):
         self._tables[table_id].delete()
-        del self._tables[table_id]
+        self._tables = {k: v for k, v in self._tables.items() if k != table_id}
+        self._remove_table_routes(table_id)
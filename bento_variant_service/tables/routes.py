@@ -4,12 +4,15 @@ from bento_lib.auth.flask_decorators import flask_permissions, flask_permissions
 from bento_lib.responses import flask_errors
 from flask import Blueprint, current_app, json, jsonify, request, url_for
 from jsonschema import validate, ValidationError
+from urllib.parse import urlencode
 
 from bento_variant_service.constants import SERVICE_NAME
+from bento_variant_service.search import request_call_samples, resolve_call_samples
 from bento_variant_service.tables.base import TableManager
 from bento_variant_service.tables.vcf.table import VCFVariantTable
 from bento_variant_service.tables.exceptions import IDGenerationFailure
 from bento_variant_service.table_manager import get_table_manager
+from bento_variant_service.variants.models import parse_projection
 from bento_variant_service.variants.schemas import VARIANT_SCHEMA, VARIANT_TABLE_METADATA_SCHEMA
 
 
@@ -144,29 +147,48 @@ def table_data(table_id):
     # TODO: Move this to search?
     only_interesting = request.args.get("only_interesting", "false").strip().lower() == "true"
 
+    # Only the fields (and samples' calls) asked for are serialized, and calls are only parsed if they're included
+    fields = request.args.get("fields")
+    try:
+        call_samples = request_call_samples()
+        call_sample_ids = resolve_call_samples(table, call_samples)
+        projection = None if fields is None and call_sample_ids is None else parse_projection(
+            None if fields is None else (f.strip() for f in fields.split(",") if f.strip()), call_sample_ids)
+    except ValueError as e:
+        return flask_errors.flask_bad_request_error(str(e))
+
+    if isinstance(call_samples, str) and table.sample_set(call_samples) is None:
+        return flask_errors.flask_bad_request_error(f"No sample set {call_samples} in table {table_id}")
+
     # TODO: Filtering?
     # TODO: Make consistent with search results?
 
     # TODO: What should be done when offset sends us off the end? 404?
 
-    data = [v.as_chord_representation()
-            for v in table.variants(offset=offset, count=count, only_interesting=only_interesting)]
+    data = [v.as_chord_representation(projection=projection)
+            for v in table.variants(offset=offset, count=count, only_interesting=only_interesting,
+                                    call_sample_ids=call_sample_ids)]
 
     next_page = next(table.variants(offset=offset + count, count=count, only_interesting=only_interesting),
                      None) is not None  # Check if there's at least one next result
 
+    # Other pages should have the same fields and samples
+    projection_args = {k: request.args[k] for k in ("fields", "samples", "sample_set") if k in request.args}
+    projection_arg = f"&{urlencode(projection_args)}" if projection_args else ""
+
     return jsonify({
-        "schema": VARIANT_SCHEMA,
+        # The schema is the same for every page, so point to it instead of including it in each one
+        "schema": {"$ref": url_for("tables.data_type_schema")},
         "data": data,
         # TODO: Need to calculate nulls based on total variants in a table
         "pagination": {  # TODO: CHORD_URL
             "previous_page_url": (
                 url_for("tables.table_data", table_id=table_id) +
-                f"?offset={max(0, offset - count)}&count={count + min(0, offset - count)}"
+                f"?offset={max(0, offset - count)}&count={count + min(0, offset - count)}{projection_arg}"
             ) if offset > 0 else None,
             "next_page_url": (
                 url_for("tables.table_data", table_id=table_id) +
-                f"?offset={offset + count}&count={count}"
+                f"?offset={offset + count}&count={count}{projection_arg}"
             ) if next_page else None,
         }
     })
@@ -2,6 +2,7 @@ import abc
 import datetime
 import os
 import shutil
+import threading
 import uuid
 
 from collections import namedtuple
@@ -35,10 +36,15 @@ TableDict = Dict[str, VCFVariantTable]
 
 class BaseVCFTableManager(TableManager, abc.ABC):
     def __init__(self, data_path: str):
+        super().__init__()
         self._DATA_PATH = data_path
         self._tables: TableDict = {}
         self._beacon_datasets: Dict[BeaconDatasetIDTuple, BeaconDataset] = {}
 
+        # Tables are updated both by requests and by background index builds, which mustn't interleave. Requests read
+        # the tables without the lock, so updates replace the dictionaries below rather than changing them in place.
+        self._update_lock = threading.Lock()
+
     @property
     def data_path(self):
         return self._DATA_PATH
@@ -118,6 +124,7 @@ class BaseVCFTableManager(TableManager, abc.ABC):
     def delete_table_and_update(self, table_id: str):
         shutil.rmtree(os.path.join(self._DATA_PATH, str(table_id)))
         self._tables[table_id].delete()
+        self._remove_table_routes(table_id)
         self.update_tables()
 
     @abc.abstractmethod
@@ -125,23 +132,33 @@ class BaseVCFTableManager(TableManager, abc.ABC):
         pass
 
     def update_tables(self):
+        with self._update_lock:
+            self._update_tables()
+
+    def _update_tables(self):
         # Loop through table folders to do the following:
         #  - Add new tables if entries on the file system have been added
         #  - Update existing tables
         #  - Remove tables if entries on the file system have been removed
 
-        table_folders = {t.id: t for t in self.table_folders}
+        tables: TableDict = {}
+        beacon_datasets: Dict[BeaconDatasetIDTuple, BeaconDataset] = {}
 
+        # Any existing tables which aren't in a folder anymore are left out
         for t in self.table_folders:
             files = self._get_table_vcf_files(t)
             if t.id in self._tables:
                 # Table exists already, so update it
-                self._tables[t.id].update_with_files(t.name, t.metadata, files)
+                tables[t.id] = self._tables[t.id]
+                tables[t.id].update_with_files(t.name, t.metadata, files)
             else:
-                self._tables[t.id] = VCFVariantTable(table_id=t.id, name=t.name, metadata=t.metadata, files=files)
+                tables[t.id] = VCFVariantTable(table_id=t.id, name=t.name, metadata=t.metadata, files=files)
+
+            for bd in tables[t.id].beacon_datasets:
+                beacon_datasets[bd.beacon_id_tuple] = bd
 
-            for bd in self._tables[t.id].beacon_datasets:
-                self._beacon_datasets[bd.beacon_id_tuple] = bd
+        self._tables = tables
+        self._beacon_datasets = beacon_datasets
 
-        # Remove any existing tables that shouldn't be there
-        self._tables = {k: v for k, v in self._tables.items() if k in table_folders}
+        # Re-route any tables which were added, changed or removed
+        self._update_routes()
@@ -0,0 +1,135 @@
+import zlib
+
+from array import array
+from bisect import bisect_left
+from typing import Iterable, Optional, Sequence, Tuple
+
+from .sidecars import SidecarBuilder, SidecarFile, build_sidecars
+
+
+__all__ = [
+    "CarrierIndex",
+    "CarrierIndexBuilder",
+    "build_carrier_index",
+]
+
+
+def _record_key(ref: str, alt: str) -> int:
+    # Tells apart records which start at the same position
+    return zlib.crc32(f"{ref}\t{alt}".encode("utf-8"))
+
+
+class CarrierIndex(SidecarFile):
+    """
+    Bit-packed matrix of which samples carry each alternate allele of each record in a VCF, i.e. have a genotype
+    containing the allele's index. Rows of the matrix are (record, alternate allele) pairs in record order, and bit j of
+    a row is sample column j. Records are found from their contig, position, REF and ALT through an offset map, so that
+    carrier questions can be answered without parsing a row's sample columns.
+    """
+
+    MAGIC = b"BVSCARR\x01"
+    SUFFIX = ".carriers"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+
+        self._row_bytes: int = (self.n_samples + 7) // 8
+        self._keys = self._next_array("I", self.n_records)
+        self._record_rows = self._next_array("I", self.n_records + 1)  # Last entry is the number of rows
+        self._bits_offset = self._offset
+
+    def _record(self, contig: str, pos: int, ref: str, alt: str) -> Optional[int]:
+        first, n = self._contigs.get(contig, (0, 0))
+        key = _record_key(ref, alt)
+
+        record = None
+        i = bisect_left(self._positions, pos, first, first + n)
+        while i < first + n and self._positions[i] == pos:
+            if self._keys[i] == key:
+                if record is not None:
+                    # Duplicate record; can't tell which row is which
+                    return None
+                record = i
+            i += 1
+
+        return record
+
+    def _row_bits(self, row: int) -> int:
+        offset = self._bits_offset + row * self._row_bytes
+        return int.from_bytes(self._mm[offset:offset + self._row_bytes], "little")
+
+    def carriers(self, contig: str, pos: int, ref: str, alt: str, alt_index: Optional[int] = None) -> Optional[int]:
+        """
+        Returns a bit mask of the sample columns of a record which carry the specified alternate allele (indexed from 1,
+        like in genotypes) or, if no allele is specified, any alternate allele. Returns None if the record isn't in the
+        index, in which case the row needs to be parsed instead.
+        """
+
+        record = self._record(contig, pos, ref, alt)
+        if record is None:
+            return None
+
+        rows = range(self._record_rows[record], self._record_rows[record + 1])
+        if alt_index is not None:
+            return self._row_bits(rows[alt_index - 1]) if 0 < alt_index <= len(rows) else 0
+
+        bits = 0
+        for row in rows:
+            bits |= self._row_bits(row)
+        return bits
+
+    @staticmethod
+    def columns(bits: int) -> Tuple[int, ...]:
+        # Indices of the set bits in a carrier mask; carriers are usually sparse, so only visit the set bits
+        columns = []
+        while bits:
+            low_bit = bits & -bits
+            columns.append(low_bit.bit_length() - 1)
+            bits ^= low_bit
+        return tuple(columns)
+
+
+class CarrierIndexBuilder(SidecarBuilder):
+    SIDECAR = CarrierIndex
+
+    def __init__(self, vcf_path: str, n_samples: int):
+        super().__init__(vcf_path, n_samples)
+
+        # Imported here, since the table module itself gets at sidecar files through VCFFile
+        from .table import VCFVariantTable
+        self._format_layout = VCFVariantTable._format_layout
+        self._sample_genotype = VCFVariantTable._sample_genotype
+
+        self._row_bytes = (n_samples + 7) // 8
+        self._keys = array("I")
+        self._record_rows = array("I", (0,))
+
+    def _add_row(self, row: tuple):
+        alts = row[4].split(",")
+        alt_bits = [0] * len(alts)
+
+        gt_pos = self._format_layout(row[8])[0] if len(row) > 8 else None
+        if gt_pos is not None:
+            for column, sample_data in enumerate(row[9:9 + self.n_samples]):
+                for allele in self._sample_genotype(sample_data, gt_pos)[0]:
+                    # Missing alleles are left as strings
+                    if isinstance(allele, int) and 0 < allele <= len(alts):
+                        alt_bits[allele - 1] |= 1 << column
+
+        self._keys.append(_record_key(row[3], row[4]))
+        self._record_rows.append(self._record_rows[-1] + len(alts))
+
+        # Rows of the bit matrix go straight to disk, since the whole matrix can be far bigger than memory
+        for b in alt_bits:
+            self._write_tail(b.to_bytes(self._row_bytes, "little"))
+
+    def _arrays(self) -> Sequence[Tuple[str, Iterable[int]]]:
+        return ("I", self._keys), ("I", self._record_rows)
+
+
+def build_carrier_index(vcf_path: str, index_path: Optional[str] = None) -> str:
+    """
+    Builds a carrier index for a bgzipped, Tabix-indexed VCF by parsing every row once, and writes it next to the VCF.
+    Returns the path of the new carrier index.
+    """
+    return build_sidecars(vcf_path, (CarrierIndexBuilder,), index_path)[0]
@@ -0,0 +1,184 @@
+from collections import namedtuple
+from typing import Optional, Sequence
+
+from bento_variant_service.variants import genotypes as gt
+from bento_variant_service.variants.models import Call
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+__all__ = [
+    "HAS_NUMPY",
+    "GENOTYPE_TYPES",
+    "DecodedCalls",
+    "decode_sample_columns",
+]
+
+
+# NumPy is an optional dependency; without it, sample columns are parsed one by one in pure Python instead.
+HAS_NUMPY = np is not None
+
+# Integer fields longer than this are left to the pure-Python parser, so that values can't overflow
+MAX_INT_DIGITS = 9
+
+_TAB, _COLON, _SLASH, _PIPE, _DOT, _STAR, _ZERO = map(ord, "\t:/|.*0")
+
+# Codes used in allele index arrays for values which aren't allele indices
+ALLELE_MISSING = -1  # .
+ALLELE_MISSING_UPSTREAM = -2  # *
+ALLELE_NONE = -3  # Second allele of a haploid genotype
+
+# Genotype types, indexed by the codes in DecodedCalls.genotype_types
+GENOTYPE_TYPES = (
+    gt.GT_MISSING,
+    gt.GT_MISSING_UPSTREAM_DELETION,
+    gt.GT_REFERENCE,
+    gt.GT_ALTERNATE,
+    gt.GT_HOMOZYGOUS_REFERENCE,
+    gt.GT_HETEROZYGOUS,
+    gt.GT_HOMOZYGOUS_ALTERNATE,
+)
+
+
+def _allele_from_code(code: int):
+    return "." if code == ALLELE_MISSING else "*" if code == ALLELE_MISSING_UPSTREAM else code
+
+
+if HAS_NUMPY:
+    # Genotype type codes for every combination of first / second allele codes, offset by ALLELE_NONE; worked out
+    # with Call.genotype_type_of so that the rules can't drift apart.
+    _GENOTYPE_TYPE_TABLE = np.array([
+        [
+            GENOTYPE_TYPES.index(Call.genotype_type_of(
+                (_allele_from_code(a1),) if a2 == ALLELE_NONE else (_allele_from_code(a1), _allele_from_code(a2))))
+            if a1 != ALLELE_NONE else 0
+            for a2 in range(ALLELE_NONE, 10)
+        ]
+        for a1 in range(ALLELE_NONE, 10)
+    ], dtype=np.int8)
+    _INTERESTING_TYPE_TABLE = np.array([t not in gt.GT_UNINTERESTING_CALLS for t in GENOTYPE_TYPES])
+
+# Arrays with one entry per decoded sample column. gt_starts / gt_ends are offsets of each GT field in data, which is
+# the sample columns joined by tabs. Missing DP / PS values are -1.
+DecodedCalls = namedtuple("DecodedCalls", (
+    "data",
+    "has_genotype",
+    "gt_starts",
+    "gt_ends",
+    "alleles",
+    "phased",
+    "genotype_types",
+    "interesting",
+    "read_depths",
+    "phase_sets",
+))
+
+
+def _field_bounds(col_starts, seps, first_sep, n_fields, pos: int):
+    present = n_fields > pos
+    sep_idx = np.minimum(first_sep + pos, len(seps) - 1)
+    ends = seps[sep_idx]
+    starts = col_starts if pos == 0 else seps[np.maximum(sep_idx - 1, 0)] + 1
+    return np.where(present, starts, 0), np.where(present, ends, 0), present
+
+
+def _parse_ints(buf, starts, ends, present):
+    lengths = ends - starts
+    missing = ~present | ((lengths == 1) & (buf[starts] == _DOT))
+
+    width = int(lengths.max(initial=0))
+    if width > MAX_INT_DIGITS or (present & (lengths == 0)).any():
+        return None
+
+    offsets = np.arange(width)
+    in_field = (offsets < lengths[:, None]) & ~missing[:, None]
+    digits = buf[np.minimum(starts[:, None] + offsets, len(buf) - 1)].astype(np.int64) - _ZERO
+    if (in_field & ((digits < 0) | (digits > 9))).any():
+        # Signs, spaces, etc. are left to the pure-Python parser
+        return None
+
+    place_values = 10 ** np.maximum(lengths[:, None] - 1 - offsets, 0)
+    values = np.where(in_field, digits * place_values, 0).sum(axis=1)
+    return np.where(missing, -1, values)
+
+
+def _allele_codes(chars):
+    is_index = (chars >= _ZERO) & (chars <= _ZERO + 9)
+    codes = np.where(
+        is_index, chars.astype(np.int64) - _ZERO, np.where(chars == _STAR, ALLELE_MISSING_UPSTREAM, ALLELE_MISSING))
+    return codes, is_index | (chars == _DOT) | (chars == _STAR)
+
+
+def decode_sample_columns(
+    sample_data: Sequence[str],
+    gt_pos: int,
+    dp_pos: Optional[int],
+    ps_pos: Optional[int],
+) -> Optional[DecodedCalls]:
+    """
+    Decodes the GT, DP and PS fields of a row's sample columns into arrays all at once, treating the columns as one
+    byte buffer rather than splitting each of them. Only handles the common cases (haploid or diploid genotypes with
+    single-digit allele indices and plain integer fields); returns None for anything else, in which case the columns
+    should be parsed one by one instead.
+    """
+
+    if not sample_data:
+        return None
+
+    data = "\t".join(sample_data) + "\t"
+    try:
+        buf = np.frombuffer(data.encode("ascii"), dtype=np.uint8)
+    except UnicodeEncodeError:
+        return None
+
+    col_ends = np.flatnonzero(buf == _TAB)
+    col_starts = np.concatenate(((0,), col_ends[:-1] + 1))
+
+    # Each column's fields end at either a colon or the tab after the column
+    seps = np.flatnonzero((buf == _COLON) | (buf == _TAB))
+    first_sep = np.searchsorted(seps, col_starts)
+    n_fields = np.searchsorted(seps, col_ends) - first_sep + 1
+
+    def field_bounds(pos):
+        return _field_bounds(col_starts, seps, first_sep, n_fields, pos)
+
+    gt_starts, gt_ends, has_genotype = field_bounds(gt_pos)
+    gt_lengths = gt_ends - gt_starts
+    haploid = has_genotype & (gt_lengths == 1)
+    diploid = has_genotype & (gt_lengths == 3)
+    if (has_genotype & ~haploid & ~diploid).any():
+        # Multi-digit allele indices, polyploid genotypes, etc.
+        return None
+
+    last = len(buf) - 1
+    first, first_valid = _allele_codes(buf[gt_starts])
+    second, second_valid = _allele_codes(buf[np.minimum(gt_starts + 2, last)])
+    separators = buf[np.minimum(gt_starts + 1, last)]
+
+    if (has_genotype & ~first_valid).any() or (
+            diploid & (~second_valid | ((separators != _SLASH) & (separators != _PIPE)))).any():
+        return None
+
+    second = np.where(diploid, second, ALLELE_NONE)
+    genotype_types = _GENOTYPE_TYPE_TABLE[first - ALLELE_NONE, second - ALLELE_NONE]
+
+    read_depths = _parse_ints(buf, *field_bounds(dp_pos)) if dp_pos is not None else np.full(len(col_ends), -1)
+    phase_sets = _parse_ints(buf, *field_bounds(ps_pos)) if ps_pos is not None else np.full(len(col_ends), -1)
+    if read_depths is None or phase_sets is None:
+        return None
+
+    return DecodedCalls(
+        data=data,
+        has_genotype=has_genotype,
+        gt_starts=gt_starts,
+        gt_ends=gt_ends,
+        alleles=np.stack((first, second), axis=1),
+        phased=diploid & (separators == _SLASH),  # Same as VCFVariantTable._parse_genotype
+        genotype_types=genotype_types,
+        interesting=has_genotype & _INTERESTING_TYPE_TABLE[genotype_types],
+        read_depths=read_depths,
+        phase_sets=phase_sets,
+    )
@@ -1,14 +1,19 @@
+import gzip
+import math
 import os
 import pysam
+import struct
 import subprocess
 import traceback
 
 from pysam import VariantFile
-from typing import Optional, Set, Sequence, Tuple
+from typing import Dict, Iterable, List, Optional, Set, Sequence, Tuple
 from urllib.parse import urlparse
 
 from bento_variant_service.constants import SERVICE_NAME
 from bento_variant_service.pool import WORKERS
+from .carriers import CarrierIndex
+from .sample_index import SampleIndex
 from .drs_utils import DRS_URI_SCHEME, drs_vcf_to_internal_paths
 
 
@@ -21,6 +26,11 @@ __all__ = [
 ASSEMBLY_ID_VCF_HEADER = "chord_assembly_id"
 CONTIG_VCF_HEADER = "contig"
 
+# Size of the windows in a Tabix linear index; a region query reads at least one of these.
+TABIX_LINEAR_BIN_SIZE = 2 ** 14
+TABIX_MAGIC = b"TBI\1"
+TABIX_PSEUDO_BIN = 37450
+
 CHR_PREFIX = "chr"
 STANDARD_CHROMOSOMES = [
     "1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11", "12", "13", "14",
@@ -28,6 +38,50 @@ STANDARD_CHROMOSOMES = [
 ]
 
 
+def _read_tabix_contigs(index_path: str) -> Dict[str, Tuple[int, Optional[int]]]:
+    # Upper bound on the (1-based) start position of the records on each contig, based on the number of windows in the
+    # contig's linear index, and the number of records on it (if recorded.) Returns nothing for indices which are not
+    # in Tabix format.
+
+    try:
+        with gzip.open(index_path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return {}
+
+    if data[:4] != TABIX_MAGIC:
+        return {}
+
+    # Header: n_ref, format, col_seq, col_beg, col_end, meta, skip, l_nm; followed by the contig names
+    n_ref, *_, l_nm = struct.unpack_from("<8i", data, 4)
+    offset = 36
+    names = data[offset:offset + l_nm].split(b"\0")[:n_ref]
+    offset += l_nm
+
+    contigs: Dict[str, Tuple[int, Optional[int]]] = {}
+
+    for name in names:
+        n_records = None
+
+        # Skip over the binning index, apart from the pseudo-bin htslib adds with the number of records on the contig
+        n_bin, = struct.unpack_from("<i", data, offset)
+        offset += 4
+        for _ in range(n_bin):
+            bin_number, n_chunk = struct.unpack_from("<Ii", data, offset)
+            if bin_number == TABIX_PSEUDO_BIN and n_chunk == 2:
+                # Chunks: (start offset, end offset), (mapped records, unmapped records)
+                n_records, = struct.unpack_from("<Q", data, offset + 24)
+            offset += 8 + n_chunk * 16
+
+        n_intv, = struct.unpack_from("<i", data, offset)
+        offset += 4 + n_intv * 8
+
+        # Records are indexed by the windows they overlap, so every record on the contig starts in the windows
+        contigs[name.decode("ascii")] = (n_intv * TABIX_LINEAR_BIN_SIZE, n_records)
+
+    return contigs
+
+
 class VCFFile:
     def __init__(self, vcf_uri: str, index_uri: Optional[str] = None):
         self._original_uri: str = vcf_uri
@@ -72,6 +126,7 @@ class VCFFile:
 
         # - Find contigs and detect contig format (e.g. chr1 vs 1)
         self._contigs: Set[str] = set(vcf.header.contigs)
+        self._contig_lengths: Dict[str, Optional[int]] = {c: vcf.header.contigs[c].length for c in self._contigs}
 
         #    - This will still work for an VCF that is on a non-standard contig, since it won't be picked up as a
         #      standard chromosome. We mostly don't want to prepend this, so erring on the side of not is a good move.
@@ -80,6 +135,7 @@ class VCFFile:
 
         # - Find sample IDs
         self._sample_ids: Tuple[str] = tuple(vcf.header.samples)
+        self._sample_columns: Dict[str, int] = {sample_id: i for i, sample_id in enumerate(self._sample_ids)}
 
         # - Find row count
         try:
@@ -90,7 +146,28 @@ class VCFFile:
                 f"{self._path}{f'##idx##{self._index_path}' if self._index_path else ''}"
             ), stdout=subprocess.PIPE)
             self._n_of_variants: int = int(p.stdout.read().strip())  # TODO: Handle error
-        except (subprocess.CalledProcessError, ValueError) as e:
+
+            # - Find contigs which actually have records, in the order they appear in the Tabix index (and the file),
+            #   and the range of positions their records start in
+            tf = pysam.TabixFile(self._path, index=self._index_path)
+            try:
+                self._index_contigs: Tuple[str, ...] = tuple(tf.contigs)
+                tabix_contigs = _read_tabix_contigs(self._index_path or f"{self._path}.tbi")
+                self._contig_extents: Dict[str, Tuple[int, Optional[int]]] = {}
+                self._contig_records: Dict[str, int] = {}
+                for c in self._index_contigs:
+                    first_row = next(tf.fetch(c, parser=pysam.asTuple()), None)
+                    if first_row is None:
+                        continue
+
+                    contig_end, n_records = tabix_contigs.get(c, (self._contig_lengths.get(c), None))
+                    self._contig_extents[c] = (int(first_row[1]), contig_end)
+                    if n_records is not None:
+                        self._contig_records[c] = n_records
+            finally:
+                tf.close()
+
+        except (subprocess.CalledProcessError, ValueError, OSError) as e:
             # bcftools returned 1, or couldn't find number of records, or couldn't find index
             print(f"[{SERVICE_NAME}] [DEBUG] Consolidating bcftools call error {str(e)} to ValueError", flush=True)
             traceback.print_exc()
@@ -98,11 +175,19 @@ class VCFFile:
         finally:
             vcf.close()
 
+        # - Use carrier / sample indices for the file, if they have been built and are up to date
+        self._carriers: Optional[CarrierIndex] = CarrierIndex.open_for(
+            self._path, self._n_of_variants, len(self._sample_ids))
+        self._sample_index: Optional[SampleIndex] = SampleIndex.open_for(
+            self._path, self._n_of_variants, len(self._sample_ids))
+
         print(f"[{SERVICE_NAME}] [DEBUG] Loaded VCF file from path {self._path} with:")
         print(f"[{SERVICE_NAME}] [DEBUG]   chr prefixes = {self._use_chr_prefix}")
         print(f"[{SERVICE_NAME}] [DEBUG]    assembly id = {self._assembly_id}")
         print(f"[{SERVICE_NAME}] [DEBUG]      # samples = {len(self._sample_ids)}")
-        print(f"[{SERVICE_NAME}] [DEBUG]         # rows = {self._n_of_variants}", flush=True)
+        print(f"[{SERVICE_NAME}] [DEBUG]         # rows = {self._n_of_variants}")
+        print(f"[{SERVICE_NAME}] [DEBUG]  carrier index = {self._carriers is not None}")
+        print(f"[{SERVICE_NAME}] [DEBUG]   sample index = {self._sample_index is not None}", flush=True)
 
     @property
     def original_uri(self) -> str:
@@ -132,10 +217,178 @@ class VCFFile:
     def n_of_variants(self) -> int:
         return self._n_of_variants
 
+    @property
+    def carriers(self) -> Optional[CarrierIndex]:
+        return self._carriers
+
+    @property
+    def sample_index(self) -> Optional[SampleIndex]:
+        return self._sample_index
+
+    def sample_columns(self, sample_ids: Iterable[str]) -> Tuple[int, ...]:
+        """
+        Finds the (sorted) indices of the specified samples' columns, relative to the first sample column. Samples
+        which aren't in the file are ignored.
+        """
+        return tuple(sorted(self._sample_columns[s] for s in sample_ids if s in self._sample_columns))
+
+    @property
+    def index_contigs(self) -> Tuple[str, ...]:
+        return self._index_contigs
+
+    @property
+    def contig_extents(self) -> Dict[str, Tuple[int, Optional[int]]]:
+        """
+        Inclusive range of (1-based) positions which the records on each contig start in, by contig name as it appears
+        in the file. The end of the range may be an overestimate, or None if unknown.
+        """
+        return self._contig_extents
+
+    def may_overlap(self, chromosome: Optional[str], start_min: Optional[int], start_max: Optional[int]) -> bool:
+        """
+        Checks, without reading any records, whether the file could have records starting in the specified region.
+        """
+
+        contigs = self._index_contigs if chromosome is None else (self._contig_name(chromosome),)
+
+        for contig in contigs:
+            extent = self._contig_extents.get(contig)
+            if extent is None:
+                continue
+
+            first, last = extent
+            if (start_max is None or first < start_max) and (start_min is None or last is None or last >= start_min):
+                return True
+
+        return False
+
+    def count_rows(
+        self,
+        chromosome: Optional[str],
+        start_min: Optional[int],
+        start_max: Optional[int],
+    ) -> Optional[Dict[str, int]]:
+        """
+        Counts the rows starting in a region on each contig (by name as it appears in the file) without reading any
+        records, using the record counts in the Tabix index for whole contigs, or the positions in a carrier / sample
+        index otherwise. Returns None if neither can answer for the region.
+        """
+
+        contigs = self._index_contigs if chromosome is None else (self._contig_name(chromosome),)
+        sidecar = self._carriers or self._sample_index
+        counts: Dict[str, int] = {}
+
+        for contig in contigs:
+            extent = self._contig_extents.get(contig)
+            if extent is None:
+                # No records on the contig
+                continue
+
+            first, last = extent
+            if (contig in self._contig_records and (start_min is None or start_min <= first) and
+                    (start_max is None or (last is not None and start_max > last))):
+                counts[contig] = self._contig_records[contig]
+            elif sidecar is not None:
+                counts[contig] = sidecar.count_records(contig, start_min, start_max)
+            else:
+                return None
+
+        return counts
+
+    def _contig_name(self, chromosome: str) -> str:
+        # If we need to prepend a chr prefix, do so here
+        return f"{CHR_PREFIX}{str(chromosome).lstrip(CHR_PREFIX)}" if self._use_chr_prefix else chromosome
+
+    def estimate_rows(self, chromosome: Optional[str], start_min: Optional[int], start_max: Optional[int]) -> int:
+        """
+        Roughly estimates the number of rows a fetch would have to read, based on the number of index bins covered by
+        the region relative to the length of the contig. Assumes rows are uniformly spread over the genome.
+        """
+
+        if chromosome is None:
+            if start_min is None and start_max is None:
+                return self._n_of_variants
+
+            # Position-only searches are run as one fetch per contig
+            return min(sum(self._estimate_contig_rows(c, start_min, start_max) for c in self._index_contigs),
+                       self._n_of_variants)
+
+        return self._estimate_contig_rows(self._contig_name(chromosome), start_min, start_max)
+
+    def _estimate_contig_rows(self, contig: str, start_min: Optional[int], start_max: Optional[int]) -> int:
+        if contig not in self._contigs:
+            return 0
+
+        contig_length = self._contig_lengths.get(contig)
+        if not contig_length:
+            # Without a length we cannot say how much of the file the region covers; assume the worst
+            return self._n_of_variants
+
+        region_start = max(start_min or 0, 0)
+        region_end = min(start_max if start_max is not None else contig_length, contig_length)
+        n_bins = max(math.ceil(region_end / TABIX_LINEAR_BIN_SIZE) - region_start // TABIX_LINEAR_BIN_SIZE, 1)
+
+        # Spread rows over the whole genome, since we don't know how many there are per contig
+        genome_length = sum(cl for cl in self._contig_lengths.values() if cl) or contig_length
+        return min(math.ceil(self._n_of_variants * n_bins * TABIX_LINEAR_BIN_SIZE / genome_length),
+                   self._n_of_variants)
+
+    def _fetch_regions(self, regions: Iterable[tuple], starting_in: bool = False) -> Iterable[tuple]:
+        # Takes pysam coordinates rather than CHORD coordinates, and contig names as they appear in the file.
+        # Parse as a Tabix file instead of a Variant file for performance reasons, and to get rows as tuples.
+        # If starting_in is set, rows which overlap a region but start before it are left out, so that rows aren't
+        # fetched twice from regions which are close together.
+        f = pysam.TabixFile(self.path, index=self.index_path, parser=pysam.asTuple(), threads=WORKERS)
+
+        try:
+            for region in regions:
+                rows = f.fetch(*region)
+                yield from (r for r in rows if int(r[1]) > region[1]) if starting_in else rows
+        finally:
+            f.close()
+
+    def fetch_all_contigs(self, start: Optional[int], end: Optional[int]) -> Iterable[tuple]:
+        """
+        Fetches rows in a range of (pysam) positions on every contig in the file. Each contig is fetched separately, so
+        only the blocks which overlap the range are read, instead of the whole file.
+        """
+        return self._fetch_regions((contig, start, end) for contig in self._index_contigs)
+
+    def fetch_sample_rows(
+        self,
+        columns: Sequence[int],
+        chromosome: Optional[str],
+        start_min: Optional[int],
+        start_max: Optional[int],
+    ) -> Iterable[tuple]:
+        """
+        Fetches rows starting at positions where any of the samples in the specified columns has an interesting
+        genotype, using the file's sample index, instead of reading through every row in the region. Positions close
+        together are fetched as one region. Other rows starting at the same positions may be included too.
+        """
+
+        contigs = self._index_contigs if chromosome is None else (self._contig_name(chromosome),)
+
+        for contig in contigs:
+            positions = self._sample_index.positions(contig, columns, start_min, start_max)
+            if not positions:
+                continue
+
+            # Group positions into runs, starting a new one when there's at least a Tabix window between positions
+            runs: List[List[int]] = []
+            for pos in positions:
+                if runs and pos - runs[-1][1] < TABIX_LINEAR_BIN_SIZE:
+                    runs[-1][1] = pos
+                else:
+                    runs.append([pos, pos])
+
+            wanted = frozenset(positions)
+            regions = ((contig, first - 1, last) for first, last in runs)  # pysam coordinates
+            yield from (r for r in self._fetch_regions(regions, starting_in=True) if int(r[1]) in wanted)
+
     def fetch(self, *args) -> Sequence[tuple]:
         if args:
-            # If we need to prepend a chr prefix, do so here
-            contig = f"{CHR_PREFIX}{str(args[0]).lstrip(CHR_PREFIX)}" if self._use_chr_prefix else args[0]
+            contig = self._contig_name(args[0])
             args = (contig, *args[1:])
 
             if contig not in self._contigs:
@@ -147,14 +400,7 @@ class VCFFile:
                 yield from ()
                 return
 
-        # Takes pysam coordinates rather than CHORD coordinates
-        # Parse as a Tabix file instead of a Variant file for performance reasons, and to get rows as tuples.
-        f = pysam.TabixFile(self.path, index=self.index_path, parser=pysam.asTuple(), threads=WORKERS)
-
-        try:
-            yield from f.fetch(*args)
-        finally:
-            f.close()
+        yield from self._fetch_regions((args,))
 
     def __repr__(self):
         return f"<VCFFile {self._path}>"
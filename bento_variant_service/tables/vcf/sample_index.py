@@ -0,0 +1,167 @@
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from bento_variant_service.variants import genotypes as gt
+from .sidecars import SidecarBuilder, SidecarFile, build_sidecars
+
+
+__all__ = [
+    "SampleIndex",
+    "SampleIndexBuilder",
+    "build_sample_index",
+]
+
+
+# How many bytes of encoded records are buffered, across every sample, before they're written to a temporary file
+_BUFFER_SIZE = 16 * 1024 * 1024
+
+
+def _encode_varints(values: Iterable[int]) -> bytes:
+    # Unsigned LEB128: 7 bits per byte, high bit set on every byte but the last
+    data = bytearray()
+    for v in values:
+        while v >= 0x80:
+            data.append((v & 0x7f) | 0x80)
+            v >>= 7
+        data.append(v)
+    return bytes(data)
+
+
+def _decode_varints(data: bytes) -> Iterator[int]:
+    value = 0
+    shift = 0
+    for b in data:
+        value |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            yield value
+            value = 0
+            shift = 0
+
+
+class SampleIndex(SidecarFile):
+    """
+    Inverted index from each sample column of a VCF to the records where the sample has an interesting genotype (i.e.
+    not missing or reference.) Each sample's record indices are stored delta-encoded as varints; records are ordered by
+    contig, then position, so they can be turned back into positions on each contig.
+    """
+
+    MAGIC = b"BVSSMPL\x01"
+    SUFFIX = ".samples"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+
+        self._sample_offsets = self._next_array("Q", self.n_samples + 1)  # Relative to the start of the varints
+        self._records_offset = self._offset
+
+    def records(self, column: int) -> List[int]:
+        """
+        Sorted indices of the records where the sample in the specified column has an interesting genotype.
+        """
+        start = self._records_offset + self._sample_offsets[column]
+        end = self._records_offset + self._sample_offsets[column + 1]
+        return list(accumulate(_decode_varints(self._mm[start:end])))
+
+    def max_records(self, columns: Iterable[int]) -> int:
+        # Upper bound on the number of records the samples have interesting genotypes in, without decoding anything;
+        # each record takes up at least one byte.
+        return sum(self._sample_offsets[c + 1] - self._sample_offsets[c] for c in columns)
+
+    def positions(
+        self,
+        contig: str,
+        columns: Iterable[int],
+        start_min: Optional[int] = None,
+        start_max: Optional[int] = None,
+    ) -> List[int]:
+        """
+        Sorted, distinct positions on a contig (as named in the file) where any of the samples in the specified columns
+        has an interesting genotype, within an optional range of start positions.
+        """
+
+        first, n = self._contigs.get(contig, (0, 0))
+        positions = set()
+
+        for column in columns:
+            records = self.records(column)
+            for record in records[bisect_left(records, first):bisect_left(records, first + n)]:
+                pos = self._positions[record]
+                if (start_min is None or pos >= start_min) and (start_max is None or pos < start_max):
+                    positions.add(pos)
+
+        return sorted(positions)
+
+
+class SampleIndexBuilder(SidecarBuilder):
+    SIDECAR = SampleIndex
+
+    def __init__(self, vcf_path: str, n_samples: int):
+        super().__init__(vcf_path, n_samples)
+
+        # Imported here, since the table module itself gets at sidecar files through VCFFile
+        from .table import VCFVariantTable
+        self._format_layout = VCFVariantTable._format_layout
+        self._sample_genotype = VCFVariantTable._sample_genotype
+
+        # Each sample's record indices are delta-encoded as they come in. The encoded records are buffered per sample
+        # and written out to the temporary file in chunks of rows, with each chunk laid out sample by sample; the
+        # lengths of each sample's segment of each chunk are kept, so the segments can be put back in sample order.
+        self._buffers = [bytearray() for _ in range(n_samples)]
+        self._n_buffered = 0
+        self._last_records = array("Q", bytes(8 * n_samples))
+        self._chunk_lengths: List[array] = []
+
+    def _add_row(self, row: tuple):
+        gt_pos = self._format_layout(row[8])[0] if len(row) > 8 else None
+        if gt_pos is None:
+            return
+
+        record = self.n_records
+        for column, sample_data in enumerate(row[9:9 + self.n_samples]):
+            # Same classification as the calls built by the table, so the index agrees with what's interesting there
+            if self._sample_genotype(sample_data, gt_pos)[2] not in gt.GT_UNINTERESTING_CALLS:
+                encoded = _encode_varints((record - self._last_records[column],))
+                self._buffers[column] += encoded
+                self._n_buffered += len(encoded)
+                self._last_records[column] = record
+
+        if self._n_buffered >= _BUFFER_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self._n_buffered:
+            return
+
+        self._chunk_lengths.append(array("Q", (len(b) for b in self._buffers)))
+        for b in self._buffers:
+            self._write_tail(b)
+            b.clear()
+        self._n_buffered = 0
+
+    def _finish(self):
+        self._flush()
+
+    def _arrays(self) -> Sequence[Tuple[str, Iterable[int]]]:
+        lengths = (sum(c[column] for c in self._chunk_lengths) for column in range(self.n_samples))
+        return ("Q", accumulate(lengths, initial=0)),
+
+    def _tail_chunks(self) -> Iterable[bytes]:
+        chunk_offsets = accumulate((sum(c) for c in self._chunk_lengths), initial=0)
+        segment_offsets = [tuple(accumulate(c, initial=o)) for c, o in zip(self._chunk_lengths, chunk_offsets)]
+
+        for column in range(self.n_samples):
+            for lengths, offsets in zip(self._chunk_lengths, segment_offsets):
+                if lengths[column]:
+                    yield self._read_tail(offsets[column], lengths[column])
+
+
+def build_sample_index(vcf_path: str, index_path: Optional[str] = None) -> str:
+    """
+    Builds a sample index for a bgzipped, Tabix-indexed VCF by parsing every row once, and writes it next to the VCF.
+    Returns the path of the new sample index.
+    """
+    return build_sidecars(vcf_path, (SampleIndexBuilder,), index_path)[0]
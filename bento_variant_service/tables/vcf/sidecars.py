@@ -0,0 +1,276 @@
+import json
+import mmap
+import os
+import pysam
+import struct
+import tempfile
+
+from array import array
+from bisect import bisect_left
+from functools import partial
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Type, TypeVar
+
+from bento_variant_service.pool import WORKERS
+
+
+__all__ = [
+    "SidecarFile",
+    "SidecarBuilder",
+    "build_sidecars",
+    "vcf_n_samples",
+    "vcf_contig_rows",
+    "write_sidecar",
+]
+
+
+# Magic, then the length of the JSON header which follows
+_PREAMBLE = struct.Struct("<8sI")
+
+# Arrays after the header are aligned to this, so they can be used without copying
+_ALIGNMENT = 8
+
+# Size of the chunks trailing data is copied into sidecar files in
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+
+S = TypeVar("S", bound="SidecarFile")
+
+
+class SidecarFile:
+    """
+    Index file stored next to the VCF it was built from (e.g. test.vcf.gz.carriers), made of a JSON header followed by
+    arrays, all memory-mapped rather than read into memory. Every sidecar file starts with the position of each record,
+    in file order (i.e. by contig, then position.)
+    """
+
+    MAGIC: bytes = b""
+    SUFFIX: str = ""
+
+    def __init__(self, path: str):
+        self._path = path
+
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._data = memoryview(self._mm)
+
+        magic, header_length = _PREAMBLE.unpack_from(self._data)
+        if magic != self.MAGIC:
+            raise ValueError(f"Not a {type(self).__name__} file: {path}")
+
+        self.header: dict = json.loads(bytes(self._data[_PREAMBLE.size:_PREAMBLE.size + header_length]))
+        self._offset = self._aligned(_PREAMBLE.size + header_length)
+
+        self.n_samples: int = self.header["n_samples"]
+        self.n_records: int = self.header["n_records"]
+
+        # Contig name: (index of first record, number of records)
+        self._contigs: Dict[str, Tuple[int, int]] = {c: (first, n) for c, first, n in self.header["contigs"]}
+
+        self._positions = self._next_array("I", self.n_records)
+
+    def __reduce__(self):
+        # Re-open the file rather than trying to pickle the memory map, e.g. when sent to a worker process
+        return type(self), (self._path,)
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def count_records(self, contig: str, start_min: Optional[int] = None, start_max: Optional[int] = None) -> int:
+        """
+        Counts the records on a contig (as named in the file) starting within an optional range of positions.
+        """
+        first, n = self._contigs.get(contig, (0, 0))
+        lo = first if start_min is None else bisect_left(self._positions, start_min, first, first + n)
+        hi = first + n if start_max is None else bisect_left(self._positions, start_max, first, first + n)
+        return max(hi - lo, 0)
+
+    @staticmethod
+    def _aligned(offset: int) -> int:
+        return offset + (-offset % _ALIGNMENT)
+
+    def _next_array(self, typecode: str, n: int) -> memoryview:
+        # Arrays are read in the order they were written in
+        size = array(typecode).itemsize * n
+        a = self._data[self._offset:self._offset + size].cast(typecode)
+        self._offset = self._aligned(self._offset + size)
+        return a
+
+    @classmethod
+    def open_for(cls: Type[S], vcf_path: str, n_records: int, n_samples: int) -> Optional[S]:
+        """
+        Opens the sidecar file for a VCF, if there is one which is up to date with it.
+        """
+
+        path = f"{vcf_path}{cls.SUFFIX}"
+
+        try:
+            if os.path.getmtime(path) < os.path.getmtime(vcf_path):
+                return None
+            sidecar = cls(path)
+        except (OSError, ValueError):
+            return None
+
+        return sidecar if (sidecar.header["n_records"], sidecar.header["n_samples"]) == (n_records, n_samples) else None
+
+
+def write_sidecar(
+    sidecar_class: Type[SidecarFile],
+    vcf_path: str,
+    header: dict,
+    arrays: Sequence[Tuple[str, Iterable[int]]],
+    tail: Iterable[bytes] = (),
+) -> str:
+    """
+    Writes a sidecar file for a VCF: the header, then each (typecode, values) array in native byte order, then any
+    trailing data, given as a sequence of chunks. Returns the path of the new file.
+    """
+
+    path = f"{vcf_path}{sidecar_class.SUFFIX}"
+    tmp_path = f"{path}.tmp"
+
+    header_bytes = json.dumps(header).encode("utf-8")
+
+    with open(tmp_path, "wb") as f:
+        def write_aligned(data: bytes):
+            f.write(data)
+            f.write(b"\0" * (-f.tell() % _ALIGNMENT))
+
+        write_aligned(_PREAMBLE.pack(sidecar_class.MAGIC, len(header_bytes)) + header_bytes)
+        for typecode, values in arrays:
+            write_aligned(array(typecode, values).tobytes())
+        for chunk in tail:
+            f.write(chunk)
+
+    # Don't leave a half-written file where it could be picked up
+    os.replace(tmp_path, path)
+
+    return path
+
+
+class SidecarBuilder:
+    """
+    Builds a sidecar file for a VCF from its rows, fed in one at a time in file order, so that several sidecars can be
+    built in the same pass over the file. Per-record arrays are kept in memory as compact arrays; data which follows
+    them can be written to a temporary file next to the VCF as rows come in (see _write_tail), and is copied into the
+    sidecar file at the end.
+    """
+
+    SIDECAR: Type[SidecarFile] = SidecarFile
+
+    def __init__(self, vcf_path: str, n_samples: int):
+        self.vcf_path = vcf_path
+        self.n_samples = n_samples
+
+        self._contigs: List[Tuple[str, int]] = []  # (contig, index of first record)
+        self._positions = array("I")
+        self._tail: Optional[BinaryIO] = None
+
+    @property
+    def n_records(self) -> int:
+        return len(self._positions)
+
+    def add_row(self, contig: str, row: tuple):
+        if not self._contigs or self._contigs[-1][0] != contig:
+            self._contigs.append((contig, self.n_records))
+        self._add_row(row)
+        self._positions.append(int(row[1]))
+
+    def _add_row(self, row: tuple):  # pragma: no cover
+        pass
+
+    def _finish(self):  # pragma: no cover
+        # Called once every row has been added, before anything is written
+        pass
+
+    def _arrays(self) -> Sequence[Tuple[str, Iterable[int]]]:  # pragma: no cover
+        # Arrays which follow the positions of the records
+        return ()
+
+    def _write_tail(self, data: bytes):
+        # Appends to the data which follows the arrays in the sidecar file
+        if self._tail is None:
+            self._tail = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.vcf_path)))
+        self._tail.write(data)
+
+    def _read_tail(self, offset: int, length: int) -> bytes:
+        self._tail.seek(offset)
+        return self._tail.read(length)
+
+    def _tail_chunks(self) -> Iterable[bytes]:
+        if self._tail is None:
+            return ()
+        self._tail.seek(0)
+        return iter(partial(self._tail.read, _COPY_CHUNK_SIZE), b"")
+
+    def write(self) -> str:
+        """
+        Writes the sidecar file once every row has been added. Returns the path of the new file.
+        """
+
+        ends = (*(first for _, first in self._contigs[1:]), self.n_records)
+        contigs = [(contig, first, end - first) for (contig, first), end in zip(self._contigs, ends)]
+
+        try:
+            self._finish()
+            return write_sidecar(
+                self.SIDECAR,
+                self.vcf_path,
+                {"n_samples": self.n_samples, "n_records": self.n_records, "contigs": contigs},
+                (("I", self._positions), *self._arrays()),
+                self._tail_chunks())
+        finally:
+            self.close()
+
+    def close(self):
+        if self._tail is not None:
+            self._tail.close()
+
+
+def build_sidecars(
+    vcf_path: str,
+    builder_classes: Sequence[Type[SidecarBuilder]],
+    index_path: Optional[str] = None,
+) -> Tuple[str, ...]:
+    """
+    Builds sidecar files for a bgzipped, Tabix-indexed VCF, parsing every row once for all of them, and writes them next
+    to the VCF. Returns the paths of the new sidecar files.
+    """
+
+    n_samples = vcf_n_samples(vcf_path, index_path)
+    builders = [builder_class(vcf_path, n_samples) for builder_class in builder_classes]
+
+    try:
+        for contig, rows in vcf_contig_rows(vcf_path, index_path):
+            for row in rows:
+                for builder in builders:
+                    builder.add_row(contig, row)
+
+        return tuple(builder.write() for builder in builders)
+
+    finally:
+        for builder in builders:
+            builder.close()
+
+
+def vcf_n_samples(vcf_path: str, index_path: Optional[str] = None) -> int:
+    vcf = pysam.VariantFile(vcf_path, index_filename=index_path)
+    try:
+        return len(vcf.header.samples)
+    finally:
+        vcf.close()
+
+
+def vcf_contig_rows(vcf_path: str, index_path: Optional[str] = None) -> Iterator[Tuple[str, Iterator[tuple]]]:
+    """
+    Yields each contig of a bgzipped, Tabix-indexed VCF along with an iterator of its rows. Sidecar files are laid out
+    in this order, one contig after another.
+    """
+
+    tf = pysam.TabixFile(vcf_path, index=index_path, parser=pysam.asTuple(), threads=WORKERS)
+    try:
+        for contig in tf.contigs:
+            yield contig, tf.fetch(contig)
+    finally:
+        tf.close()
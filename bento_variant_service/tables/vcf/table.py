@@ -1,22 +1,39 @@
 import re
 import sys
 
-from typing import Generator, List, Optional, Tuple
+from collections import Counter
+from functools import lru_cache, partial
+
+from typing import AbstractSet, Callable, Dict, Generator, Iterable, List, Optional, Sequence, Set, Tuple, Union
 
 from bento_variant_service.beacon.datasets import BeaconDataset
 from bento_variant_service.constants import SERVICE_NAME
-from bento_variant_service.tables.base import VariantTable
+from bento_variant_service.tables.base import ContigRoute, VariantTable
+from bento_variant_service.tables.vcf.decoding import HAS_NUMPY, GENOTYPE_TYPES, DecodedCalls, decode_sample_columns
 from bento_variant_service.tables.vcf.file import VCFFile
 from bento_variant_service.variants.models import Allele, Variant, Call
+from bento_variant_service.variants.regions import RegionSet, normalize_chromosome
 
 
 MAX_SIGNED_INT_32 = 2 ** 31 - 1
 
 REGEX_GENOTYPE_SPLIT = re.compile(r"[|/]")
+
+# Matches the start of any sample column whose genotype (when it's the first field) might be interesting, i.e. isn't
+# missing (first allele . or *) or homozygous / haploid reference (all alleles 0).
+REGEX_MAYBE_INTERESTING_GT = re.compile(r"\t(?![.*]|0(?:[/|]0)*(?::|\t|$))")
 VCF_GENOTYPE = "GT"
 VCF_READ_DEPTH = "DP"
 VCF_PHASE_SET = "PS"
 
+# Maximum number of distinct GT / FORMAT strings to keep parsed values for (per process)
+GENOTYPE_CACHE_SIZE = 1024
+FORMAT_CACHE_SIZE = 64
+
+# Rows with at least this many sample columns to parse are decoded with NumPy (if installed) rather than column by
+# column; below this, setting up the arrays costs more than it saves.
+NUMPY_DECODE_MIN_COLUMNS = 512
+
 
 class VCFVariantTable(VariantTable):
     def __init__(
@@ -38,8 +55,21 @@ class VCFVariantTable(VariantTable):
             if len(fg) >= 9:  # Need 9th column of VCF to deal with genotypes, samples, etc.
                 good_files.append(file)
 
-        self.update(name, metadata, tuple(vf.assembly_id for vf in good_files))
+        files_changed = self._file_keys(good_files) != self._file_keys(self._files)
+
+        # The files are swapped in before the generation changes, so that anything which sees the new generation (e.g.
+        # a search snapshotting the tables) sees the new files as well.
         self._files: Tuple[VCFFile] = tuple(good_files)
+        self.update(name, metadata, tuple(vf.assembly_id for vf in good_files))
+        if files_changed:
+            self._bump_generation()
+
+    @staticmethod
+    def _file_keys(files: Sequence[VCFFile]) -> Tuple[Tuple[str, Optional[str], int, bool, bool], ...]:
+        # File records are re-created on every table update, so compare what they point to instead
+        return tuple(
+            (vf.path, vf.index_path, vf.n_of_variants, vf.carriers is not None, vf.sample_index is not None)
+            for vf in files)
 
     @property
     def beacon_datasets(self):
@@ -62,22 +92,81 @@ class VCFVariantTable(VariantTable):
         return val if val in (".", "*") else int(val)
 
     @staticmethod
-    def _variant_calls(variant: Variant, sample_ids: tuple, row: tuple, only_interesting: bool = False):
-        for sample_id, row_data in zip(sample_ids, row[9:]):
-            row_info = {k: v for k, v in zip(row[8].split(":"), row_data.split(":"))}
+    @lru_cache(maxsize=GENOTYPE_CACHE_SIZE)
+    def _parse_genotype(gt: str) -> Tuple[Tuple[Union[int, str], ...], bool, str]:
+        # A VCF only has a handful of distinct GT strings (0/0, 0|1, ./., ...), so parsed genotypes are cached and
+        # shared between all calls rather than being split and classified again for every sample on every row.
+        genotype = tuple(map(VCFVariantTable._int_or_missing_from_vcf, re.split(REGEX_GENOTYPE_SPLIT, gt)))
+        return genotype, "/" in gt, Call.genotype_type_of(genotype)
+
+    @staticmethod
+    @lru_cache(maxsize=FORMAT_CACHE_SIZE)
+    def _format_layout(format_str: str) -> Tuple[Optional[int], Optional[int], Optional[int], int]:
+        """
+        Finds the positions of the GT, DP and PS fields in a FORMAT string, along with how many times a sample column
+        needs to be split to get at all of them. FORMAT strings are usually the same for every row in a file.
+        """
+
+        format_keys = format_str.split(":")
+        gt_pos, dp_pos, ps_pos = (
+            format_keys.index(k) if k in format_keys else None for k in (VCF_GENOTYPE, VCF_READ_DEPTH, VCF_PHASE_SET))
+        return gt_pos, dp_pos, ps_pos, max(p for p in (gt_pos, dp_pos, ps_pos, -1) if p is not None) + 1
 
-            if VCF_GENOTYPE not in row_info:
+    @staticmethod
+    def _sample_field(sample_fields: List[str], pos: Optional[int]) -> str:
+        # Trailing fields may be dropped from sample columns, in which case they're missing
+        return sample_fields[pos] if pos is not None and pos < len(sample_fields) else "."
+
+    @staticmethod
+    def _sample_genotype(sample_data: str, gt_pos: int) -> Tuple[Tuple[Union[int, str], ...], bool, str]:
+        # Parses just the genotype of a raw sample column, only splitting the column as far as the GT field
+        return VCFVariantTable._parse_genotype(
+            VCFVariantTable._sample_field(sample_data.split(":", gt_pos + 1), gt_pos))
+
+    @staticmethod
+    def _variant_calls(
+        variant: Variant,
+        sample_ids: tuple,
+        row: tuple,
+        only_interesting: bool = False,
+        sample_columns: Optional[Sequence[int]] = None,
+    ):
+        gt_pos, dp_pos, ps_pos, n_splits = VCFVariantTable._format_layout(row[8])
+
+        if gt_pos is None:
+            # Only include samples which have genotypes
+            return
+
+        # If only some samples' columns are wanted, skip parsing the rest entirely
+        n_columns = min(len(sample_ids), len(row) - 9)
+        columns = range(n_columns) if sample_columns is None else [c for c in sample_columns if c < n_columns]
+
+        if HAS_NUMPY and len(columns) >= NUMPY_DECODE_MIN_COLUMNS:
+            decoded = decode_sample_columns(
+                row[9:9 + n_columns] if sample_columns is None else [row[9 + c] for c in columns],
+                gt_pos, dp_pos, ps_pos)
+            if decoded is not None:
+                yield from VCFVariantTable._decoded_variant_calls(variant, sample_ids, columns, decoded,
+                                                                  only_interesting)
+                return
+
+        for column in columns:
+            # Only split as far as we need to get to the fields we use
+            sample_fields = row[9 + column].split(":", n_splits)
+
+            if gt_pos >= len(sample_fields):
                 # Only include samples which have genotypes
                 continue
 
-            gt = row_info[VCF_GENOTYPE]
+            genotype, phased, genotype_type = VCFVariantTable._parse_genotype(sample_fields[gt_pos])
             call = Call(
                 variant=variant,
-                genotype=tuple(map(VCFVariantTable._int_or_missing_from_vcf, re.split(REGEX_GENOTYPE_SPLIT, gt))),
-                phased="/" in gt,
-                phase_set=VCFVariantTable._int_or_none_from_vcf(row_info.get(VCF_PHASE_SET, ".")),
-                sample_id=sample_id,
-                read_depth=VCFVariantTable._int_or_none_from_vcf(row_info.get(VCF_READ_DEPTH, ".")),
+                genotype=genotype,
+                phased=phased,
+                phase_set=VCFVariantTable._int_or_none_from_vcf(VCFVariantTable._sample_field(sample_fields, ps_pos)),
+                sample_id=sample_ids[column],
+                read_depth=VCFVariantTable._int_or_none_from_vcf(VCFVariantTable._sample_field(sample_fields, dp_pos)),
+                genotype_type=genotype_type,
             )
 
             if only_interesting and not call.is_interesting:
@@ -86,6 +175,165 @@ class VCFVariantTable(VariantTable):
 
             yield call
 
+    @staticmethod
+    def _decoded_variant_calls(
+        variant: Variant,
+        sample_ids: tuple,
+        columns: Sequence[int],
+        decoded: DecodedCalls,
+        only_interesting: bool,
+    ):
+        # Which calls to build is worked out from the arrays, so no Call objects are made for skipped samples
+        data = decoded.data
+        gt_starts = decoded.gt_starts.tolist()
+        gt_ends = decoded.gt_ends.tolist()
+        genotype_types = decoded.genotype_types.tolist()
+        read_depths = decoded.read_depths.tolist()
+        phase_sets = decoded.phase_sets.tolist()
+
+        for i in (decoded.interesting if only_interesting else decoded.has_genotype).nonzero()[0].tolist():
+            # Parse the GT string too, so that calls share genotype tuples with ones parsed column by column
+            genotype, phased, _ = VCFVariantTable._parse_genotype(data[gt_starts[i]:gt_ends[i]])
+            yield Call(
+                variant=variant,
+                genotype=genotype,
+                phased=phased,
+                phase_set=None if phase_sets[i] == -1 else phase_sets[i],
+                sample_id=sample_ids[columns[i]],
+                read_depth=None if read_depths[i] == -1 else read_depths[i],
+                genotype_type=GENOTYPE_TYPES[genotype_types[i]],
+            )
+
+    @staticmethod
+    def _load_variant_calls(
+        sample_ids: tuple,
+        row: tuple,
+        only_interesting: bool,
+        sample_columns: Optional[Sequence[int]],
+        variant: Variant,
+    ) -> Tuple[Call, ...]:
+        return tuple(VCFVariantTable._variant_calls(variant, sample_ids, row, only_interesting=only_interesting,
+                                                    sample_columns=sample_columns))
+
+    @staticmethod
+    def _fetch_rows(
+        vcf: VCFFile,
+        chromosome: Optional[str],
+        start_min: Optional[int],
+        start_max: Optional[int],
+        interesting_columns: Optional[Sequence[int]] = None,
+    ) -> Iterable[tuple]:
+        """
+        Fetches rows starting in (or, for Tabix, overlapping) a region. If interesting_columns is specified, only rows
+        where the samples in those columns have interesting genotypes are needed; if the file has a sample index which
+        says there are fewer of those than rows in the region, only those rows are fetched.
+        """
+
+        sample_index = vcf.sample_index
+        if (interesting_columns is not None and sample_index is not None and
+                sample_index.max_records(interesting_columns) < vcf.estimate_rows(chromosome, start_min, start_max)):
+            return vcf.fetch_sample_rows(interesting_columns, chromosome, start_min, start_max)
+
+        if chromosome is None and start_min is None and start_max is None:
+            return vcf.fetch()
+
+        # TODO: pysam uses 0-based indexing, double-check
+        start = start_min - 1 if start_min is not None else 0
+        end = start_max - 1 if start_max is not None else MAX_SIGNED_INT_32
+
+        if chromosome is None:
+            # Position-only query; use the index for each contig rather than reading through the whole file
+            return vcf.fetch_all_contigs(start, end)
+
+        return vcf.fetch(chromosome, start, end)
+
+    @staticmethod
+    def _row_outside_start_bounds(row: tuple, start_min: Optional[int], start_max: Optional[int]) -> bool:
+        pos = int(row[1])
+        return (start_min is not None and pos < start_min) or (start_max is not None and pos >= start_max)
+
+    @staticmethod
+    def _row_has_carrier(row: tuple, alt_index: int) -> bool:
+        """
+        Scans the sample columns of a raw VCF row for any genotype containing the specified allele index, without
+        building any calls. Returns as soon as a carrier is found.
+        """
+
+        gt_pos = VCFVariantTable._format_layout(row[8])[0]
+        if gt_pos is None:
+            return False
+
+        for row_data in row[9:]:
+            if alt_index in VCFVariantTable._sample_genotype(row_data, gt_pos)[0]:
+                return True
+
+        return False
+
+    @staticmethod
+    def _row_may_be_interesting(row) -> bool:
+        """
+        Scans the raw text of a row's sample columns for any genotype which isn't missing or reference, without
+        splitting the row or building any calls. If this returns False, the row has no interesting calls; if it returns
+        True, it still needs to be parsed to find out.
+        """
+
+        if row[8].split(":", 1)[0] != VCF_GENOTYPE:
+            # GT should always come first, but if it doesn't, we can't tell without parsing the row
+            return True
+
+        # pysam rows give back their original line as a string, so the sample columns don't each need a string made
+        line = "\t".join(row) if isinstance(row, tuple) else str(row)
+        return REGEX_MAYBE_INTERESTING_GT.search(line, sum(map(len, row[:9])) + 8) is not None
+
+    @staticmethod
+    def _row_carriers(vcf: VCFFile, row, alt_index: Optional[int] = None) -> Optional[int]:
+        """
+        Looks up the carriers of a row's alternate allele (or of any alternate allele) in the file's carrier index, as a
+        bit mask of sample columns. Returns None if the file doesn't have a carrier index or the row isn't in it.
+        """
+        return None if vcf.carriers is None else vcf.carriers.carriers(row[0], int(row[1]), row[3], row[4], alt_index)
+
+    def _beacon_match(
+        self,
+        assembly_id: Optional[str],
+        chromosome: Optional[str],
+        start_min: Optional[int],
+        start_max: Optional[int],
+        end_min: Optional[int],
+        end_max: Optional[int],
+        ref: str,
+        alt: str,
+    ) -> bool:
+        for vcf in filter(lambda vf: assembly_id is None or vf.assembly_id == assembly_id, self._files):
+            try:
+                for row in self._fetch_rows(vcf, chromosome, start_min, start_max):
+                    if row[3] != ref:
+                        continue
+
+                    if chromosome is None and self._row_outside_start_bounds(row, start_min, start_max):
+                        continue
+
+                    end_pos = int(row[1]) + len(row[3])
+                    if (end_min is not None and end_pos < end_min) or (end_max is not None and end_pos > end_max):
+                        continue
+
+                    alt_alleles = row[4].split(",")
+                    if alt not in alt_alleles:
+                        continue
+
+                    # Genotype indices for alternate alleles start at 1 (0 is the reference allele)
+                    alt_index = alt_alleles.index(alt) + 1
+                    carriers = self._row_carriers(vcf, row, alt_index)
+                    if carriers if carriers is not None else self._row_has_carrier(row, alt_index):
+                        return True
+
+            except ValueError as e:
+                print(f"[{SERVICE_NAME}] [ERROR] Encountered ValueError: {e}", file=sys.stderr, flush=True)
+                print(f"[{SERVICE_NAME}] [ERROR]     In VCF: {repr(vcf)}", file=sys.stderr, flush=True)
+                continue
+
+        return False
+
     @property
     def files(self) -> Tuple[VCFFile]:
         return self._files
@@ -101,6 +349,52 @@ class VCFVariantTable(VariantTable):
             sample_set.update(vcf.sample_ids)
         return len(sample_set)
 
+    def estimate_search_work(
+        self,
+        assembly_id: Optional[str] = None,
+        chromosome: Optional[str] = None,
+        start_min: Optional[int] = None,
+        start_max: Optional[int] = None,
+    ) -> int:
+        # Each row has its fixed columns plus one column per sample which may need to be parsed
+        return sum(
+            vcf.estimate_rows(chromosome, start_min, start_max) * (len(vcf.sample_ids) + 1)
+            for vcf in self._files
+            if assembly_id is None or vcf.assembly_id == assembly_id
+        )
+
+    @property
+    def contig_routes(self) -> Set[ContigRoute]:
+        return {(vcf.assembly_id, normalize_chromosome(c)) for vcf in self._files for c in vcf.contig_extents}
+
+    def may_overlap(self, assembly_id: Optional[str], regions: RegionSet) -> bool:
+        return any(
+            vcf.may_overlap(*region)
+            for vcf in self._files
+            if assembly_id is None or vcf.assembly_id == assembly_id
+            for region in regions
+        )
+
+    def count_variants_in_regions(
+        self,
+        assembly_id: Optional[str],
+        regions: RegionSet,
+    ) -> Optional[Dict[Tuple[str, str], int]]:
+        counts = Counter()
+
+        for vcf in filter(lambda vf: assembly_id is None or vf.assembly_id == assembly_id, self._files):
+            for region in regions:
+                file_counts = vcf.count_rows(*region)
+                if file_counts is None:
+                    # Without a carrier / sample index, only whole contigs can be counted from the Tabix index
+                    return None
+
+                # Variants have their chromosome standardized, so counts should be too
+                for contig, n in file_counts.items():
+                    counts[(vcf.assembly_id, normalize_chromosome(contig))] += n
+
+        return dict(counts)
+
     def _variants(
         self,
         assembly_id: Optional[str] = None,
@@ -110,10 +404,17 @@ class VCFVariantTable(VariantTable):
         offset: Optional[int] = None,
         count: Optional[int] = None,
         only_interesting: bool = False,
+        sample_ids: Optional[AbstractSet[str]] = None,
+        call_sample_ids: Optional[AbstractSet[str]] = None,
+        interesting_rows: bool = False,
+        should_stop: Optional[Callable[[], bool]] = None,
     ) -> Generator[Variant, None, None]:
         # If offset isn't specified, set it to 0 (the very start)
         offset: int = 0 if offset is None else offset
 
+        # Rows without interesting calls are skipped either way; only_interesting also leaves out uninteresting calls
+        skip_uninteresting = only_interesting or interesting_rows
+
         variants_passed = 0
         variants_seen = 0
 
@@ -125,7 +426,7 @@ class VCFVariantTable(VariantTable):
                 chromosome is None and  # No filters (otherwise we wouldn't be able to assume we're skipping the VCF)
                 start_min is None and  # "
                 start_max is None and  # "
-                not only_interesting and  # "
+                not skip_uninteresting and  # "
                 vcf.n_of_variants <= offset - variants_seen
             ):
                 # If the entire file is covered by the remaining offset, skip it. This saves time crawling through an
@@ -134,21 +435,29 @@ class VCFVariantTable(VariantTable):
                 variants_seen += vcf.n_of_variants
                 continue
 
+            sample_columns = None if sample_ids is None else vcf.sample_columns(sample_ids)
+            if sample_columns is not None and not sample_columns:
+                # None of the requested samples are in the file, so there are no calls to look at
+                continue
+            # Bit mask of the requested samples' columns, to check carrier masks against
+            sample_columns_mask = None if sample_columns is None else sum(1 << c for c in sample_columns)
+
+            # Columns of the samples whose calls are wanted, looked up once per file rather than for every row
+            call_columns = None if call_sample_ids is None else vcf.sample_columns(call_sample_ids)
+
             try:
                 # TODO: Security of passing this? Verify values in non-Beacon searches
                 # TODO: What if the VCF includes telomeres (off the end)?]
 
-                # TODO: pysam uses 0-based indexing, double-check
+                rows = self._fetch_rows(
+                    vcf, chromosome, start_min, start_max, sample_columns if skip_uninteresting else None)
 
-                query = ()
-                if chromosome is not None:
-                    query = (
-                        chromosome,
-                        start_min - 1 if start_min is not None else 0,
-                        start_max - 1 if start_max is not None else MAX_SIGNED_INT_32,
-                    )
+                for row in rows:
+                    # Checked for every row, rather than every variant yielded, since most rows may be skipped without
+                    # yielding anything (e.g. uninteresting rows in joint-called cohorts.)
+                    if should_stop is not None and should_stop():
+                        return
 
-                for row in vcf.fetch(*query):
                     variants_passed += 1
 
                     if variants_passed <= offset:
@@ -157,14 +466,27 @@ class VCFVariantTable(VariantTable):
                     if count is not None and variants_seen >= count:
                         return
 
-                    if chromosome is None:
-                        # Didn't index in, so check start_min / start_max by hand
-                        if start_min is not None and int(row[1]) < start_min:
-                            continue
-                        elif start_max is not None and int(row[1]) >= start_max:
+                    if self._row_outside_start_bounds(row, start_min, start_max):
+                        # The row starts before the region but overlaps it, which Tabix includes; check start_min /
+                        # start_max by hand so each row belongs to only one region.
+                        continue
+
+                    row_columns = sample_columns
+
+                    if skip_uninteresting:
+                        # If the file has a carrier index, rows where one of the (requested) samples carries an
+                        # alternate allele are known to be interesting. Calls can be interesting without carrying one,
+                        # though (e.g. 0/., which is heterozygous), so any other row is still checked by scanning it.
+                        carriers = self._row_carriers(vcf, row)
+                        if carriers is not None and sample_columns_mask is not None:
+                            carriers &= sample_columns_mask
+
+                        if not carriers and not self._row_may_be_interesting(row):
+                            # Every sample is missing or reference (most rows in joint-called cohorts); no need to
+                            # parse it
                             continue
 
-                    alt_alleles = tuple(Allele(Allele.class_from_vcf(a), a) for a in row[4].split(","))
+                    alt_alleles = tuple(map(Allele.from_vcf, row[4].split(",")))
                     variant = Variant(
                         assembly_id=vcf.assembly_id,
                         chromosome=row[0],
@@ -175,12 +497,26 @@ class VCFVariantTable(VariantTable):
                         file_uri=vcf.original_index_uri,
                     )
 
-                    variant.calls = tuple(VCFVariantTable._variant_calls(variant, vcf.sample_ids, row,
-                                                                         only_interesting=only_interesting))
+                    # If we need to look at the calls to know whether to skip the variant, they're built right away
+                    build_calls = skip_uninteresting or row_columns is not None
 
-                    if only_interesting and len(variant.calls) == 0:
-                        # Uninteresting; no calls of note on the variant
-                        continue
+                    calls_loader = partial(VCFVariantTable._load_variant_calls, vcf.sample_ids, row,
+                                           only_interesting, row_columns if build_calls else call_columns)
+
+                    if build_calls:
+                        variant.calls = calls_loader(variant)
+                        if len(variant.calls) == 0 or (
+                                interesting_rows and not any(c.is_interesting for c in variant.calls)):
+                            # Uninteresting, or none of the requested samples have calls; no calls of note
+                            continue
+
+                        if call_sample_ids is not None:
+                            variant.calls = tuple(c for c in variant.calls if c.sample_id in call_sample_ids)
+
+                    else:
+                        # Otherwise, only parse the sample columns (of just the samples whose calls are wanted, if
+                        # specified) if someone actually looks at the calls
+                        variant.load_calls_lazily(calls_loader)
 
                     yield variant
 
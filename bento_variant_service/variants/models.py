@@ -1,5 +1,7 @@
+from collections import namedtuple
 from enum import Enum
-from typing import Optional, Tuple, Union
+from functools import lru_cache
+from typing import AbstractSet, Callable, Iterable, Optional, Tuple, Union
 from . import genotypes as gt
 
 
@@ -9,6 +11,12 @@ __all__ = [
     "Variant",
     "Call",
 
+    "VARIANT_FIELDS",
+    "CALL_FIELDS",
+    "Projection",
+    "FULL_PROJECTION",
+    "parse_projection",
+
     "VCF_MISSING_VAL",
     "VCF_MISSING_UPSTREAM_VAL",
     "ALLELE_MISSING",
@@ -27,7 +35,53 @@ VCF_MISSING_VAL = "."
 VCF_MISSING_UPSTREAM_VAL = "*"
 
 
+# Fields of variant / call representations, in the order they're given in
+VARIANT_FIELDS = ("assembly_id", "chromosome", "start", "end", "ref", "alt", "qual", "calls")
+CALL_FIELDS = ("sample_id", "genotype_alleles", "genotype_type", "phased", "phase_set")
+
+# Subset of fields to include in variant representations, and in the representations of their calls if "calls" is one
+# of the variant fields. If sample_ids is not None, only calls for those samples are included.
+Projection = namedtuple("Projection", ("variant_fields", "call_fields", "sample_ids"))
+FULL_PROJECTION = Projection(frozenset(VARIANT_FIELDS), frozenset(CALL_FIELDS), None)
+
+
+def parse_projection(fields: Optional[Iterable[str]], sample_ids: Optional[AbstractSet[str]] = None) -> Projection:
+    """
+    Parses a list of fields to include in variant representations, e.g. ["chromosome", "start", "calls.sample_id"].
+    "calls" includes every call field, while "calls.<field>" includes calls with only the fields listed. If fields is
+    None, every field is included. Raises a ValueError for any field which isn't part of the representation.
+    """
+
+    if fields is None:
+        return FULL_PROJECTION._replace(sample_ids=None if sample_ids is None else frozenset(sample_ids))
+
+    variant_fields = set()
+    call_fields = set()
+
+    for field in fields:
+        if field in VARIANT_FIELDS:
+            variant_fields.add(field)
+            if field == "calls":
+                call_fields.update(CALL_FIELDS)
+        elif field.startswith("calls.") and field[6:] in CALL_FIELDS:
+            variant_fields.add("calls")
+            call_fields.add(field[6:])
+        else:
+            raise ValueError(f"Invalid field: {field}")
+
+    return Projection(
+        frozenset(variant_fields), frozenset(call_fields), None if sample_ids is None else frozenset(sample_ids))
+
+
+# Maximum number of distinct allele strings to keep shared Allele instances for (per process)
+ALLELE_CACHE_SIZE = 4096
+
+
 class Allele:
+    # Alleles are created for every variant and referenced by every call, so keep them small and share them where we
+    # can (see from_vcf.) Shared instances must not be modified.
+    __slots__ = ("allele_class", "value")
+
     def __init__(self, allele_class: AlleleClass, value: Optional[str]):
         self.allele_class: AlleleClass = allele_class
         self.value: Optional[str] = value  # Include angle brackets here for extra clarity / unambiguity
@@ -67,12 +121,37 @@ class Allele:
         else:
             return AlleleClass.SEQUENCE
 
+    @staticmethod
+    @lru_cache(maxsize=ALLELE_CACHE_SIZE)
+    def from_vcf(allele: str) -> "Allele":
+        """
+        Gets an Allele for a VCF allele string. Instances are shared between all variants with the same allele.
+        """
+        if allele == VCF_MISSING_VAL:
+            return ALLELE_MISSING
+        elif allele == VCF_MISSING_UPSTREAM_VAL:
+            return ALLELE_MISSING_UPSTREAM
+        return Allele(Allele.class_from_vcf(allele), allele)
+
 
 class Variant:
     """
     Instance of a particular variant and all calls made.
     """
 
+    __slots__ = (
+        "assembly_id",
+        "chromosome",
+        "ref_bases",
+        "alt_alleles",
+        "start_pos",
+        "qual",
+        "_calls",
+        "_calls_loader",
+        "file_uri",
+        "_genotype_alleles",
+    )
+
     def __init__(self, assembly_id: str, chromosome: str, ref_bases: str, alt_alleles: Tuple[Allele, ...],
                  start_pos: int, qual: Optional[float] = None, calls: Tuple["Call"] = (),
                  file_uri: Optional[str] = None):
@@ -82,14 +161,65 @@ class Variant:
         self.alt_alleles: Tuple[Allele, ...] = alt_alleles  # Alternate alleles - tuple makes them comparable
         self.start_pos: int = start_pos  # Starting position on the chromosome w/r/t the reference, 0-indexed
         self.qual: Optional[float] = qual  # Quality score for "assertion made by alt"
-        self.calls: Tuple["Call"] = calls  # Variant calls, per sample  TODO: Make this a dict?
+
+        # Variant calls, per sample  TODO: Make this a dict?
+        #  - If a loader is set, calls haven't been built yet and will be built from it the first time they're accessed
+        self._calls: Tuple["Call", ...] = calls
+        self._calls_loader: Optional[Callable[["Variant"], Tuple["Call", ...]]] = None
 
         self.file_uri: Optional[str] = file_uri  # File URI, "
 
+        # Alleles of each distinct genotype of the variant's calls, built the first time a call's alleles are needed
+        self._genotype_alleles: Optional[dict] = None
+
+    @property
+    def calls(self) -> Tuple["Call", ...]:
+        if self._calls_loader is not None:
+            self._calls = self._calls_loader(self)
+            self._calls_loader = None
+        return self._calls
+
+    @calls.setter
+    def calls(self, calls: Tuple["Call", ...]):
+        self._calls = calls
+        self._calls_loader = None
+
+    def load_calls_lazily(self, loader: Callable[["Variant"], Tuple["Call", ...]]):
+        """
+        Defers building the variant's calls until they're needed, e.g. so that raw sample data doesn't get parsed for
+        consumers which only look at the position and alleles. The loader gets called with the variant.
+        """
+        self._calls = ()
+        self._calls_loader = loader
+
     @property
     def ref_allele(self) -> Allele:
         # Ref alleles have to be bases to my knowledge
-        return Allele(AlleleClass.SEQUENCE, self.ref_bases)
+        return Allele.from_vcf(self.ref_bases)
+
+    def _genotype_allele(self, g) -> Allele:
+        if g == VCF_MISSING_VAL:
+            return ALLELE_MISSING
+        elif g == VCF_MISSING_UPSTREAM_VAL:
+            return ALLELE_MISSING_UPSTREAM
+        elif g == 0:
+            return self.ref_allele
+        else:
+            return self.alt_alleles[g - 1]
+
+    def genotype_alleles(self, genotype: Tuple[Union[int, str], ...]) -> Tuple[Allele, ...]:
+        """
+        Alleles of a genotype of one of the variant's calls. A variant's calls only have a handful of distinct genotypes
+        between them, so the alleles of each are built once and shared by every call with that genotype.
+        """
+
+        if self._genotype_alleles is None:
+            self._genotype_alleles = {}
+
+        alleles = self._genotype_alleles.get(genotype)
+        if alleles is None:
+            alleles = self._genotype_alleles[genotype] = tuple(map(self._genotype_allele, genotype))
+        return alleles
 
     @property
     def end_pos(self) -> int:
@@ -98,7 +228,12 @@ class Variant:
         """
         return self.start_pos + len(self.ref_bases)
 
-    def as_chord_representation(self):
+    def as_chord_representation(self, include_calls: bool = True, projection: Optional[Projection] = None):
+        # Leaving out calls saves building them, but means the representation does not match the variant schema. The
+        # same goes for projections: calls are only built if they're part of the projection.
+        if projection is not None:
+            return self._projected_chord_representation(include_calls, projection)
+
         return {
             "assembly_id": self.assembly_id,
             "chromosome": self.chromosome,
@@ -107,12 +242,41 @@ class Variant:
             "ref": self.ref_bases,
             "alt": [a.value for a in self.alt_alleles],  # TODO: Include both value and class here?
             "qual": self.qual,
-            "calls": [c.as_chord_representation() for c in self.calls],
+            **({"calls": [c.as_chord_representation() for c in self.calls]} if include_calls else {}),
         }
 
-    def as_augmented_chord_representation(self):
+    def _projected_chord_representation(self, include_calls: bool, projection: Projection) -> dict:
+        fields = projection.variant_fields
+        r = {}
+
+        # Same order as in the full representation
+        if "assembly_id" in fields:
+            r["assembly_id"] = self.assembly_id
+        if "chromosome" in fields:
+            r["chromosome"] = self.chromosome
+        if "start" in fields:
+            r["start"] = self.start_pos
+        if "end" in fields:
+            r["end"] = self.end_pos
+        if "ref" in fields:
+            r["ref"] = self.ref_bases
+        if "alt" in fields:
+            r["alt"] = [a.value for a in self.alt_alleles]
+        if "qual" in fields:
+            r["qual"] = self.qual
+        if include_calls and "calls" in fields:
+            sample_ids = projection.sample_ids
+            r["calls"] = [
+                c.as_chord_representation(projection=projection)
+                for c in self.calls
+                if sample_ids is None or c.sample_id in sample_ids
+            ]
+
+        return r
+
+    def as_augmented_chord_representation(self, include_calls: bool = True, projection: Optional[Projection] = None):
         return {
-            **self.as_chord_representation(),
+            **self.as_chord_representation(include_calls=include_calls, projection=projection),
             # _ prefix is context dependent -> immune from equality, used by Bento in weird contexts
             "_extra": {
                 "file_uri": self.file_uri,
@@ -142,54 +306,67 @@ class Call:
     Instance of a called variant on a particular sample.
     """
 
-    def _genotype_to_allele(self, g) -> Allele:
-        if g == VCF_MISSING_VAL:
-            return ALLELE_MISSING
-        elif g == VCF_MISSING_UPSTREAM_VAL:
-            return ALLELE_MISSING_UPSTREAM
-        elif g == 0:
-            return self.variant.ref_allele
-        else:
-            return self.variant.alt_alleles[g - 1]
+    __slots__ = (
+        "variant",
+        "sample_id",
+        "genotype",
+        "phased",
+        "phase_set",
+        "read_depth",
+        "genotype_type",
+    )
 
     # TODO: py3.8: More refined typing for genotype: Tuple[Union[int, Literal["*"], Literal["."]], ...]
 
     def __init__(self, variant: Variant, sample_id: str, genotype: Tuple[Union[int, str], ...],
-                 phased: bool = False, phase_set: Optional[int] = None, read_depth: Optional[int] = None):
+                 phased: bool = False, phase_set: Optional[int] = None, read_depth: Optional[int] = None,
+                 genotype_type: Optional[str] = None):
         self.variant: Variant = variant
         self.sample_id: str = sample_id
         self.genotype: Tuple[Union[int, str], ...] = genotype
-        self.genotype_alleles: Tuple[Allele, ...] = tuple(map(self._genotype_to_allele, genotype))
         self.phased: bool = phased
         self.phase_set: Optional[int] = phase_set if phased else None  # Should be ignored if phased
         self.read_depth: Optional[int] = read_depth
 
+        # Genotype type can be passed in if it's already known, e.g. from a cache of parsed genotypes
+        self.genotype_type: str = genotype_type if genotype_type is not None else self.genotype_type_of(genotype)
+
+    @staticmethod
+    def genotype_type_of(genotype: Tuple[Union[int, str], ...]) -> str:
         if len(genotype) == 0:
             raise ValueError("Calls must have a genotype length of 1 or more")
 
         if genotype[0] == VCF_MISSING_VAL:
             # Missing call
-            genotype_type = gt.GT_MISSING
+            return gt.GT_MISSING
         elif genotype[0] == VCF_MISSING_UPSTREAM_VAL:
             # Missing call due to an upstream deletion
-            genotype_type = gt.GT_MISSING_UPSTREAM_DELETION
-        elif len(self.genotype) == 1:
-            genotype_type = gt.GT_REFERENCE if self.genotype[0] == 0 else gt.GT_ALTERNATE
-        else:  # len(self.genotype) > 1; not haploid
-            genotype_type = gt.GT_HOMOZYGOUS_ALTERNATE
-            if len(set(self.genotype)) > 1:
-                genotype_type = gt.GT_HETEROZYGOUS
-            elif self.genotype[0] == 0:
-                # all elements are 0 if 0 is the first element and the length of the set is 1
-                genotype_type = gt.GT_HOMOZYGOUS_REFERENCE
-
-        self.genotype_type = genotype_type
+            return gt.GT_MISSING_UPSTREAM_DELETION
+        elif len(genotype) == 1:
+            return gt.GT_REFERENCE if genotype[0] == 0 else gt.GT_ALTERNATE
+
+        # len(genotype) > 1; not haploid
+        if len(set(genotype)) > 1:
+            return gt.GT_HETEROZYGOUS
+        elif genotype[0] == 0:
+            # all elements are 0 if 0 is the first element and the length of the set is 1
+            return gt.GT_HOMOZYGOUS_REFERENCE
+        return gt.GT_HOMOZYGOUS_ALTERNATE
+
+    @property
+    def genotype_alleles(self) -> Tuple[Allele, ...]:
+        # Shared between the variant's calls rather than stored on each one, since there may be millions of calls in
+        # memory
+        return self.variant.genotype_alleles(self.genotype)
 
     @property
     def is_interesting(self):
         return self.genotype_type not in gt.GT_UNINTERESTING_CALLS
 
-    def as_chord_representation(self, include_variant: bool = False):
+    def as_chord_representation(self, include_variant: bool = False, projection: Optional[Projection] = None):
+        if projection is not None:
+            return self._projected_chord_representation(include_variant, projection)
+
         return {
             "sample_id": self.sample_id,
             "genotype_alleles": [a.value for a in self.genotype_alleles],  # TODO: Include allele class?
@@ -199,6 +376,25 @@ class Call:
             **(self.variant.as_chord_representation() if include_variant else {}),
         }
 
+    def _projected_chord_representation(self, include_variant: bool, projection: Projection) -> dict:
+        fields = projection.call_fields
+        r = {}
+
+        if "sample_id" in fields:
+            r["sample_id"] = self.sample_id
+        if "genotype_alleles" in fields:
+            r["genotype_alleles"] = [a.value for a in self.genotype_alleles]
+        if "genotype_type" in fields:
+            r["genotype_type"] = self.genotype_type
+        if "phased" in fields:
+            r["phased"] = self.phased
+        if "phase_set" in fields:
+            r["phase_set"] = self.phase_set
+        if include_variant:
+            r.update(self.variant.as_chord_representation(projection=projection))
+
+        return r
+
     def eq_no_variant_check(self, other):
         # Use and shortcutting to return False early if the other instance isn't a Call
         return isinstance(other, Call) and all((
@@ -0,0 +1,123 @@
+import math
+
+from collections import namedtuple
+from itertools import groupby
+from typing import Iterable, List, Optional, Tuple
+
+
+__all__ = [
+    "Region",
+    "RegionSet",
+    "WHOLE_GENOME",
+
+    "normalize_chromosome",
+    "region_is_empty",
+    "intersect_regions",
+    "intersect_region_sets",
+    "union_region_sets",
+    "normalize_regions",
+]
+
+
+# Region of the genome which variant start positions can fall in. Coordinates are the same as elsewhere in the service:
+# start_min is inclusive and start_max is exclusive. None means unbounded (or, for chromosome, any chromosome.)
+Region = namedtuple("Region", ("chromosome", "start_min", "start_max"))
+
+# Normalized set of regions: sorted and non-overlapping, so that no variant start position falls in more than one.
+RegionSet = Tuple[Region, ...]
+
+WHOLE_GENOME = Region(None, None, None)
+
+
+def normalize_chromosome(chromosome: str) -> str:
+    # Contigs may or may not have a chr prefix depending on where they came from; e.g. chr1 and 1 are the same contig.
+    return chromosome[3:] if chromosome.startswith("chr") else chromosome
+
+
+def _bounds(region: Region) -> Tuple[float, float]:
+    return (
+        -math.inf if region.start_min is None else region.start_min,
+        math.inf if region.start_max is None else region.start_max,
+    )
+
+
+def _region_from_bounds(chromosome: Optional[str], start_min: float, start_max: float) -> Region:
+    return Region(
+        chromosome,
+        None if start_min == -math.inf else int(start_min),
+        None if start_max == math.inf else int(start_max),
+    )
+
+
+def region_is_empty(region: Region) -> bool:
+    start_min, start_max = _bounds(region)
+    return start_min >= start_max
+
+
+def intersect_regions(a: Region, b: Region) -> Optional[Region]:
+    # Differently-prefixed names for the same contig (e.g. chr1 and 1) don't contradict each other
+    if (a.chromosome is not None and b.chromosome is not None and
+            normalize_chromosome(str(a.chromosome)) != normalize_chromosome(str(b.chromosome))):
+        return None
+
+    (a_min, a_max), (b_min, b_max) = _bounds(a), _bounds(b)
+    region = _region_from_bounds(a.chromosome if a.chromosome is not None else b.chromosome,
+                                 max(a_min, b_min), min(a_max, b_max))
+    return None if region_is_empty(region) else region
+
+
+def _merge_bounds(bounds: Iterable[Tuple[float, float]]) -> List[Tuple[float, float]]:
+    merged: List[Tuple[float, float]] = []
+    for start_min, start_max in sorted(bounds):
+        if merged and start_min <= merged[-1][1]:  # Overlapping or adjacent
+            merged[-1] = (merged[-1][0], max(merged[-1][1], start_max))
+        else:
+            merged.append((start_min, start_max))
+    return merged
+
+
+def _subtract_bounds(bounds: Tuple[float, float], others: List[Tuple[float, float]]) -> List[Tuple[float, float]]:
+    # others must be sorted and non-overlapping, e.g. from _merge_bounds
+    pieces = []
+    start_min, start_max = bounds
+    for o_min, o_max in others:
+        if o_max <= start_min or o_min >= start_max:
+            continue
+        if o_min > start_min:
+            pieces.append((start_min, o_min))
+        start_min = max(start_min, o_max)
+    if start_min < start_max:
+        pieces.append((start_min, start_max))
+    return pieces
+
+
+def normalize_regions(regions: Iterable[Region]) -> RegionSet:
+    """
+    Turns any collection of regions into a sorted set of non-overlapping regions covering the same positions. Ranges
+    which apply to any chromosome are removed from the chromosome-specific regions, so nothing is fetched twice.
+    Regions on differently-prefixed names for the same contig (e.g. chr1 and 1) are merged, under whichever name sorts
+    first.
+    """
+
+    regions = [r for r in regions if not region_is_empty(r)]
+
+    any_chromosome = _merge_bounds(_bounds(r) for r in regions if r.chromosome is None)
+    normalized = [_region_from_bounds(None, *b) for b in any_chromosome]
+
+    specific = sorted((r for r in regions if r.chromosome is not None),
+                      key=lambda r: (normalize_chromosome(str(r.chromosome)), str(r.chromosome)))
+    for _, contig_regions in groupby(specific, key=lambda r: normalize_chromosome(str(r.chromosome))):
+        contig_regions = list(contig_regions)
+        chromosome = contig_regions[0].chromosome
+        for b in _merge_bounds(_bounds(r) for r in contig_regions):
+            normalized.extend(_region_from_bounds(chromosome, *p) for p in _subtract_bounds(b, any_chromosome))
+
+    return tuple(normalized)
+
+
+def intersect_region_sets(a: RegionSet, b: RegionSet) -> RegionSet:
+    return normalize_regions(filter(None, (intersect_regions(ra, rb) for ra in a for rb in b)))
+
+
+def union_region_sets(a: RegionSet, b: RegionSet) -> RegionSet:
+    return normalize_regions((*a, *b))
@@ -267,6 +267,14 @@ VARIANT_TABLE_METADATA_SCHEMA = {
         "updated": {
             "type": "string",
             "chord_autogenerated": True  # TODO: Extend schema
-        }
+        },
+        "sample_sets": {
+            "type": "object",
+            "description": "Named sets of sample IDs (e.g. cohort subsets) which calls can be limited to.",
+            "additionalProperties": {
+                "type": "array",
+                "items": {"type": "string"},
+            },
+        },
     }
 }
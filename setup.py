@@ -23,6 +23,10 @@ setuptools.setup(
         "requests>=2.26.0,<3.0",
         "requests_unixsocket>=0.2.0,<0.3.0",
     ],
+    extras_require={
+        # Faster decoding of VCF rows with many samples
+        "numpy": ["numpy>=1.19"],
+    },
 
     author=config["package"]["authors"],
     author_email=config["package"]["author_emails"],
@@ -1,10 +1,17 @@
 import json
+import os
 import pytest
 import requests
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 from bento_variant_service import table_manager as tm
 from bento_variant_service.app import create_app
 
+from .shared_data import VCF_TEN_VAR_FILE_PATH, VCF_TEN_VAR_INDEX_FILE_PATH
+
 
 @pytest.fixture
 def app():
@@ -26,7 +33,14 @@ def uninitialized_app():
 
 
 @pytest.fixture
-def app_vcf_mode(tmpdir):
+def index_build_executor():
+    executor = ThreadPoolExecutor(max_workers=1)
+    yield executor
+    executor.shutdown()
+
+
+@pytest.fixture
+def app_vcf_mode(tmpdir, index_build_executor):
     data_path = tmpdir / "vcf_data"
     data_path.mkdir()
 
@@ -35,6 +49,7 @@ def app_vcf_mode(tmpdir):
         "TESTING": True,
         "DATA_PATH": str(data_path),
         "TABLE_MANAGER": tm.MANAGER_TYPE_VCF,
+        "INDEX_BUILD_EXECUTOR": index_build_executor,
     })
 
 
@@ -70,6 +85,40 @@ def drs_table_manager(app_drs_mode):
         yield tm.get_table_manager()
 
 
+@pytest.fixture()
+def make_memory_table(table_manager):
+    """
+    Creates memory tables named test (with ID fixed_id) holding the variants passed.
+    """
+
+    def create(*variants, metadata: Optional[dict] = None):
+        table = table_manager.create_table_and_update("test", metadata or {})
+        table.variant_store.extend(variants)
+        return table
+
+    return create
+
+
+@pytest.fixture()
+def make_vcf_table(vcf_table_manager):
+    """
+    Creates VCF tables named test with ten_variants_22.vcf.gz (and its Tabix index) added as test.vcf.gz.
+    """
+
+    def create(metadata: Optional[dict] = None):
+        table = vcf_table_manager.create_table_and_update("test", metadata or {})
+
+        vcf_path = os.path.join(vcf_table_manager.data_path, table.table_id, "test.vcf.gz")
+        shutil.copyfile(VCF_TEN_VAR_FILE_PATH, vcf_path)
+        shutil.copyfile(VCF_TEN_VAR_INDEX_FILE_PATH, f"{vcf_path}.tbi")
+
+        # Update to register the new files
+        vcf_table_manager.update_tables()
+        return table
+
+    return create
+
+
 @pytest.fixture
 def client(app):
     yield app.test_client()
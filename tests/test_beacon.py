@@ -1,19 +1,14 @@
-import os
-import shutil
-
 from jsonschema import validate
 from uuid import uuid4
 
 from bento_variant_service.beacon.routes import generate_beacon_id
 from bento_variant_service.beacon.datasets import make_beacon_dataset_id
-from bento_variant_service.pool import get_pool, teardown_pool
+from bento_variant_service.metrics import clear_metrics, get_metrics
+from bento_variant_service.pool import shutdown_pool
 from bento_variant_service.tables.memory import MemoryTableManager
 from bento_variant_service.tables.vcf.vcf_manager import VCFTableManager
 
 from .shared_data import (
-    VCF_TEN_VAR_FILE_PATH,
-    VCF_TEN_VAR_INDEX_FILE_PATH,
-
     VARIANT_1,
     VARIANT_2,
     VARIANT_3,
@@ -238,6 +233,14 @@ BEACON_REQUEST_1 = {
     "end": 5000,  # "
 }
 
+BEACON_REQUEST_CONTRADICTORY = {  # end bounds cannot be reached with a reference allele of length 1
+    **SHARED_REQUEST_BASE,
+    "referenceBases": "C",
+    "alternateBases": "T",
+    "start": 4999,  # 0-based coordinates
+    "endMin": 5100,  # "
+}
+
 BEACON_REQUEST_2 = {  # test inference of startMax
     **SHARED_REQUEST_BASE,
     "referenceBases": "C",
@@ -346,8 +349,6 @@ def test_beacon_response(app, client, table_manager):
     # Add a dummy dataset first (beacon API needs one or more datasets)
 
     with app.app_context():
-        pool = get_pool()
-
         try:
             mm: MemoryTableManager = table_manager
 
@@ -439,6 +440,16 @@ def test_beacon_response(app, client, table_manager):
                     assert not data["exists"]
                     assert len(data["datasetAlleleResponses"]) == 0
 
+            # Test contradictory bounds, which should be answered without searching anything
+
+            clear_metrics()
+            rv = client.post("/beacon/query", json=BEACON_REQUEST_CONTRADICTORY)
+            assert rv.status_code == 200
+            data = rv.get_json()
+            validate(data, BEACON_ALLELE_RESPONSE_SCHEMA)
+            assert not data["exists"]
+            assert get_metrics()["counters"] == {"searches_empty": 1, "beacon_queries_executed": 1}
+
             # Test different includeDatasetResponses values
 
             br_all = {
@@ -496,22 +507,30 @@ def test_beacon_response(app, client, table_manager):
             assert len(data["datasetAlleleResponses"]) == 0
 
         finally:
-            teardown_pool(None)
-            pool.join()
+            shutdown_pool()
 
 
 # noinspection DuplicatedCode
-def test_vcf_beacon(vcf_table_manager):
+def test_vcf_beacon(vcf_table_manager, make_vcf_table):
     vm: VCFTableManager = vcf_table_manager
 
-    # Create a new table named test
-    t = vm.create_table_and_update("test", {})
-
-    # Add ten_variants_22.vcf.gz
-    shutil.copyfile(VCF_TEN_VAR_FILE_PATH, os.path.join(vm.data_path, t.table_id, "test.vcf.gz"))
-    shutil.copyfile(VCF_TEN_VAR_INDEX_FILE_PATH, os.path.join(vm.data_path, t.table_id, "test.vcf.gz.tbi"))
-
-    vm.update_tables()
+    # Create a new table named test, with ten_variants_22.vcf.gz
+    t = make_vcf_table()
 
     assert len(t.beacon_datasets) == 1
     assert len(vm.beacon_datasets) == 1
+
+    # Beacon matching against the raw VCF rows
+
+    assert t.beacon_match("GRCh37", "22", 16050075, 16050076, None, None, "A", "G")
+    assert t.beacon_match("GRCh37", "22", 16050075, 16050076, 16050076, 16050076, "A", "G")
+    assert not t.beacon_match("GRCh37", "22", 16050075, 16050076, 16050077, None, "A", "G")  # End too small
+    assert not t.beacon_match("GRCh37", "22", 16050075, 16050076, None, None, "A", "T")  # Wrong alt
+    assert not t.beacon_match("GRCh37", "22", 16050075, 16050076, None, None, "C", "G")  # Wrong ref
+    assert not t.beacon_match("GRCh38", "22", 16050075, 16050076, None, None, "A", "G")  # Wrong assembly
+    assert not t.beacon_match("GRCh37", "21", 16050075, 16050076, None, None, "A", "G")  # Wrong chromosome
+
+    # - Multi-allelic row; carriers of the 4th alternate allele exist
+    assert t.beacon_match("GRCh37", "22", 16050654, 16050655, None, None, "A", "<CN4>")
+    assert t.beacon_match("GRCh37", None, 16050654, 16050655, None, None, "A", "<CN4>")
+    assert not t.beacon_match("GRCh37", None, 16050655, None, None, None, "A", "<CN4>")
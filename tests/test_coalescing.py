@@ -0,0 +1,92 @@
+import threading
+import time
+
+from bento_variant_service.coalescing import SingleFlight
+from bento_variant_service.metrics import clear_metrics, get_metrics
+
+
+def _wait_for(condition):
+    started = time.time()
+    while not condition():
+        assert time.time() - started < 10
+        time.sleep(0.01)
+
+
+def _n_coalesced(name: str) -> int:
+    return get_metrics()["counters"].get(f"{name}_coalesced", 0)
+
+
+def _run_concurrently(flight: SingleFlight, call, n: int, release: threading.Event) -> list:
+    # Makes n concurrent calls, only letting the first one finish once the rest have joined its flight
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(call())) for _ in range(n)]
+    for t in threads:
+        t.start()
+
+    _wait_for(lambda: _n_coalesced(flight.name) == n - 1)
+    release.set()
+
+    for t in threads:
+        t.join()
+
+    return results
+
+
+def test_single_flight_do():
+    clear_metrics()
+
+    flight = SingleFlight("test", timeout=10)
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        release.wait(10)
+        return len(calls)
+
+    assert _run_concurrently(flight, lambda: flight.do("key", slow), 4, release) == [1, 1, 1, 1]
+    assert len(calls) == 1
+
+    metrics = get_metrics()
+    assert metrics["counters"] == {"test_executed": 1, "test_coalesced": 3}
+    assert metrics["gauges"] == {"test_coalescing_ratio": 0.75}
+
+    # Calls made once the flight is done run again
+    assert flight.do("key", slow) == 2
+    assert flight.do("other_key", lambda: "other") == "other"
+    assert get_metrics()["counters"]["test_executed"] == 3
+
+
+def test_single_flight_failure():
+    clear_metrics()
+
+    flight = SingleFlight("test_failure", timeout=10)
+    release = threading.Event()
+    calls = []
+
+    def fail_first():
+        calls.append(1)
+        if len(calls) == 1:
+            release.wait(10)
+            raise ValueError("failed")
+        return "ok"
+
+    def call():
+        try:
+            return flight.do("key", fail_first)
+        except ValueError:
+            return "error"
+
+    # Only the leader gets the error; everyone waiting on it makes the call themselves
+    assert sorted(_run_concurrently(flight, call, 3, release)) == ["error", "ok", "ok"]
+    assert len(calls) == 3
+
+    # Waiting on a flight gives up after the timeout
+    flight = SingleFlight("test_timeout", timeout=0.01)
+    release = threading.Event()
+    leader = threading.Thread(target=lambda: flight.do("key", lambda: release.wait(10)))
+    leader.start()
+    _wait_for(lambda: get_metrics()["counters"].get("test_timeout_executed") == 1)
+    assert flight.do("key", lambda: "own result") == "own result"
+    release.set()
+    leader.join()
@@ -134,7 +134,7 @@ def test_ingest_vcf_missing_files(client_vcf_mode):
     assert rv.status_code == 204
 
 
-def test_ingest_vcf_valid(tmpdir, client_vcf_mode, vcf_table_manager: VCFTableManager):
+def test_ingest_vcf_valid(tmpdir, client_vcf_mode, vcf_table_manager: VCFTableManager, index_build_executor):
     t = _create_dummy_table(client_vcf_mode)
 
     data_path = tmpdir / "data_to_ingest"
@@ -162,6 +162,11 @@ def test_ingest_vcf_valid(tmpdir, client_vcf_mode, vcf_table_manager: VCFTableMa
 
     assert len(list(vcf_table_manager.get_table(t["id"]).variants())) == 10
 
+    # Carrier and sample indices are built for the ingested file, in the background
+    index_build_executor.shutdown(wait=True)
+    assert vcf_table_manager.get_table(t["id"]).files[0].carriers is not None
+    assert vcf_table_manager.get_table(t["id"]).files[0].sample_index is not None
+
 
 @responses.activate
 def test_ingest_vcf_valid_drs(client_drs_mode, drs_table_manager: DRSVCFTableManager):
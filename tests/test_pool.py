@@ -1,10 +1,23 @@
-from flask import g
+import time
+
 from multiprocessing import Pool
+from multiprocessing.dummy import Pool as ThreadPool
+
+from bento_variant_service import pool as pool_module
+from bento_variant_service.pool import (
+    WORKERS,
+    acquire_pool,
+    get_worker_table,
+    shutdown_pool,
+    snapshot_tables,
+    worker_cancelled,
+)
+from bento_variant_service.tables.memory import MemoryVariantTable
 
-from bento_variant_service.pool import WORKERS, get_pool, teardown_pool
+from .shared_data import VARIANT_1
 
 
-def test_pool_init(app):
+def test_pool_init():
     try:
         # noinspection PyUnresolvedReferences
         from pytest_cov.embed import cleanup_on_sigterm
@@ -15,31 +28,228 @@ def test_pool_init(app):
 
     dummy_pool = Pool(processes=WORKERS)
 
-    with app.app_context():
-        pool = get_pool()
+    try:
+        lease = acquire_pool({}, ())
+        pool = lease.pool
         assert isinstance(pool, type(dummy_pool))
 
-        pool2 = get_pool()
-        assert pool2 == pool
+        # The pool is shared by searches, and outlives each of them
+        lease_2 = acquire_pool({}, ())
+        assert lease_2.pool == pool
+        lease.release()
+        lease_2.release()
+        lease_2.release()  # Releasing twice doesn't do anything
 
-        pool.close()
+        lease = acquire_pool({}, ())
+        assert lease.pool == pool
+        lease.release()
+    finally:
+        shutdown_pool()
         pool.join()
+        dummy_pool.close()
+        dummy_pool.join()
 
-    dummy_pool.close()
-    dummy_pool.join()
 
+def test_pool_shut_down():
+    lease = acquire_pool({}, ())
+    pool = lease.pool
 
-def test_pool_tear_down(app):
-    dummy_pool = Pool(processes=WORKERS)
+    # The pool keeps working for searches still using it
+    shutdown_pool()
+    assert pool.apply_async(sum, ((1, 2),)).get(timeout=15) == 3
+    lease.release()
+    pool.join()
 
+    lease = acquire_pool({}, ())
     try:
-        with app.app_context():
-            pool = get_pool()
-            assert isinstance(pool, type(dummy_pool))
+        assert lease.pool != pool
+    finally:
+        lease.release()
+        shutdown_pool()
+        lease.pool.join()
+
+
+def _worker_table_name(table_ref):
+    return get_worker_table(table_ref).name
+
+
+def test_pool_tables():
+    table = MemoryVariantTable("fixed_id", "test table", {})
+    other_table = MemoryVariantTable("other_id", "other table", {})
+
+    lease = acquire_pool(snapshot_tables((table, other_table)), (table.table_id,))
+    pool = lease.pool
+
+    try:
+        assert lease.pool.map(_worker_table_name, [lease.table_ref(table.table_id)]) == ["test table"]
+        lease.release()
+
+        # Nothing changed, so the pool should be re-used
+        lease = acquire_pool(snapshot_tables((table, other_table)), (table.table_id,))
+        assert lease.pool == pool
+        lease.release()
+
+        # Tables which aren't being searched don't need to be up-to-date in the pool's registry
+        other_table.add_variant(VARIANT_1)
+        lease = acquire_pool(snapshot_tables((table, other_table)), (table.table_id,))
+        assert lease.pool == pool
+        lease.release()
 
-            teardown_pool(None)
-            pool.join()
-            assert "pool" not in g
+        old_generation = table.generation
+        table.add_variant(VARIANT_1)
+        assert table.generation != old_generation
+
+        table.update("new name", {}, table.assembly_ids)
+
+        lease = acquire_pool(snapshot_tables((table, other_table)), (table.table_id,))
+        assert lease.pool != pool
+        pool.join()
+        pool = lease.pool
+
+        assert pool.map(_worker_table_name, [lease.table_ref(table.table_id)]) == ["new name"]
+        assert pool.map(_worker_table_name, [lease.table_ref(other_table.table_id)]) == ["other table"]
+        lease.release()
+
+        # Tables re-created with the same ID don't get mistaken for what's already in the pool
+        table = MemoryVariantTable("re-created_id", "old", {})
+        lease = acquire_pool(snapshot_tables((table,)), (table.table_id,))
+        pool.join()
+        pool = lease.pool
+        lease.release()
+
+        table = MemoryVariantTable("re-created_id", "new", {})
+        lease = acquire_pool(snapshot_tables((table,)), (table.table_id,))
+        assert lease.pool != pool
+        pool.join()
+        pool = lease.pool
+        assert pool.map(_worker_table_name, [lease.table_ref(table.table_id)]) == ["new"]
     finally:
-        dummy_pool.close()
-        dummy_pool.join()
+        lease.release()
+        shutdown_pool()
+        pool.join()
+
+
+def test_pool_tables_threads(monkeypatch):
+    # With a single worker, pools are made of threads in the request process; a pool which has been replaced should
+    # still only see its own tables while searches finish up with it.
+    monkeypatch.setattr(pool_module, "Pool", ThreadPool)
+
+    table_1 = MemoryVariantTable("table_1", "table 1", {})
+    table_2 = MemoryVariantTable("table_2", "table 2", {})
+
+    lease_1 = acquire_pool(snapshot_tables((table_1,)), (table_1.table_id,))
+    lease_2 = acquire_pool(snapshot_tables((table_2,)), (table_2.table_id,))
+
+    try:
+        assert lease_2.pool != lease_1.pool
+        assert lease_2.pool.map(_worker_table_name, [lease_2.table_ref(table_2.table_id)]) == ["table 2"]
+        assert lease_1.pool.map(_worker_table_name, [lease_1.table_ref(table_1.table_id)]) == ["table 1"]
+    finally:
+        lease_1.release()
+        lease_1.pool.join()
+        lease_2.release()
+        shutdown_pool()
+        lease_2.pool.join()
+
+
+def _wait_for_cancellation(search):
+    started = time.time()
+    while time.time() - started < 10:
+        if worker_cancelled(search):
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def _ref_cancelled(table_ref):
+    return worker_cancelled(table_ref.search)
+
+
+def test_pool_cancel():
+    table = MemoryVariantTable("fixed_id", "test table", {})
+    tables = snapshot_tables((table,))
+
+    lease = acquire_pool(tables, (table.table_id,))
+    pool = lease.pool
+    ref = lease.table_ref(table.table_id)
+
+    try:
+        # Workers see the cancellation while in the middle of a task
+        result = pool.apply_async(_wait_for_cancellation, (ref.search,))
+        lease.cancel()
+        assert result.get(timeout=15)
+        lease.release()
+
+        # New searches start out uncancelled, even if they get the same slot
+        lease = acquire_pool(tables, (table.table_id,))
+        assert lease.pool == pool
+        assert lease.table_ref(table.table_id).search.slot == ref.search.slot
+        assert pool.apply_async(_ref_cancelled, (lease.table_ref(table.table_id),)).get(timeout=15) is False
+    finally:
+        lease.release()
+        shutdown_pool()
+        pool.join()
+
+
+def test_pool_cancel_threads(monkeypatch):
+    # Cancelling one search doesn't cancel whatever another search is doing with the same pool
+    monkeypatch.setattr(pool_module, "Pool", ThreadPool)
+
+    lease_1 = acquire_pool({}, ())
+    lease_2 = acquire_pool({}, ())
+    pool = lease_1.pool
+
+    try:
+        assert lease_2.pool == pool
+        result = pool.apply_async(_wait_for_cancellation, (lease_2.search,))
+        lease_2.cancel()
+        assert result.get(timeout=15)
+        assert pool.apply_async(worker_cancelled, (lease_1.search,)).get(timeout=15) is False
+    finally:
+        lease_1.release()
+        lease_2.release()
+        shutdown_pool()
+        pool.join()
+
+
+def test_pool_cancellable_searches(monkeypatch):
+    monkeypatch.setattr(pool_module, "MAX_CANCELLABLE_SEARCHES", 1)
+
+    shutdown_pool()
+    table = MemoryVariantTable("fixed_id", "test table", {})
+    tables = snapshot_tables((table,))
+    lease_1 = acquire_pool(tables, (table.table_id,))
+    lease_2 = acquire_pool(tables, (table.table_id,))
+
+    try:
+        # Searches past the limit still run, but can't be cancelled by anything other than their deadline
+        assert lease_1.table_ref(table.table_id).search is not None
+        assert lease_2.table_ref(table.table_id).search is None
+        lease_2.cancel()
+        assert lease_2.pool.apply_async(_ref_cancelled, (lease_2.table_ref(table.table_id),)).get(timeout=15) is False
+    finally:
+        lease_1.release()
+        lease_2.release()
+        shutdown_pool()
+        lease_1.pool.join()
+
+
+def test_pool_broken():
+    lease_1 = acquire_pool({}, ())
+    lease_2 = acquire_pool({}, ())
+    pool = lease_1.pool
+
+    # A search giving up on a stuck pool gets the next searches a new one, but doesn't stop the pool out from under
+    # searches still using it
+    lease_1.release(broken=True)
+    assert pool.apply_async(sum, ((1, 2),)).get(timeout=15) == 3
+
+    lease_3 = acquire_pool({}, ())
+    try:
+        assert lease_3.pool != pool
+    finally:
+        lease_2.release()
+        pool.join()
+        lease_3.release()
+        shutdown_pool()
+        lease_3.pool.join()
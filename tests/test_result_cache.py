@@ -0,0 +1,61 @@
+from bento_variant_service.metrics import clear_metrics, get_metrics
+from bento_variant_service.result_cache import ResultCache
+
+
+def test_result_cache_lru():
+    clear_metrics()
+
+    cache = ResultCache("test_cache", 10)
+
+    assert cache.get("a") is None
+    cache.put("a", "value a", 4, ("t1",))
+    cache.put("b", "value b", 4, ("t2",))
+    assert cache.get("a") == "value a"
+    assert len(cache) == 2 and cache.n_bytes == 8
+
+    # Entries are evicted by size, least recently used first
+    cache.put("c", "value c", 4, ("t1", "t2"))
+    assert cache.get("b") is None
+    assert cache.get("a") == "value a" and cache.get("c") == "value c"
+    assert len(cache) == 2 and cache.n_bytes == 8
+
+    # Replacing an entry doesn't count its old size
+    cache.put("c", "new value c", 6, ("t2",))
+    assert cache.get("c") == "new value c" and cache.n_bytes == 10
+
+    # Values bigger than the whole cache aren't cached
+    cache.put("d", "value d", 11, ())
+    assert cache.get("d") is None and len(cache) == 2
+
+    metrics = get_metrics()
+    assert metrics["counters"] == {
+        "test_cache_hits": 4,
+        "test_cache_misses": 3,
+        "test_cache_evictions": 1,
+    }
+    assert metrics["gauges"] == {"test_cache_bytes": 10, "test_cache_entries": 2}
+
+
+def test_result_cache_invalidation():
+    clear_metrics()
+
+    cache = ResultCache("test_cache", 100)
+    cache.put("a", "value a", 1, ("t1",))
+    cache.put("b", "value b", 1, ("t1", "t2"))
+    cache.put("c", "value c", 1, ("t3",))
+
+    cache.invalidate_table("t2")
+    assert cache.get("b") is None and cache.get("a") == "value a"
+
+    cache.invalidate_table("t1")
+    cache.invalidate_table("t4")
+    assert cache.get("a") is None and cache.get("c") == "value c"
+    assert get_metrics()["counters"]["test_cache_invalidations"] == 2
+
+    cache.clear()
+    assert cache.get("c") is None and cache.n_bytes == 0
+
+    # Caches without any room don't keep anything
+    cache = ResultCache("test_cache", 0)
+    cache.put("a", "value a", 0, ())
+    assert cache.get("a") is None
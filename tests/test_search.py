@@ -1,7 +1,15 @@
 import json
+import threading
+import time
 
-from bento_variant_service.pool import get_pool, teardown_pool
+from types import SimpleNamespace
+from unittest.mock import ANY
+
+from bento_variant_service import search
+from bento_variant_service.metrics import clear_metrics, get_metrics
+from bento_variant_service.pool import shutdown_pool
 from bento_variant_service.tables.memory import MemoryTableManager
+from bento_variant_service.variants.regions import Region, WHOLE_GENOME, intersect_regions, normalize_regions
 
 from .shared_data import VARIANT_1, VARIANT_4, VARIANT_5
 
@@ -31,6 +39,13 @@ QUERY_11 = ["#and", QUERY_1, QUERY_FRAGMENT_7]
 QUERY_12 = ["#and", QUERY_1, QUERY_FRAGMENT_8]
 QUERY_13 = ["#and", QUERY_1, QUERY_FRAGMENT_9]
 QUERY_14 = ["#and", QUERY_1, QUERY_FRAGMENT_10]
+# Values in #or branches stay in the query checked against each variant, so they need to be the right type
+QUERY_15 = ["#and", QUERY_1, ["#or", ["#eq", ["#resolve", "start"], 7000], ["#lt", ["#resolve", "start"], 5000]]]
+QUERY_16 = ["#or", ["#and", QUERY_1, ["#eq", ["#resolve", "start"], 7000]],
+            ["#and", QUERY_1, ["#eq", ["#resolve", "start"], 7001]]]
+QUERY_17 = ["#or", ["#eq", ["#resolve", "chromosome"], "2"], QUERY_1]
+QUERY_18 = ["#or", ["#and", QUERY_1, ["#ge", ["#resolve", "start"], 5000]],
+            ["#and", QUERY_1, ["#le", ["#resolve", "start"], 5000]]]  # Overlapping regions
 
 TEST_QUERIES = (
     (QUERY_1, True),
@@ -47,6 +62,10 @@ TEST_QUERIES = (
     (QUERY_12, True),
     (QUERY_13, True),
     (QUERY_14, True),
+    (QUERY_15, True),
+    (QUERY_16, True),
+    (QUERY_17, True),
+    (QUERY_18, True),
 )
 
 TEST_PRIVATE_QUERIES = (
@@ -64,22 +83,18 @@ TEST_PRIVATE_QUERIES = (
     (QUERY_12, 1),
     (QUERY_13, 1),
     (QUERY_14, 1),
+    (QUERY_15, 1),
+    (QUERY_16, 2),
+    (QUERY_17, 3),
+    (QUERY_18, 3),
 )
 
 
-def test_chord_variant_search(app, client, table_manager):
+def test_chord_variant_search(app, client, make_memory_table):
     with app.app_context():
-        pool = get_pool()
-
         try:
-            mm: MemoryTableManager = table_manager
-
             # Create a new table with ID fixed_id and name test
-            table = mm.create_table_and_update("test", {})
-
-            table.variant_store.append(VARIANT_1)
-            table.variant_store.append(VARIANT_4)
-            table.variant_store.append(VARIANT_5)
+            make_memory_table(VARIANT_1, VARIANT_4, VARIANT_5)
 
             for rv in (client.post("/search"),
                        client.get("/search"),
@@ -111,6 +126,15 @@ def test_chord_variant_search(app, client, table_manager):
                        client.get("/private/search", query_string={"data_type": "variant", "query": "[5, 6, 7"})):
                 assert rv.status_code == 400
 
+            # Queries which are valid JSON but can't be searched with, including malformed positions in #or branches
+            for q in (["#eq", ["#resolve", "start"]],
+                      ["#eq", ["#resolve", "start"], "abc"],
+                      ["#or", QUERY_1, ["#gt", ["#resolve", "start"], "abc"]]):
+                for rv in (client.post("/search", json={"data_type": "variant", "query": q}),
+                           client.post("/private/search", json={"data_type": "variant", "query": q}),
+                           client.post("/private/tables/fixed_id/search", json={"query": q})):
+                    assert rv.status_code == 400
+
             # Test table search
 
             # - Invalid data type
@@ -251,5 +275,548 @@ def test_chord_variant_search(app, client, table_manager):
                 assert len(data["results"]) == r
 
         finally:
-            teardown_pool(None)
-            pool.join()
+            shutdown_pool()
+
+
+def test_search_execution_planning(app, client, table_manager, monkeypatch, make_memory_table):
+    with app.app_context():
+        clear_metrics()
+
+        mm: MemoryTableManager = table_manager
+        table = make_memory_table(VARIANT_1, VARIANT_4, VARIANT_5)
+
+        # Small searches are run in the request process
+        assert search.plan_inline_search((table,), None, (Region("1", None, None),))
+
+        rv = client.post("/private/search", json={"data_type": "variant", "query": QUERY_2})
+        inline_data = rv.get_json()
+        assert len(inline_data["results"]["fixed_id"]["matches"]) == 3
+
+        # Anything above the threshold gets sent to the pool, with the same results
+        mm.search_cache.clear()
+        monkeypatch.setattr(search, "INLINE_SEARCH_MAX_WORK", 2)
+        assert not search.plan_inline_search((table,), None, (Region("1", None, None),))
+
+        rv = client.post("/private/search", json={"data_type": "variant", "query": QUERY_2})
+        assert rv.get_json() == inline_data
+
+        rv = client.get("/private/metrics")
+        assert rv.status_code == 200
+        data = rv.get_json()
+        assert data["counters"]["searches_inline"] == 2
+        assert data["counters"]["searches_pooled"] == 2
+        assert data["gauges"]["search_inline_max_work"] == 2
+        assert data["gauges"]["search_last_estimated_work"] == 3
+
+
+def test_query_regions():
+    from bento_lib.search.queries import convert_query_to_ast_and_preprocess
+
+    assert normalize_regions((Region("1", 10, 20), Region("1", 15, 30), Region("1", 30, 40))) == \
+        (Region("1", 10, 40),)
+    assert normalize_regions((Region("2", 5, None), Region("1", None, 5))) == \
+        (Region("1", None, 5), Region("2", 5, None))
+    assert normalize_regions((Region("1", 10, 10),)) == ()
+    assert normalize_regions((Region("1", 0, 100), Region(None, 10, 20))) == \
+        (Region(None, 10, 20), Region("1", 0, 10), Region("1", 20, 100))
+    assert normalize_regions((Region("chr1", 10, 20), Region("1", 15, 30), Region("chr2", None, None))) == \
+        (Region("1", 10, 30), Region("chr2", None, None))
+
+    assert intersect_regions(Region("1", 10, None), Region(None, None, 20)) == Region("1", 10, 20)
+    assert intersect_regions(Region("1", 10, None), Region("2", None, 20)) is None
+    assert intersect_regions(Region("1", 10, None), Region(None, None, 10)) is None
+    assert intersect_regions(Region("chr1", 10, None), Region("1", None, 20)) == Region("chr1", 10, 20)
+
+    def regions(q):
+        return search.parse_query_for_tabix(convert_query_to_ast_and_preprocess(q))[0]
+
+    assert regions(["#eq", ["#resolve", "ref"], "C"]) == (WHOLE_GENOME,)
+    assert regions(["#not", QUERY_1]) == (WHOLE_GENOME,)
+    assert regions(QUERY_8) == (Region("1", 5000, 5001),)
+    assert regions(QUERY_15) == (Region("1", None, 5000), Region("1", 7000, 7001))
+    assert regions(QUERY_16) == (Region("1", 7000, 7002),)
+    assert regions(QUERY_17) == (Region("1", None, None), Region("2", None, None))
+    assert regions(QUERY_18) == (Region("1", None, None),)
+    assert regions(["#and", QUERY_13, QUERY_14]) == ()
+    assert regions(["#and", ["#eq", ["#resolve", "chromosome"], "chr1"], ["#eq", ["#resolve", "chromosome"], "1"]]) == \
+        (Region("chr1", None, None),)
+    assert regions(["#or", ["#eq", ["#resolve", "chromosome"], "chr1"], ["#eq", ["#resolve", "chromosome"], "1"]]) == \
+        (Region("1", None, None),)
+
+
+def test_query_constant_folding(app, client, make_memory_table):
+    from bento_lib.search.queries import Literal, convert_query_to_ast_and_preprocess
+
+    def fold(q):
+        return search.fold_constants(convert_query_to_ast_and_preprocess(q))
+
+    assert fold(["#eq", 1, 1]) == Literal(True)
+    assert fold(["#lt", 2, 1]) == Literal(False)
+    assert fold(["#and", QUERY_1, ["#eq", 1, 1]]) == convert_query_to_ast_and_preprocess(QUERY_1)
+    assert fold(["#and", QUERY_1, ["#eq", 1, 2]]) == Literal(False)
+    assert fold(["#or", QUERY_1, ["#not", ["#eq", 1, 2]]]) == Literal(True)
+    assert fold(["#or", ["#eq", 1, 2], ["#gt", 1, 2]]) == Literal(False)
+    assert fold(["#eq", 1, "a"]) == convert_query_to_ast_and_preprocess(["#eq", 1, "a"])
+
+    assert search.parse_query_for_tabix(convert_query_to_ast_and_preprocess(["#eq", 1, 1])) == ((WHOLE_GENOME,), None)
+
+    with app.app_context():
+        make_memory_table(VARIANT_1)
+
+        # Queries which can never match are answered without running a search
+        for q in (["#and", QUERY_1, ["#eq", 1, 2]],
+                  ["#and", QUERY_1, ["#eq", ["#resolve", "chromosome"], "2"]],
+                  ["#and", QUERY_FRAGMENT_3, QUERY_FRAGMENT_4]):
+            clear_metrics()
+            rv = client.post("/private/search", json={"data_type": "variant", "query": q})
+            assert rv.get_json() == {"results": {}, "timed_out_tables": []}
+            rv = client.post("/search", json={"data_type": "variant", "query": q})
+            assert rv.get_json() == {"results": [], "timed_out_tables": []}
+            assert get_metrics()["counters"] == {"searches_empty": 2}
+
+
+def test_query_sample_ids():
+    from bento_lib.search.queries import convert_query_to_ast_and_preprocess
+
+    def sample_ids(q):
+        return search.query_sample_ids(convert_query_to_ast_and_preprocess(q))
+
+    sample_1 = ["#eq", ["#resolve", "calls", "[item]", "sample_id"], "S0001"]
+    sample_2 = ["#eq", ["#resolve", "calls", "[item]", "sample_id"], "S0002"]
+
+    assert sample_ids(QUERY_1) is None
+    assert sample_ids(sample_1) == {"S0001"}
+    assert sample_ids(["#and", QUERY_1, sample_1]) == {"S0001"}
+    assert sample_ids(["#and", QUERY_1, ["#or", sample_1, sample_2]]) == {"S0001", "S0002"}
+    assert sample_ids(["#and", ["#or", sample_1, sample_2], sample_2]) == {"S0002"}
+    assert sample_ids(["#or", sample_1, QUERY_1]) is None
+    assert sample_ids(["#not", sample_1]) is None
+
+
+def test_query_only_interesting():
+    from bento_lib.search.queries import convert_query_to_ast_and_preprocess
+
+    def only_interesting(q):
+        return search.query_only_interesting(convert_query_to_ast_and_preprocess(q))
+
+    het = ["#eq", ["#resolve", "calls", "[item]", "genotype_type"], "HETEROZYGOUS"]
+    hom_alt = ["#eq", ["#resolve", "calls", "[item]", "genotype_type"], "HOMOZYGOUS_ALTERNATE"]
+    hom_ref = ["#eq", ["#resolve", "calls", "[item]", "genotype_type"], "HOMOZYGOUS_REFERENCE"]
+
+    assert not only_interesting(QUERY_1)
+    assert only_interesting(het)
+    assert only_interesting(["#and", QUERY_1, ["#or", het, hom_alt]])
+    assert not only_interesting(["#and", QUERY_1, ["#or", het, hom_ref]])
+    assert not only_interesting(["#or", het, QUERY_1])
+    assert not only_interesting(["#not", hom_ref])
+
+
+def test_aggregate_search(app, client, table_manager, monkeypatch, make_memory_table):
+    with app.app_context():
+        clear_metrics()
+
+        mm: MemoryTableManager = table_manager
+        make_memory_table(VARIANT_1, VARIANT_4, VARIANT_5)
+
+        def aggregate(q, group_by=(), url="/private/search"):
+            rv_post = client.post(url, json={"data_type": "variant", "query": q, "aggregate": True,
+                                             "group_by": list(group_by)})
+            rv_get = client.get(url, query_string={"data_type": "variant", "query": json.dumps(q),
+                                                   "aggregate": "true", "group_by": ",".join(group_by)})
+            assert rv_post.status_code == 200
+            assert rv_post.get_json() == rv_get.get_json()
+            return rv_post.get_json()["results"]
+
+        assert aggregate(QUERY_1) == {"fixed_id": {"data_type": "variant", "count": 3, "groups": {}}}
+        assert aggregate(QUERY_2, ("chromosome", "genotype_type", "chromosome")) == {"fixed_id": {
+            "data_type": "variant",
+            "count": 3,
+            "groups": {"chromosome": {"1": 3}, "genotype_type": {"HETEROZYGOUS": 3}},
+        }}
+        assert aggregate(QUERY_9, ("assembly_id",)) == {"fixed_id": {
+            "data_type": "variant", "count": 1, "groups": {"assembly_id": {"GRCh37": 1}}}}
+
+        # Tables without matches are left out, like in normal private searches
+        assert aggregate(QUERY_10, ("chromosome",)) == {}
+
+        # Table searches always give back counts for the table
+        assert aggregate(QUERY_13, url="/private/tables/fixed_id/search") == {"count": 1, "groups": {}}
+        assert aggregate(QUERY_10, ("chromosome",), url="/private/tables/fixed_id/search") == {
+            "count": 0, "groups": {"chromosome": {}}}
+
+        # Pooled searches count the same way
+        inline_results = aggregate(QUERY_2, ("chromosome", "genotype_type"))
+        mm.search_cache.clear()
+        monkeypatch.setattr(search, "INLINE_SEARCH_MAX_WORK", 2)
+        assert aggregate(QUERY_2, ("chromosome", "genotype_type")) == inline_results
+
+        # Memory tables don't have indices to count from
+        assert "search_tables_counted_from_index" not in get_metrics()["counters"]
+
+        # Bad aggregate options
+        for url in ("/private/search", "/private/tables/fixed_id/search"):
+            for body in ({"aggregate": "yes"},
+                         {"aggregate": True, "group_by": "chromosome"},
+                         {"aggregate": True, "group_by": ["ref"]},
+                         {"group_by": ["chromosome"]}):
+                rv = client.post(url, json={"data_type": "variant", "query": QUERY_1, **body})
+                assert rv.status_code == 400
+
+            rv = client.get(url, query_string={"data_type": "variant", "query": json.dumps(QUERY_1),
+                                               "aggregate": "maybe"})
+            assert rv.status_code == 400
+
+        # Counts are only available privately
+        for url in ("/search", "/tables/fixed_id/search"):
+            rv = client.post(url, json={"data_type": "variant", "query": QUERY_1, "aggregate": True})
+            assert rv.status_code == 400
+
+
+def test_search_fields(app, client, make_memory_table):
+    with app.app_context():
+        make_memory_table(VARIANT_1, VARIANT_4, VARIANT_5)
+
+        calls_query = ["#and", QUERY_2, ["#eq", ["#resolve", "calls", "[item]", "genotype_type"], "HETEROZYGOUS"]]
+        extra = {"_extra": {"file_uri": None}}
+
+        for q in (QUERY_2, calls_query):
+            for fields in (["start", "ref"], ["start", "calls.genotype_type"]):
+                # Private search responses are streamed, so each one has to be read before the next request
+                rv_post = client.post("/private/search", json={"data_type": "variant", "query": q, "fields": fields})
+                data = rv_post.get_json()
+                rv_get = client.get("/private/search", query_string={
+                    "data_type": "variant", "query": json.dumps(q), "fields": ",".join(fields)})
+                assert data == rv_get.get_json()
+
+                matches = data["results"]["fixed_id"]["matches"]
+                assert matches[0] == {
+                    "start": 5000,
+                    **({"ref": "C"} if "ref" in fields else {"calls": [{"genotype_type": "HETEROZYGOUS"}]}),
+                    **extra,
+                }
+                assert len(matches) == 3
+
+                rv = client.post("/private/tables/fixed_id/search", json={"query": q, "fields": fields})
+                assert rv.get_json()["results"] == matches
+
+        for body in ({"fields": "start"}, {"fields": ["stop"]}, {"fields": ["start"], "aggregate": True}):
+            rv = client.post("/private/search", json={"data_type": "variant", "query": QUERY_2, **body})
+            assert rv.status_code == 400
+
+        rv = client.post("/search", json={"data_type": "variant", "query": QUERY_2, "fields": ["start"]})
+        assert rv.status_code == 400
+
+
+def test_search_call_samples(app, client, make_memory_table):
+    with app.app_context():
+        make_memory_table(VARIANT_1, VARIANT_4, metadata={"sample_sets": {"subset": ["S0002"]}})
+
+        def matches(url="/private/search", **kwargs):
+            rv = client.post(url, json={"data_type": "variant", "query": QUERY_1, **kwargs})
+            assert rv.status_code == 200
+            results = rv.get_json()["results"]
+            return results if url != "/private/search" else results["fixed_id"]["matches"]
+
+        assert [len(m["calls"]) for m in matches()] == [1, 1]
+        assert [len(m["calls"]) for m in matches(samples=["S0001"])] == [1, 1]
+
+        # Variants are still returned without any calls for the samples
+        assert [m["calls"] for m in matches(samples=["S0002"])] == [[], []]
+        assert [m["calls"] for m in matches(sample_set="subset")] == [[], []]
+        assert [m["calls"] for m in matches("/private/tables/fixed_id/search", sample_set="subset")] == [[], []]
+
+        assert matches(samples=["S0001"], fields=["start", "calls.sample_id"])[0] == {
+            "start": 5000, "calls": [{"sample_id": "S0001"}], "_extra": {"file_uri": None}}
+
+        rv = client.get("/private/search", query_string={
+            "data_type": "variant", "query": json.dumps(QUERY_1), "samples": "S0002"})
+        assert [m["calls"] for m in rv.get_json()["results"]["fixed_id"]["matches"]] == [[], []]
+
+        for body in ({"samples": "S0001"}, {"sample_set": ["subset"]}, {"samples": ["S0001"], "sample_set": "subset"},
+                     {"samples": ["S0001"], "aggregate": True}):
+            rv = client.post("/private/search", json={"data_type": "variant", "query": QUERY_1, **body})
+            assert rv.status_code == 400
+
+        rv = client.post("/private/tables/fixed_id/search", json={"query": QUERY_1, "sample_set": "not_a_set"})
+        assert rv.status_code == 400
+        rv = client.post("/search", json={"data_type": "variant", "query": QUERY_1, "samples": ["S0001"]})
+        assert rv.status_code == 400
+
+
+def test_search_timeouts(app, client, table_manager, monkeypatch, make_memory_table):
+    with app.app_context():
+        clear_metrics()
+
+        mm: MemoryTableManager = table_manager
+        table = make_memory_table(VARIANT_1, VARIANT_4, VARIANT_5)
+
+        regions = (Region("1", None, None),)
+
+        # Workers stuck past the timeout are given up on, and their tables are reported as timed out
+        def slow_beacon_match(*_args, **_kwargs):
+            time.sleep(2)
+            return True
+
+        monkeypatch.setattr(type(table), "beacon_match", slow_beacon_match)
+        monkeypatch.setattr(search, "INLINE_SEARCH_MAX_WORK", 0)
+        timed_out_tables = []
+        assert list(search.beacon_variant_search(
+            mm, "GRCh37", "1", None, None, None, None, "C", "T", timeout=1, timed_out_tables=timed_out_tables)) == []
+        assert timed_out_tables == ["fixed_id"]
+
+        # Beacon lookups which haven't started by the deadline are skipped
+        r = search.beacon_search_worker_prime(table, "GRCh37", "1", None, None, None, None, "C", "T", deadline=0)
+        assert r == search.TableResult("fixed_id", False, None, True)
+
+        # Searches stop once the deadline passes, sending back what was found before then
+        def fake_clock():
+            ticks = iter(range(100))
+            return SimpleNamespace(time=lambda: next(ticks))
+
+        monkeypatch.setattr(search, "time", fake_clock())
+        r = search.search_worker_prime(table, regions, None, True, None, deadline=4)
+        assert r.timed_out and r.found and r.data.n_matches == 2
+        assert json.loads(r.data.data)[1]["start"] == 7000
+
+        # The deadline is checked by the table for each row it reads, not just between the variants it yields
+        monkeypatch.setattr(search, "time", fake_clock())
+        r = search.search_worker_prime(table, regions, None, True, None, deadline=1)
+        assert r.timed_out and not r.found
+
+        monkeypatch.setattr(search, "time", fake_clock())
+        r = search.aggregate_search_worker_prime(table, regions, None, None, None, False, ("chromosome",), deadline=2)
+        assert r.timed_out and r.data == search.VariantCounts(1, {"chromosome": {"1": 1}})
+
+        r = search.search_worker_prime(table, regions, None, True, None)
+        assert not r.timed_out and r.data.n_matches == 3
+
+        # Responses say which tables timed out
+        monkeypatch.setattr(search, "time", time)
+        monkeypatch.setattr(search, "CHORD_SEARCH_TIMEOUT", 0)
+        monkeypatch.setattr(search, "INLINE_SEARCH_MAX_WORK", 1000000)
+
+        rv = client.post("/private/search", json={"data_type": "variant", "query": QUERY_1})
+        assert rv.get_json() == {"results": {}, "timed_out_tables": ["fixed_id"]}
+        rv = client.post("/search", json={"data_type": "variant", "query": QUERY_1})
+        assert rv.get_json() == {"results": [], "timed_out_tables": ["fixed_id"]}
+        rv = client.post("/private/tables/fixed_id/search", json={"query": QUERY_1})
+        assert rv.get_json() == {"results": [], "timed_out": True}
+        rv = client.post("/private/tables/fixed_id/search", json={"query": QUERY_1, "aggregate": True})
+        assert rv.get_json() == {"results": {"count": 0, "groups": {}}, "timed_out": True}
+
+        assert get_metrics()["counters"]["search_tables_timed_out"] == 5
+
+
+def test_search_cancellation(app, client, table_manager, monkeypatch, make_memory_table):
+    with app.app_context():
+        clear_metrics()
+
+        mm: MemoryTableManager = table_manager
+        table = make_memory_table(VARIANT_1, VARIANT_4)
+
+        regions = (Region("1", None, None),)
+
+        # Pool workers stop searching once the pool is cancelled
+        r = search.search_worker_prime(table, regions, None, True, None)
+        assert r.found and r.data.n_matches == 2
+
+        monkeypatch.setattr(search, "_cancellation_check", lambda _t: lambda: True)
+        r = search.search_worker_prime(table, regions, None, True, None)
+        assert r == search.TableResult("fixed_id", False, search.EMPTY_ENCODED_MATCHES, False, True)
+        r = search.aggregate_search_worker_prime(table, regions, None, None, None, False, ())
+        assert r == search.TableResult("fixed_id", False, search.VariantCounts(0, {}), False, True)
+        r = search.beacon_search_worker_prime(table, "GRCh37", "1", None, None, None, None, "C", "T")
+        assert r == search.TableResult("fixed_id", False, None, False, True)
+
+        # Tables which were only partly searched before a cancellation aren't passed off as fully searched
+        timed_out_tables = []
+        assert search.chord_search(mm, "variant", QUERY_1, internal_data=True, timed_out_tables=timed_out_tables) == {}
+        assert timed_out_tables == ["fixed_id"]
+        assert get_metrics()["counters"]["search_tables_cancelled"] == 1
+        monkeypatch.undo()
+
+        # Searches small enough to be run inline aren't streamed
+        rv = client.post("/private/search", json={"data_type": "variant", "query": QUERY_1})
+        assert "Content-Length" in rv.headers
+        assert len(rv.get_json()["results"]["fixed_id"]["matches"]) == 2
+        mm.search_cache.clear()
+
+        # Closing a streamed response before the search is done cancels the rest of it
+        monkeypatch.setattr(search, "INLINE_SEARCH_MAX_WORK", 0)
+        rv = client.post("/private/search", json={"data_type": "variant", "query": QUERY_1})
+        chunks = iter(rv.response)
+        assert next(chunks) == b'{"results":{'
+        assert next(chunks).startswith(b'"fixed_id":{"data_type":"variant","matches":[')
+        rv.close()
+        assert get_metrics()["counters"]["searches_cancelled"] == 1
+
+        # Searches which are read to the end aren't cancelled
+        rv = client.post("/private/search", json={"data_type": "variant", "query": QUERY_1})
+        assert "Content-Length" not in rv.headers
+        assert len(rv.get_json()["results"]["fixed_id"]["matches"]) == 2
+        assert get_metrics()["counters"]["searches_cancelled"] == 1
+        mm.search_cache.clear()
+
+        # Errors partway through a streamed response still leave valid JSON, which says the results are incomplete
+        def failing_search_results(*args):
+            yield next(search_results(*args))
+            raise ValueError("test error")
+
+        search_results = search._search_results
+        monkeypatch.setattr(search, "_search_results", failing_search_results)
+        rv = client.post("/private/search", json={"data_type": "variant", "query": QUERY_1})
+        assert "Content-Length" not in rv.headers
+        assert rv.get_json() == {
+            "results": {"fixed_id": {"data_type": "variant", "matches": ANY}},
+            "timed_out_tables": [],
+            "error": "Encountered error during search",
+        }
+
+
+def test_search_table_updated_mid_search(app, table_manager, monkeypatch, make_memory_table):
+    with app.app_context():
+        mm: MemoryTableManager = table_manager
+        table = make_memory_table(VARIANT_1)
+
+        # Tables can be updated (e.g. by a background index build) between the pool being set up and the tasks being
+        # sent to it; workers should still find the version of the table the search started with.
+        acquire_pool = search.acquire_pool
+
+        def acquire_pool_then_update(tables, table_ids):
+            lease = acquire_pool(tables, table_ids)
+            table.add_variant(VARIANT_4)
+            return lease
+
+        monkeypatch.setattr(search, "acquire_pool", acquire_pool_then_update)
+        monkeypatch.setattr(search, "INLINE_SEARCH_MAX_WORK", 0)
+
+        timed_out_tables = []
+        results = search.chord_search(mm, "variant", QUERY_1, internal_data=True, timed_out_tables=timed_out_tables)
+        assert results["fixed_id"].n_matches >= 1
+        assert timed_out_tables == []
+
+
+def test_search_coalescing(app, table_manager, monkeypatch, make_memory_table):
+    with app.app_context():
+        clear_metrics()
+
+        mm: MemoryTableManager = table_manager
+        table = make_memory_table(VARIANT_1, VARIANT_4)
+
+        release = threading.Event()
+        search_results = search._search_results
+
+        def slow_search_results(*args):
+            release.wait(10)
+            yield from search_results(*args)
+
+        monkeypatch.setattr(search, "_search_results", slow_search_results)
+
+        results = []
+
+        def run_search(query):
+            with app.app_context():
+                results.append(search.chord_search(mm, "variant", query, internal_data=True))
+
+        # Queries which are written differently but search the same thing get coalesced too
+        queries = (QUERY_1, QUERY_1, ["#and", QUERY_1, ["#eq", 1, 1]])
+        threads = [threading.Thread(target=run_search, args=(q,)) for q in queries]
+        for t in threads:
+            t.start()
+
+        started = time.time()
+        while get_metrics()["counters"].get("searches_coalesced", 0) < 2:
+            assert time.time() - started < 10
+            time.sleep(0.01)
+
+        release.set()
+        for t in threads:
+            t.join()
+
+        assert len(results) == 3 and results[0]["fixed_id"].n_matches == 2
+        assert results[1] == results[0] and results[2] == results[0]
+        assert get_metrics()["counters"]["searches_executed"] == 1
+        assert get_metrics()["gauges"]["searches_coalescing_ratio"] == 2 / 3
+
+        # Searches are keyed on the table generations, so nothing stale gets shared
+        assert search.ast_key(search.convert_query_to_ast_and_preprocess(["#eq", 1, "1"])) == \
+            ("#eq", ("int", 1), ("str", "1"))
+        generations = search.table_generations(mm)
+        table.add_variant(VARIANT_5)
+        assert search.table_generations(mm) != generations
+
+        # Streamed searches aren't coalesced, since whoever shared them would only get results as fast as the first
+        # search's client reads them
+        monkeypatch.setattr(search, "_search_results", search_results)
+        monkeypatch.setattr(search, "INLINE_SEARCH_MAX_WORK", 0)
+        streamed = search.chord_search(mm, "variant", QUERY_1, internal_data=True, stream=True)
+        assert not isinstance(streamed, dict)
+        assert dict(streamed)["fixed_id"].n_matches == 3
+        assert get_metrics()["counters"]["searches_executed"] == 1
+
+
+def test_search_result_cache(app, client, table_manager, make_memory_table):
+    with app.app_context():
+        clear_metrics()
+
+        mm: MemoryTableManager = table_manager
+        table = make_memory_table(VARIANT_1, VARIANT_4)
+
+        def private_search(q):
+            rv = client.post("/private/search", json={"data_type": "variant", "query": q})
+            return rv.get_json()["results"]["fixed_id"]["matches"]
+
+        matches = private_search(QUERY_1)
+        assert len(matches) == 2
+        assert get_metrics()["counters"]["search_cache_misses"] == 1
+        assert get_metrics()["gauges"]["search_cache_entries"] == 1
+
+        # Repeated searches (including the same search written differently) come from the cache
+        assert private_search(QUERY_1) == matches
+        assert private_search(["#and", QUERY_1, ["#eq", 1, 1]]) == matches
+        assert get_metrics()["counters"]["search_cache_hits"] == 2
+
+        # Public searches are cached separately from private ones
+        rv = client.post("/search", json={"data_type": "variant", "query": QUERY_1})
+        assert rv.get_json()["results"] == [{"id": "fixed_id", "data_type": "variant"}]
+        assert get_metrics()["counters"]["search_cache_misses"] == 2
+
+        # Changes to a table are picked up right away, since the table generation is part of the key
+        table.variant_store.append(VARIANT_5)
+        assert len(private_search(QUERY_1)) == 3
+        assert get_metrics()["counters"]["search_cache_misses"] == 3
+
+        # Deleting a table evicts every entry involving it
+        assert len(mm.search_cache) == 3
+        mm.delete_table_and_update("fixed_id")
+        assert len(mm.search_cache) == 0
+        assert get_metrics()["counters"]["search_cache_invalidations"] == 3
+
+
+def test_search_result_cache_incomplete(app, client, table_manager, monkeypatch, make_memory_table):
+    with app.app_context():
+        clear_metrics()
+
+        mm: MemoryTableManager = table_manager
+        make_memory_table(VARIANT_1, VARIANT_4)
+
+        # Searches where workers were cancelled partway through don't fill the cache
+        monkeypatch.setattr(search, "_cancellation_check", lambda _t: lambda: True)
+        assert search.chord_search(mm, "variant", QUERY_1, internal_data=True) == {}
+        assert len(mm.search_cache) == 0
+        monkeypatch.undo()
+
+        # Neither do streamed searches which are cancelled before they're done
+        monkeypatch.setattr(search, "INLINE_SEARCH_MAX_WORK", 0)
+        rv = client.post("/private/search", json={"data_type": "variant", "query": QUERY_1})
+        chunks = iter(rv.response)
+        next(chunks)
+        next(chunks)
+        rv.close()
+        assert get_metrics()["counters"]["searches_cancelled"] == 1
+        assert len(mm.search_cache) == 0
+
+        # Once a search does run to completion, it's cached
+        rv = client.post("/private/search", json={"data_type": "variant", "query": QUERY_1})
+        assert len(rv.get_json()["results"]["fixed_id"]["matches"]) == 2
+        assert len(mm.search_cache) == 1
@@ -16,6 +16,7 @@ from bento_variant_service.table_manager import (
     clear_table_manager,
 )
 from bento_variant_service.variants.models import Variant
+from bento_variant_service.variants.regions import Region, WHOLE_GENOME
 from .shared_data import (
     T_ALLELE,
 
@@ -64,6 +65,17 @@ def test_memory_table_manager():
     assert len(ts) == 1
     assert ts["fixed_id"] is tbl
 
+    # Memory tables don't know their contigs, so they're always routed to
+    assert mm.route_tables("GRCh37", (Region("22", None, None),)) == (tbl,)
+
+    # Tables are routed to in order of table ID, whatever order they were created in
+    mm.id_to_generate = "a_table"
+    tbl_a = mm.create_table_and_update("test a", {})
+    assert mm.route_tables("GRCh37", (Region("22", None, None),)) == (tbl_a, tbl)
+    assert mm.route_tables(None, (WHOLE_GENOME,)) == (tbl_a, tbl)
+    mm.delete_table_and_update("a_table")
+    mm.id_to_generate = "fixed_id"
+
     tbl.variant_store.append(Variant(
         assembly_id="GRCh38",
         chromosome="1",
@@ -138,6 +150,17 @@ def test_vcf_table_manager(tmpdir):
     assert t1.n_of_variants == 1
     assert t1.n_of_samples == 835
 
+    # Tables are routed to by contig, with or without a chr prefix
+    t2 = vm.create_table_and_update("test 2", {})
+    assert t1.contig_routes == {("GRCh37", "22")}
+    assert t2.contig_routes == set()
+    assert vm.route_tables("GRCh37", (Region("22", None, None),)) == (t1,)
+    assert vm.route_tables(None, (Region("chr22", 5, 10),)) == (t1,)
+    assert vm.route_tables("GRCh38", (Region("22", None, None),)) == ()
+    assert vm.route_tables(None, (Region("21", None, None),)) == ()
+    assert set(vm.route_tables(None, (WHOLE_GENOME,))) == {t1, t2}
+
     vm.delete_table_and_update(t1.table_id)
     assert t1.deleted
     assert vm.get_table(t1.table_id) is None
+    assert vm.route_tables(None, (Region("22", None, None),)) == ()
@@ -1,12 +1,20 @@
 import json
 import os
+import pysam
 import shutil
 
 from jsonschema import validate
 from typing import Optional, Tuple
 
+from bento_variant_service import search
+from bento_variant_service.metrics import clear_metrics, get_metrics
 from bento_variant_service.tables.memory import MemoryTableManager
+from bento_variant_service.tables.vcf.carriers import build_carrier_index
+from bento_variant_service.tables.vcf.file import VCFFile
+from bento_variant_service.tables.vcf.table import VCFVariantTable
+from bento_variant_service.tables.vcf.sample_index import build_sample_index
 from bento_variant_service.tables.vcf.vcf_manager import VCFTableManager
+from bento_variant_service.variants.regions import Region
 from bento_variant_service.variants.schemas import VARIANT_TABLE_METADATA_SCHEMA, VARIANT_SCHEMA
 
 from .shared_data import (
@@ -14,7 +22,6 @@ from .shared_data import (
     VCF_ONE_VAR_INDEX_FILE_PATH,
 
     VCF_TEN_VAR_FILE_PATH,
-    VCF_TEN_VAR_INDEX_FILE_PATH,
 
     VCF_MISSING_9_FILE_PATH,
     VCF_MISSING_9_INDEX_FILE_PATH,
@@ -171,8 +178,9 @@ def test_table_data(client, table_manager):
     rv = client.get("/private/tables/fixed_id/data")
     assert rv.status_code == 200
     data = rv.get_json()
-    # TODO: Test schema
-    assert json.dumps(data["schema"], sort_keys=True) == json.dumps(VARIANT_SCHEMA, sort_keys=True)
+    # The schema is sent by reference
+    rv_schema = client.get(data["schema"]["$ref"])
+    assert json.dumps(rv_schema.get_json(), sort_keys=True) == json.dumps(VARIANT_SCHEMA, sort_keys=True)
     assert data["pagination"]["previous_page_url"] is None
     assert data["pagination"]["next_page_url"] is None
     assert json.dumps(data["data"], sort_keys=True) == json.dumps([
@@ -181,6 +189,23 @@ def test_table_data(client, table_manager):
         VARIANT_3.as_chord_representation(),
     ], sort_keys=True)
 
+    # Field projection
+    rv = client.get("/private/tables/fixed_id/variants", query_string={"fields": "chromosome,start,ref,alt"})
+    assert rv.status_code == 200
+    assert rv.get_json()["data"] == [
+        {"chromosome": v.chromosome, "start": v.start_pos, "ref": v.ref_bases, "alt": [a.value for a in v.alt_alleles]}
+        for v in (VARIANT_1, VARIANT_2, VARIANT_3)]
+
+    rv = client.get("/private/tables/fixed_id/variants",
+                    query_string={"fields": "start,calls.sample_id", "count": 1})
+    data = rv.get_json()
+    assert data["data"] == [{"start": 5000, "calls": [{"sample_id": "S0001"}]}]
+    rv = client.get(data["pagination"]["next_page_url"])
+    assert rv.get_json()["data"] == [{"start": 5003, "calls": [{"sample_id": "S0001"}]}]
+
+    rv = client.get("/private/tables/fixed_id/variants", query_string={"fields": "start,calls.read_depth"})
+    assert rv.status_code == 400
+
 
 SHARED_QUERY_STRINGS_AND_RESULTS = (
     ({"offset": "not_an_int"}, 400, None),
@@ -287,18 +312,9 @@ def test_vcf_table_error_handling(vcf_table_manager):
 
 
 # noinspection DuplicatedCode
-def test_vcf_table_pagination(client_vcf_mode, vcf_table_manager):
-    vm: VCFTableManager = vcf_table_manager
-
-    # Create a new table named test
-    t = vm.create_table_and_update("test", {})
-
-    # Add ten_variants_22.vcf.gz
-    shutil.copyfile(VCF_TEN_VAR_FILE_PATH, os.path.join(vm.data_path, t.table_id, "test.vcf.gz"))
-    shutil.copyfile(VCF_TEN_VAR_INDEX_FILE_PATH, os.path.join(vm.data_path, t.table_id, "test.vcf.gz.tbi"))
-
-    # Update to register new files
-    vm.update_tables()
+def test_vcf_table_pagination(client_vcf_mode, make_vcf_table):
+    # Create a new table named test, with ten_variants_22.vcf.gz
+    t = make_vcf_table()
 
     for q, sc, r in VCF_QUERY_STRINGS_AND_RESULTS:
         rv = client_vcf_mode.get(f"/private/tables/{t.table_id}/variants", query_string=q)
@@ -317,3 +333,268 @@ def test_vcf_table_pagination(client_vcf_mode, vcf_table_manager):
     assert len(tuple(t.variants(start_min=16050607))) == 7  # inclusive min
     assert len(tuple(t.variants(start_max=16050627))) == 4  # exclusive max
     assert len(tuple(t.variants(start_min=16050607, start_max=16050627))) == 1  # "
+
+    assert t.may_overlap("GRCh37", (Region("22", 16050607, 16050627),))
+    assert not t.may_overlap("GRCh38", (Region("22", 16050607, 16050627),))
+    assert not t.may_overlap(None, (Region("21", None, None), Region("22", None, 16050000)))
+
+    # Only the requested samples' calls are parsed
+    variants = tuple(t.variants(chromosome="22", sample_ids=frozenset({"HG00096", "NA19648", "not_a_sample"})))
+    assert len(variants) == 10
+    assert all(tuple(c.sample_id for c in v.calls) == ("NA19648", "HG00096") for v in variants)
+    assert len(tuple(t.variants(chromosome="22", sample_ids=frozenset({"not_a_sample"})))) == 0
+
+    # Regions are fetched one after the other, each variant only being yielded for the region it starts in
+    assert len(tuple(t.variants_in_regions(None, (Region("22", None, 16050607), Region("22", 16050607, None))))) == 10
+    assert len(tuple(t.variants_in_regions(None, (Region("22", 16050607, 16050627), Region(None, 16050627, None))))) \
+        == 7
+
+
+def test_vcf_table_chr_prefix_regions(vcf_table_manager):
+    vm: VCFTableManager = vcf_table_manager
+    t = vm.create_table_and_update("test", {})
+
+    # chr-prefixed copy of ten_variants_22.vcf.gz
+    vcf_path = os.path.join(vm.data_path, t.table_id, "test.vcf")
+    with pysam.BGZFile(VCF_TEN_VAR_FILE_PATH) as src, open(vcf_path, "w") as f:
+        for line in src.read().decode("utf-8").splitlines(keepends=True):
+            f.write(line.replace("##contig=<ID=", "##contig=<ID=chr") if line.startswith("#") else f"chr{line}")
+    pysam.tabix_index(vcf_path, preset="vcf")
+    vm.update_tables()
+
+    # Differently-prefixed names for the contig in the same query don't return rows twice
+    query = ["#or", ["#eq", ["#resolve", "chromosome"], "22"], ["#eq", ["#resolve", "chromosome"], "chr22"]]
+    regions = search.parse_query_for_tabix(search.convert_query_to_ast_and_preprocess(query))[0]
+    assert regions == (Region("22", None, None),)
+
+    starts = [v.start_pos for v in t.variants_in_regions(None, regions)]
+    assert len(starts) == 10 and len(set(starts)) == 10
+
+
+def test_vcf_table_carrier_index(vcf_table_manager, make_vcf_table):
+    vm: VCFTableManager = vcf_table_manager
+    t = make_vcf_table()
+    vcf_path = t.files[0].path
+
+    def results():
+        interesting = tuple(
+            (v.start_pos, tuple((c.sample_id, c.genotype) for c in v.calls))
+            for v in t.variants(only_interesting=True))
+        restricted = tuple(
+            (v.start_pos, tuple(c.sample_id for c in v.calls))
+            for v in t.variants(only_interesting=True, sample_ids=frozenset({"HG00096", "NA19648"})))
+        beacon = tuple(
+            t.beacon_match("GRCh37", "22", v.start_pos, v.start_pos + 1, None, None, v.ref_bases, a.value)
+            for v in t.variants() for a in v.alt_alleles)
+        return interesting, restricted, beacon
+
+    assert t.files[0].carriers is None
+    expected = results()
+    assert all(expected[2])
+
+    generation = t.generation
+    build_carrier_index(vcf_path)
+    vm.update_tables()
+
+    assert t.generation != generation  # Workers need the new file records
+    assert t.files[0].carriers is not None
+    assert results() == expected
+
+
+def test_vcf_table_carrier_index_no_alt_calls(vcf_table_manager):
+    vm: VCFTableManager = vcf_table_manager
+    t = vm.create_table_and_update("test", {})
+
+    # 0/. doesn't carry an alternate allele, but it's still a heterozygous (i.e. interesting) call
+    vcf_path = os.path.join(vm.data_path, t.table_id, "test.vcf")
+    with open(vcf_path, "w") as f:
+        f.write("\n".join((
+            "##fileformat=VCFv4.2",
+            "##contig=<ID=22>",
+            '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">',
+            "\t".join(("#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT", "S1", "S2", "S3")),
+            "22\t100\t.\tA\tG\t.\tPASS\t.\tGT\t0/0\t0/.\t0/0",
+            "22\t200\t.\tC\tT\t.\tPASS\t.\tGT\t0/1\t0/.\t0/0",
+            "22\t300\t.\tG\tA\t.\tPASS\t.\tGT\t0/0\t0/0\t./.",
+        )) + "\n")
+    vcf_path = pysam.tabix_index(vcf_path, preset="vcf")
+    vm.update_tables()
+
+    def results(**kwargs):
+        return tuple(
+            (v.start_pos, tuple((c.sample_id, c.genotype_type) for c in v.calls))
+            for v in t.variants(only_interesting=True, **kwargs))
+
+    expected = (
+        (100, (("S2", "HETEROZYGOUS"),)),
+        (200, (("S1", "HETEROZYGOUS"), ("S2", "HETEROZYGOUS"))),
+    )
+    assert results() == expected
+    assert results(sample_ids=frozenset({"S2"})) == ((100, (("S2", "HETEROZYGOUS"),)), (200, (("S2", "HETEROZYGOUS"),)))
+
+    build_carrier_index(vcf_path)
+    vm.update_tables()
+    assert t.files[0].carriers is not None
+
+    # Listings are the same with or without the index
+    assert results() == expected
+    assert results(sample_ids=frozenset({"S2"})) == ((100, (("S2", "HETEROZYGOUS"),)), (200, (("S2", "HETEROZYGOUS"),)))
+    assert results(sample_ids=frozenset({"S3"})) == ()
+
+    # Rows which are skipped are still checked for whether to stop, e.g. once a search's deadline has passed
+    checked_rows = []
+
+    def should_stop():
+        checked_rows.append(None)
+        return False
+
+    assert results(should_stop=should_stop) == expected
+    assert len(checked_rows) == 3
+    assert results(should_stop=lambda: True) == ()
+
+
+def test_vcf_table_search_interesting_keeps_calls(vcf_table_manager, make_vcf_table):
+    vm: VCFTableManager = vcf_table_manager
+    t = make_vcf_table()
+    vcf_path = t.files[0].path
+
+    # Genotype type queries only skip rows without interesting calls; the variants which match keep all their calls,
+    # including reference (0/0) ones
+    query = ["#eq", ["#resolve", "calls", "[item]", "genotype_type"], "HETEROZYGOUS"]
+
+    def matches():
+        return json.loads(search.chord_search(vm, "variant", query, internal_data=True)[t.table_id].data)
+
+    without_index = matches()
+    assert without_index
+    assert all(len(m["calls"]) == len(t.files[0].sample_ids) for m in without_index)
+    assert all(any(c["genotype_type"] == "HOMOZYGOUS_REFERENCE" for c in m["calls"]) for m in without_index)
+
+    build_carrier_index(vcf_path)
+    vm.update_tables()
+    assert t.files[0].carriers is not None
+    assert matches() == without_index
+
+
+def test_vcf_table_sample_index(vcf_table_manager, monkeypatch, make_vcf_table):
+    vm: VCFTableManager = vcf_table_manager
+    t = make_vcf_table()
+    vcf_path = t.files[0].path
+
+    def results(sample_ids, **kwargs):
+        return tuple(
+            (v.start_pos, tuple((c.sample_id, c.genotype) for c in v.calls))
+            for v in t.variants(only_interesting=True, sample_ids=frozenset(sample_ids), **kwargs))
+
+    queries = (({"HG00096"}, {}), ({"HG00096", "NA19648"}, {}), ({"NA19648"}, {"start_min": 16050627}))
+    expected = tuple(results(s, **kw) for s, kw in queries)
+    assert 0 < len(expected[1]) < 10
+
+    build_sample_index(vcf_path)
+    vm.update_tables()
+    assert t.files[0].sample_index is not None
+
+    sample_fetches = []
+    fetch_sample_rows = VCFFile.fetch_sample_rows
+
+    def spy(self, *args):
+        sample_fetches.append(args)
+        return fetch_sample_rows(self, *args)
+
+    monkeypatch.setattr(VCFFile, "fetch_sample_rows", spy)
+
+    assert tuple(results(s, **kw) for s, kw in queries) == expected
+    assert len(sample_fetches) == len(queries)  # Only the index's rows were read
+
+    # Without only_interesting, every row has a call for the sample
+    assert len(tuple(t.variants(sample_ids=frozenset({"HG00096"})))) == 10
+    assert len(sample_fetches) == len(queries)
+
+
+def test_vcf_table_aggregate_counts(vcf_table_manager, make_vcf_table):
+    vm: VCFTableManager = vcf_table_manager
+    t = make_vcf_table()
+    vcf_path = t.files[0].path
+
+    whole_contig = (Region("22", None, None),)
+    part_of_contig = (Region("22", None, 16050400), Region("22", 16050627, 16050628))
+    assert t.count_variants_in_regions(None, whole_contig) == {("GRCh37", "22"): 10}
+    assert t.count_variants_in_regions("GRCh38", whole_contig) == {}
+    assert t.count_variants_in_regions(None, part_of_contig) is None  # Needs a carrier / sample index
+
+    def aggregate(query, group_by):
+        clear_metrics()
+        return search.chord_search(vm, "variant", query, aggregate_by=group_by)
+
+    region_query = ["#and", ["#eq", ["#resolve", "chromosome"], "22"], ["#lt", ["#resolve", "start"], 16050400]]
+    ref_query = ["#and", region_query, ["#eq", ["#resolve", "ref"], "C"]]
+
+    queries = (region_query, ref_query)
+    expected = tuple(aggregate(q, ("chromosome", "genotype_type"))[t.table_id] for q in queries)
+    assert expected[0].n_matches == len(tuple(t.variants(None, "22", None, 16050400)))
+    assert 0 < expected[1].n_matches < expected[0].n_matches < 10
+    assert sum(expected[0].groups["genotype_type"].values()) == 835 * expected[0].n_matches
+
+    build_carrier_index(vcf_path)
+    vm.update_tables()
+    assert t.count_variants_in_regions(None, (Region("22", None, 16050400),)) == {
+        ("GRCh37", "22"): expected[0].n_matches}
+
+    # Region-only counts come from the index; anything else still goes through the variants
+    for q, e, from_index in zip(queries, expected, (True, False)):
+        counts = aggregate(q, ("chromosome",))[t.table_id]
+        assert counts == search.VariantCounts(e.n_matches, {"chromosome": e.groups["chromosome"]})
+        assert get_metrics()["counters"].get("search_tables_counted_from_index", 0) == from_index
+
+    assert aggregate(region_query, ("genotype_type",))[t.table_id] == \
+        search.VariantCounts(expected[0].n_matches, {"genotype_type": expected[0].groups["genotype_type"]})
+    assert "search_tables_counted_from_index" not in get_metrics()["counters"]
+
+
+def test_vcf_table_data_projection(client_vcf_mode, make_vcf_table):
+    t = make_vcf_table()
+
+    VCFVariantTable._parse_genotype.cache_clear()
+
+    rv = client_vcf_mode.get(f"/private/tables/{t.table_id}/variants", query_string={"fields": "chromosome,start"})
+    data = rv.get_json()["data"]
+    assert len(data) == 10 and all(set(v) == {"chromosome", "start"} for v in data)
+    assert VCFVariantTable._parse_genotype.cache_info().misses == 0  # No calls were parsed
+
+    rv = client_vcf_mode.get(f"/private/tables/{t.table_id}/variants",
+                             query_string={"fields": "calls.genotype_type", "count": 1})
+    data = rv.get_json()["data"]
+    assert len(data[0]["calls"]) == 835 and set(data[0]["calls"][0]) == {"genotype_type"}
+
+
+def test_vcf_table_call_samples(client_vcf_mode, make_vcf_table):
+    t = make_vcf_table({"sample_sets": {"subset": ["HG00096", "NA19648", "not_a_sample"]}})
+
+    subset = t.sample_set("subset")
+    assert subset == {"HG00096", "NA19648", "not_a_sample"}
+    assert t.sample_set("not_a_set") is None
+
+    def call_tuples(variants):
+        return tuple((v.start_pos, tuple((c.sample_id, c.genotype) for c in v.calls)) for v in variants)
+
+    for only_interesting in (False, True):
+        full = call_tuples(t.variants(only_interesting=only_interesting))
+        assert call_tuples(t.variants(only_interesting=only_interesting, call_sample_ids=subset)) == tuple(
+            (pos, tuple(c for c in calls if c[0] in subset)) for pos, calls in full)
+
+    assert all(len(v.calls) == 2 for v in t.variants(call_sample_ids=subset))
+
+    for args in ({"samples": "NA19648,HG00096"}, {"sample_set": "subset"}):
+        rv = client_vcf_mode.get(f"/private/tables/{t.table_id}/variants",
+                                 query_string={**args, "fields": "start,calls.sample_id", "count": 5})
+        data = rv.get_json()
+        assert len(data["data"]) == 5
+        # Calls are in the order of the columns in the file
+        assert all(v["calls"] == [{"sample_id": "NA19648"}, {"sample_id": "HG00096"}] for v in data["data"])
+
+        rv = client_vcf_mode.get(data["pagination"]["next_page_url"])
+        assert len(rv.get_json()["data"][0]["calls"]) == 2
+
+    for args in ({"sample_set": "not_a_set"}, {"sample_set": "subset", "samples": "HG00096"}):
+        rv = client_vcf_mode.get(f"/private/tables/{t.table_id}/variants", query_string=args)
+        assert rv.status_code == 400
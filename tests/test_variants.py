@@ -1,6 +1,9 @@
 import pytest
+from bento_variant_service.tables.vcf.table import VCFVariantTable
 from bento_variant_service.variants import genotypes as gt
-from bento_variant_service.variants.models import AlleleClass, Allele, ALLELE_MISSING, ALLELE_MISSING_UPSTREAM, Call
+from bento_variant_service.variants.models import (
+    AlleleClass, Allele, ALLELE_MISSING, ALLELE_MISSING_UPSTREAM, Call, Variant
+)
 from .shared_data import T_ALLELE, C_ALLELE, VARIANT_1, VARIANT_2, VARIANT_3, VARIANT_6, CALL_1, CALL_2
 
 
@@ -38,6 +41,17 @@ def test_allele_from_str():
     assert Allele.class_from_vcf("A") == AlleleClass.SEQUENCE
     assert Allele.class_from_vcf("<A>") == AlleleClass.STRUCTURAL
 
+    assert Allele.from_vcf("A") == Allele(AlleleClass.SEQUENCE, "A")
+    assert Allele.from_vcf("A") is Allele.from_vcf("A")
+    assert Allele.from_vcf("<INS>").allele_class == AlleleClass.STRUCTURAL
+    assert Allele.from_vcf(".") is ALLELE_MISSING
+    assert Allele.from_vcf("*") is ALLELE_MISSING_UPSTREAM
+
+
+def test_model_slots():
+    for obj in (T_ALLELE, VARIANT_1, CALL_1):
+        assert not hasattr(obj, "__dict__")
+
 
 def test_variant_equality():
     assert VARIANT_1 == VARIANT_1
@@ -51,6 +65,29 @@ def test_variant_equality():
     assert VARIANT_3 != VARIANT_6
 
 
+def test_variant_lazy_calls():
+    loads = []
+
+    def loader(variant):
+        loads.append(variant)
+        return (Call(variant=variant, sample_id="S0001", genotype=(0, 1), phased=True),)
+
+    v = Variant(assembly_id="GRCh37", chromosome="1", start_pos=5000, ref_bases="C", alt_alleles=(T_ALLELE,))
+    v.load_calls_lazily(loader)
+
+    r = v.as_chord_representation(include_calls=False)
+    assert "calls" not in r
+    assert r["start"] == 5000
+    assert len(loads) == 0  # Calls weren't needed
+
+    assert len(v.calls) == 1 and v.calls[0].variant is v
+    assert v.as_augmented_chord_representation()["calls"][0]["sample_id"] == "S0001"
+    assert len(loads) == 1  # Calls are only built once
+
+    v.calls = ()
+    assert v.calls == ()
+
+
 def test_call_fake_equality():
     assert CALL_1.variant != CALL_2.variant
     assert CALL_1.eq_no_variant_check(CALL_2)
@@ -105,3 +142,114 @@ def test_call_genotypes():
     assert c.genotype_alleles[0].allele_class == AlleleClass.STRUCTURAL
     assert c.genotype_type == gt.GT_HOMOZYGOUS_ALTERNATE
     assert c.is_interesting
+
+    # Calls of a variant with the same genotype share their alleles, rather than building them on every access
+    c = Call(VARIANT_1, "S0001", (0, 1))
+    assert c.genotype_alleles is Call(VARIANT_1, "S0002", (0, 1)).genotype_alleles
+    assert c.genotype_alleles is c.genotype_alleles
+
+
+def test_vcf_genotype_cache():
+    VCFVariantTable._parse_genotype.cache_clear()
+
+    assert VCFVariantTable._parse_genotype("0|1") == ((0, 1), False, gt.GT_HETEROZYGOUS)
+    assert VCFVariantTable._parse_genotype("1/1") == ((1, 1), True, gt.GT_HOMOZYGOUS_ALTERNATE)
+    assert VCFVariantTable._parse_genotype("./.") == ((".", "."), True, gt.GT_MISSING)
+    assert VCFVariantTable._parse_genotype("0|1") == ((0, 1), False, gt.GT_HETEROZYGOUS)
+
+    info = VCFVariantTable._parse_genotype.cache_info()
+    assert info.hits == 1 and info.misses == 3
+
+    # Cached genotype types are used as-is by calls
+    c = Call(VARIANT_1, "S0001", (0, 1), genotype_type=gt.GT_HETEROZYGOUS)
+    assert c.genotype_type == gt.GT_HETEROZYGOUS and c.is_interesting
+
+
+def test_vcf_format_layout():
+    assert VCFVariantTable._format_layout("GT") == (0, None, None, 1)
+    assert VCFVariantTable._format_layout("GT:AD:DP:GQ:PS") == (0, 2, 4, 5)
+    assert VCFVariantTable._format_layout("DP:GT") == (1, 0, None, 2)
+    assert VCFVariantTable._format_layout("AD") == (None, None, None, 0)
+
+    row = ("1", "5000", ".", "C", "T", ".", ".", ".", "GT:DP:PS", "0|1:10:5000", "1/1", "0|0:5:1")
+    calls = tuple(VCFVariantTable._variant_calls(VARIANT_1, ("S1", "S2", "S3"), row))
+    assert tuple((c.sample_id, c.genotype, c.read_depth, c.phase_set) for c in calls) == (
+        ("S1", (0, 1), 10, None),
+        ("S2", (1, 1), None, None),  # Trailing fields left out
+        ("S3", (0, 0), 5, None),
+    )
+
+
+def _call_tuples(calls):
+    try:
+        return tuple((c.sample_id, c.genotype, c.phased, c.phase_set, c.read_depth, c.genotype_type) for c in calls)
+    except ValueError:  # Bad rows should fail the same way either way
+        return ValueError
+
+
+def test_vcf_numpy_decoding(monkeypatch):
+    pytest.importorskip("numpy")
+    from bento_variant_service.tables.vcf import table as vcf_table
+    from bento_variant_service.tables.vcf.decoding import decode_sample_columns
+
+    sample_ids = tuple(f"S{i}" for i in range(10))
+    rows = (
+        ("1", "5000", ".", "C", "T", ".", ".", ".", "GT:DP:PS",
+         "0|1:10:5000", "1/1", "0/0:5:1", "./.:.:.", "*/1:3", "1|0", "0", "1:7", ".", "0/.:123456789:12"),
+        ("1", "5000", ".", "C", "T,G", ".", ".", ".", "DP:AD:GT",
+         "1:2,3:2/1", "2", "3:4", ".", "5:6:0|0", "7:8:1/1", ".:.:./.", "9:0:1", "10:1:0/0", "11:1:2/2:x"),
+        ("1", "5000", ".", "C", "T", ".", ".", ".", "GT:DP", *(("0/0:1", "0/1:2") * 5)),
+    )
+    unhandled = (
+        ("1", "5000", ".", "C", "T", ".", ".", ".", "GT:DP", "10/1:5"),  # Two-digit allele index
+        ("1", "5000", ".", "C", "T", ".", ".", ".", "GT:DP", "0/1/1:5"),  # Triploid
+        ("1", "5000", ".", "C", "T", ".", ".", ".", "GT:DP", "0/1:-5"),  # Not a plain integer
+        ("1", "5000", ".", "C", "T", ".", ".", ".", "GT:DP", "0/1:1234567890"),  # Too long
+        ("1", "5000", ".", "C", "T", ".", ".", ".", "GT:DP", "0-1:5"),  # Bad separator
+    )
+
+    for row in rows:
+        assert decode_sample_columns(row[9:], *VCFVariantTable._format_layout(row[8])[:3]) is not None
+    for row in unhandled:
+        assert decode_sample_columns(row[9:], 0, 1, None) is None
+
+    for row in rows + unhandled:
+        for only_interesting in (False, True):
+            for sample_columns in (None, (0, 4, 5, 9)):
+                args = (VARIANT_1, sample_ids, row, only_interesting, sample_columns)
+
+                monkeypatch.setattr(vcf_table, "HAS_NUMPY", False)
+                expected = _call_tuples(VCFVariantTable._variant_calls(*args))
+
+                monkeypatch.setattr(vcf_table, "HAS_NUMPY", True)
+                monkeypatch.setattr(vcf_table, "NUMPY_DECODE_MIN_COLUMNS", 1)
+                assert _call_tuples(VCFVariantTable._variant_calls(*args)) == expected
+
+    decoded = decode_sample_columns(rows[0][9:], 0, 1, 2)
+    assert decoded.alleles.tolist()[:5] == [[0, 1], [1, 1], [0, 0], [-1, -1], [-2, 1]]
+    assert decoded.read_depths.tolist()[:4] == [10, -1, 5, -1]
+    assert decoded.interesting.tolist()[:6] == [True, True, False, False, False, True]
+
+
+def test_vcf_interesting_prefilter():
+    def row(fmt, *samples):
+        return ("1", "5000", ".", "C", "T", ".", ".", ".", fmt, *samples)
+
+    sample_ids = ("S1", "S2", "S3")
+    rows = (
+        (row("GT:DP", "0/0:10", "0|0:11", "./.:1"), False),
+        (row("GT:DP", "0:10", ".", "*/1:1"), False),  # Missing first allele means a missing call
+        (row("GT", "0/0/0", "./1", ".|."), False),
+        (row("GT"), False),
+        (row("GT:DP", "0/0:10", "0/1:11", "./.:1"), True),
+        (row("GT", "0/0", "0/."), True),  # Heterozygous
+        (row("GT", "1"), True),
+        (row("GT:DP", "0/0:10", "00/0:11"), True),  # Not interesting, but can't be ruled out
+        (row("DP:GT", "10:0/0"), True),
+    )
+
+    for r, may_be_interesting in rows:
+        assert VCFVariantTable._row_may_be_interesting(r) == may_be_interesting
+        if not may_be_interesting:
+            # Never rules out a row which has interesting calls
+            assert not tuple(VCFVariantTable._variant_calls(VARIANT_1, sample_ids, r, only_interesting=True))
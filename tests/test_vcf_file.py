@@ -1,9 +1,22 @@
 import os
+import pickle
 import pytest
+import shutil
 
-from bento_variant_service.tables.vcf.file import VCFFile
+from bento_variant_service.tables.vcf import sample_index as sample_index_module
+from bento_variant_service.tables.vcf.carriers import CarrierIndex, build_carrier_index
+from bento_variant_service.tables.vcf.file import VCFFile, _read_tabix_contigs
+from bento_variant_service.tables.vcf.sample_index import SampleIndex, build_sample_index
+from bento_variant_service.tables.vcf.table import VCFVariantTable
 
-from .shared_data import VCF_ONE_VAR_FILE_PATH, VCF_ONE_VAR_FILE_URI, DRS_VCF_ID
+from .shared_data import (
+    VCF_ONE_VAR_FILE_PATH,
+    VCF_ONE_VAR_FILE_URI,
+    VCF_ONE_VAR_INDEX_FILE_PATH,
+    VCF_TEN_VAR_FILE_PATH,
+    VCF_TEN_VAR_INDEX_FILE_PATH,
+    DRS_VCF_ID,
+)
 
 
 def test_vcf_file():
@@ -17,6 +30,21 @@ def test_vcf_file():
     assert len(tuple(file.fetch())) == 1
     assert repr(file) == f"<VCFFile {file.path}>"
 
+    assert file.index_contigs == ("22",)
+    assert file.contig_extents == {"22": (16050075, 16056320)}
+    assert file.may_overlap("22", None, None)
+    assert file.may_overlap(None, 16050075, 16050076)
+    assert not file.may_overlap("22", None, 16050075)  # Exclusive maximum
+    assert not file.may_overlap("22", 16056321, None)
+    assert not file.may_overlap("21", None, None)
+    assert len(tuple(file.fetch_all_contigs(16050000, 16050100))) == 1
+    assert len(tuple(file.fetch_all_contigs(0, 1000))) == 0
+
+    assert file.estimate_rows(None, None, None) == 1
+    assert file.estimate_rows("22", 16050000, 16050100) == 1
+    assert file.estimate_rows("not_a_contig", None, None) == 0
+    assert file.estimate_rows(None, 16050000, 16050100) == 1
+
 
 def test_vcf_file_no_contig():
     file = VCFFile(VCF_ONE_VAR_FILE_URI)
@@ -26,3 +54,122 @@ def test_vcf_file_no_contig():
 def test_vcf_file_error():
     with pytest.raises(ValueError):
         VCFFile(VCF_ONE_VAR_FILE_URI, f"drs://drs.local/{DRS_VCF_ID}")
+
+
+def test_read_tabix_contigs():
+    assert _read_tabix_contigs(VCF_ONE_VAR_INDEX_FILE_PATH) == {"22": (16056320, 1)}
+    assert _read_tabix_contigs(VCF_TEN_VAR_INDEX_FILE_PATH)["22"][1] == 10
+    assert _read_tabix_contigs(VCF_ONE_VAR_FILE_PATH) == {}  # Not an index
+    assert _read_tabix_contigs(f"{VCF_ONE_VAR_FILE_PATH}.csi") == {}  # Does not exist
+
+
+def test_vcf_file_count_rows(tmpdir):
+    vcf_path = str(tmpdir / "test.vcf.gz")
+    shutil.copyfile(VCF_TEN_VAR_FILE_PATH, vcf_path)
+    shutil.copyfile(VCF_TEN_VAR_INDEX_FILE_PATH, f"{vcf_path}.tbi")
+
+    regions = (("22", None, None), (None, None, None), ("22", 16050000, 16050400), (None, 16050500, None),
+               ("22", 16050627, 16050628), ("21", None, None), ("22", 1, 2))
+
+    def fetched_counts(file):
+        all_rows = tuple(file.fetch())
+        counts = []
+        for chromosome, start_min, start_max in regions:
+            n = sum(1 for r in all_rows if (chromosome is None or r[0] == chromosome) and
+                    (start_min is None or int(r[1]) >= start_min) and (start_max is None or int(r[1]) < start_max))
+            counts.append({"22": n} if n else {})
+        return counts
+
+    # Whole contigs can be counted from the Tabix index alone
+    file = VCFFile(f"file://{vcf_path}")
+    assert file.count_rows("22", None, None) == {"22": 10}
+    assert file.count_rows(None, 16050000, None) == {"22": 10}
+    assert file.count_rows("21", None, None) == {}
+    assert file.count_rows("22", 16050000, 16050400) is None
+
+    expected = fetched_counts(file)
+    assert 0 < expected[2]["22"] < 10 and expected[-1] == {}
+
+    for build_index in (build_carrier_index, build_sample_index):
+        build_index(vcf_path)
+        file = VCFFile(f"file://{vcf_path}")
+        assert [{c: n for c, n in (file.count_rows(*r) or {}).items() if n} for r in regions] == expected
+        os.remove(f"{vcf_path}{(CarrierIndex if build_index is build_carrier_index else SampleIndex).SUFFIX}")
+
+
+def test_carrier_index(tmpdir):
+    vcf_path = str(tmpdir / "test.vcf.gz")
+    shutil.copyfile(VCF_TEN_VAR_FILE_PATH, vcf_path)
+    shutil.copyfile(VCF_TEN_VAR_INDEX_FILE_PATH, f"{vcf_path}.tbi")
+
+    assert VCFFile(f"file://{vcf_path}").carriers is None
+
+    path = build_carrier_index(vcf_path)
+    file = VCFFile(f"file://{vcf_path}")
+    index = file.carriers
+    assert index is not None and index.path == path
+    assert index.n_records == 10 and index.n_samples == 835
+
+    for row in file.fetch():
+        alts = row[4].split(",")
+        for alt_index in range(1, len(alts) + 2):
+            carriers = index.carriers(row[0], int(row[1]), row[3], row[4], alt_index)
+            assert bool(carriers) == VCFVariantTable._row_has_carrier(row, alt_index)
+
+        # Every interesting call in this file carries an alternate allele (unlike e.g. 0/.)
+        calls = VCFVariantTable._variant_calls(None, file.sample_ids, row, only_interesting=True)
+        columns = CarrierIndex.columns(index.carriers(row[0], int(row[1]), row[3], row[4]))
+        assert {file.sample_ids.index(c.sample_id) for c in calls} <= set(columns)
+
+    assert index.carriers("22", 1, "A", "G") is None
+    assert index.carriers("21", 16050075, "A", "G") is None
+    assert CarrierIndex.columns(0b100101) == (0, 2, 5)
+
+    assert pickle.loads(pickle.dumps(index)).n_records == 10
+
+    # Out-of-date indices aren't used
+    assert CarrierIndex.open_for(vcf_path, 11, 835) is None
+    os.utime(path, (0, 0))
+    assert VCFFile(f"file://{vcf_path}").carriers is None
+
+
+def test_sample_index(tmpdir, monkeypatch):
+    vcf_path = str(tmpdir / "test.vcf.gz")
+    shutil.copyfile(VCF_TEN_VAR_FILE_PATH, vcf_path)
+    shutil.copyfile(VCF_TEN_VAR_INDEX_FILE_PATH, f"{vcf_path}.tbi")
+
+    assert VCFFile(f"file://{vcf_path}").sample_index is None
+
+    build_sample_index(vcf_path)
+    file = VCFFile(f"file://{vcf_path}")
+    index = file.sample_index
+    assert isinstance(index, SampleIndex)
+    assert index.n_records == 10 and index.n_samples == 835
+
+    # Each sample's records are the rows where it has an interesting call
+    rows = tuple(file.fetch())
+    expected_records = [[] for _ in file.sample_ids]
+    for i, row in enumerate(rows):
+        for c in VCFVariantTable._variant_calls(None, file.sample_ids, row, only_interesting=True):
+            expected_records[file.sample_ids.index(c.sample_id)].append(i)
+
+    assert [index.records(c) for c in range(index.n_samples)] == expected_records
+    assert all(index.max_records((c,)) >= len(r) for c, r in enumerate(expected_records))
+
+    columns = file.sample_columns(("HG00096", "NA19648"))
+    expected_rows = tuple(r for i, r in enumerate(rows) if any(i in expected_records[c] for c in columns))
+    assert 0 < len(expected_rows) < len(rows)
+    assert tuple(tuple(r) for r in file.fetch_sample_rows(columns, None, None, None)) == \
+        tuple(tuple(r) for r in expected_rows)
+    assert tuple(tuple(r) for r in file.fetch_sample_rows(columns, "22", int(expected_rows[0][1]) + 1, None)) == \
+        tuple(tuple(r) for r in expected_rows[1:])
+    assert index.positions("21", columns) == []
+    assert tuple(file.fetch_sample_rows(columns, "21", None, None)) == ()
+
+    # Building in many small chunks, written out as they fill up, gives the same index
+    with open(index.path, "rb") as f:
+        index_data = f.read()
+    monkeypatch.setattr(sample_index_module, "_BUFFER_SIZE", 1)
+    build_sample_index(vcf_path)
+    with open(index.path, "rb") as f:
+        assert f.read() == index_data